@@ -0,0 +1,82 @@
+import tensorflow as tf
+from keras import backend as K
+from keras import optimizers
+from keras.optimizers import Optimizer
+
+class AccumulateGradients(Optimizer):
+    """Wraps an optimizer (e.g. Adam, SGD, Adadelta) so it updates the weights once every
+    `steps` batches with the mean of their gradients, i.e. trains with an effective batch
+    size of `steps` x batch size using the memory of a single batch.
+
+    Gradients are summed into accumulators every batch; on the last batch of every `steps`
+    the wrapped optimizer runs its usual update on the mean gradient and accumulators are
+    reset. Updates of the wrapped optimizer (weights, moments, its `iterations`) are only
+    applied on those batches, so its state and decay schedules count real updates.
+
+    `lr` is the learning rate variable of the wrapped optimizer, so callbacks setting
+    `model.optimizer.lr` (CyclicLR, ReduceLROnPlateau) change it. Note callbacks still run
+    every batch: use `CyclicLR(batches_per_update=steps)`.
+
+    `reduce_gradients`, if set, is a function applied to the mean gradients only on update
+    batches, e.g. averaging them across processes (see `allreduce_gradients`).
+
+    # Arguments
+        optimizer: optimizer instance to wrap
+        steps: batches per update
+
+    # Example
+        ```python
+            model.compile(optimizer=AccumulateGradients(Adam(lr=1e-4), steps=8), loss='categorical_crossentropy')
+        ```
+    """
+
+    def __init__(self, optimizer, steps, **kwargs):
+        super(AccumulateGradients, self).__init__(**kwargs)
+        self.optimizer = optimizers.get(optimizer)
+        self.steps     = steps
+        self.lr        = self.optimizer.lr
+        self.reduce_gradients = None
+        with K.name_scope(self.__class__.__name__):
+            self.iterations = K.variable(0, dtype='int64', name='iterations')
+
+    def get_updates(self, loss, params):
+        grads = self.optimizer.get_gradients(loss, params)
+        accumulators = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        accumulated  = [a + g for a, g in zip(accumulators, grads)]
+        update = K.equal(self.iterations % self.steps, self.steps - 1)
+        mean = [a / self.steps for a in accumulated]
+        if self.reduce_gradients is not None:
+            # in a branch so it only runs on update batches
+            mean = tf.cond(update, lambda: self.reduce_gradients(mean), lambda: mean)
+
+        # run the wrapped optimizer on the mean gradient, each of its updates applied only
+        # on update batches
+        update_fn, update_add_fn, get_gradients = K.update, K.update_add, self.optimizer.get_gradients
+        K.update     = lambda x, new_x: update_fn(x, K.switch(update, new_x, x))
+        K.update_add = lambda x, increment: update_add_fn(x, K.cast(update, K.dtype(x)) * increment)
+        self.optimizer.get_gradients = lambda loss, params: mean
+        try:
+            optimizer_updates = self.optimizer.get_updates(loss, params)
+        finally:
+            K.update, K.update_add, self.optimizer.get_gradients = update_fn, update_add_fn, get_gradients
+
+        self.updates = optimizer_updates + [
+            K.update(a, K.switch(update, K.zeros_like(a), new_a)) for a, new_a in zip(accumulators, accumulated)]
+        # count the batch once everything above read the count
+        with tf.control_dependencies(self.updates):
+            self.updates.append(K.update_add(self.iterations, 1))
+        self.weights = [self.iterations] + accumulators + self.optimizer.weights
+        return self.updates
+
+    def get_config(self):
+        config = {
+            'optimizer': optimizers.serialize(self.optimizer),
+            'steps': self.steps,
+        }
+        base_config = super(AccumulateGradients, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+    @classmethod
+    def from_config(cls, config):
+        optimizer = optimizers.deserialize(config.pop('optimizer'))
+        return cls(optimizer, **config)
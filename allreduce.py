@@ -0,0 +1,185 @@
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+from keras.callbacks import Callback
+
+from accumulate import AccumulateGradients
+
+class SharedMemoryAllreduce(object):
+    """Averages (and broadcasts) numpy arrays across `size` processes of one host through
+    memory-mapped files (e.g. in /dev/shm), so data-parallel training on CPU needs no MPI.
+
+    Every process writes its arrays to its row of a shared (size x n_elements) buffer,
+    then after a barrier sums a 1/size slice of the columns of all rows into a shared
+    result (reduce-scatter) and after another barrier reads the whole result
+    (allgather). Barriers are a counter per process each one only writes to, so no
+    atomic operations or locks are needed; waiting processes poll them with exponential
+    backoff (up to `max_wait` seconds between polls) instead of spinning on a core that
+    a peer may need to reach the barrier.
+
+    Rank 0 creates the files and must be constructed first, other ranks wait for them.
+
+    # Arguments
+        path: prefix of the shared files, e.g. /dev/shm/landmark-dp-1234
+        rank: index of this process (0..size-1)
+        size: number of processes
+        n_elements: max elements averaged or broadcast in a call
+        alive: optional function returning False if peers died (to stop waiting on barriers)
+        max_wait: max seconds between polls of a barrier
+    """
+
+    def __init__(self, path, rank, size, n_elements, alive=None, max_wait=1e-3):
+        self.path  = path
+        self.rank  = rank
+        self.size  = size
+        self.alive = alive
+        self.max_wait = max_wait
+        self.generation     = 0
+        self.barrier_time   = 0.
+        self.allreduce_time = 0.
+
+        if rank == 0:
+            self.rows     = np.memmap(path + '-rows',    dtype=np.float32, mode='w+', shape=(size, n_elements))
+            self.result   = np.memmap(path + '-result',  dtype=np.float32, mode='w+', shape=(n_elements, ))
+            self.counters = np.memmap(path + '-barrier', dtype=np.int64,   mode='w+', shape=(size, ))
+            self.stats    = np.memmap(path + '-stats',   dtype=np.float64, mode='w+', shape=(size, 2))
+            open(path + '-ready', 'w').close()
+        else:
+            while not os.path.exists(path + '-ready'):
+                time.sleep(0.1)
+            self.rows     = np.memmap(path + '-rows',    dtype=np.float32, mode='r+', shape=(size, n_elements))
+            self.result   = np.memmap(path + '-result',  dtype=np.float32, mode='r+', shape=(n_elements, ))
+            self.counters = np.memmap(path + '-barrier', dtype=np.int64,   mode='r+', shape=(size, ))
+            self.stats    = np.memmap(path + '-stats',   dtype=np.float64, mode='r+', shape=(size, 2))
+
+    def barrier(self):
+        start = time.time()
+        self.generation += 1
+        self.counters[self.rank] = self.generation
+        wait, last_check = 1e-6, start
+        while np.min(self.counters) < self.generation:
+            time.sleep(wait)
+            wait = min(2 * wait, self.max_wait)
+            if self.alive is not None and time.time() - last_check > 1.:
+                last_check = time.time()
+                if not self.alive():
+                    raise RuntimeError("Data parallel peer processes died")
+        self.barrier_time += time.time() - start
+
+    def _split(self, arrays, flat):
+        out, offset = [ ], 0
+        for a in arrays:
+            out.append(np.array(flat[offset:offset + a.size], dtype=a.dtype).reshape(a.shape))
+            offset += a.size
+        return out
+
+    def average(self, *arrays):
+        start = time.time()
+        n = sum(a.size for a in arrays)
+        offset = 0
+        for a in arrays:
+            self.rows[self.rank, offset:offset + a.size] = a.ravel()
+            offset += a.size
+        self.barrier()
+        chunks = np.linspace(0, n, self.size + 1).astype(np.int64)
+        lo, hi = chunks[self.rank], chunks[self.rank + 1]
+        np.sum(self.rows[:, lo:hi], axis=0, out=self.result[lo:hi])
+        self.result[lo:hi] /= self.size
+        self.barrier()
+        out = self._split(arrays, self.result)
+        self.allreduce_time += time.time() - start
+        return out
+
+    def broadcast(self, arrays):
+        """Returns `arrays` of rank 0 (all ranks pass arrays of the same shapes)."""
+        # so rank 0 does not overwrite the result of a previous call before every rank read it
+        self.barrier()
+        if self.rank == 0:
+            offset = 0
+            for a in arrays:
+                self.result[offset:offset + a.size] = a.ravel()
+                offset += a.size
+        self.barrier()
+        out = self._split(arrays, self.result) if self.rank != 0 else arrays
+        # so rank 0 does not overwrite the result before every rank read it
+        self.barrier()
+        return out
+
+    def close(self):
+        if self.rank == 0:
+            for suffix in ['-rows', '-result', '-barrier', '-stats', '-ready']:
+                if os.path.exists(self.path + suffix):
+                    os.remove(self.path + suffix)
+
+def allreduce_gradients(optimizer, allreduce):
+    """Makes `optimizer` average its gradients across processes with `allreduce` (a
+    SharedMemoryAllreduce) in every training step, or for an AccumulateGradients only the
+    accumulated gradients of the steps updating the weights."""
+
+    def average(grads):
+        grads = [tf.convert_to_tensor(g) for g in grads]
+        averaged = tf.py_func(allreduce.average, grads, [g.dtype for g in grads], stateful=True)
+        for a, g in zip(averaged, grads):
+            a.set_shape(g.shape)
+        return averaged
+
+    if isinstance(optimizer, AccumulateGradients):
+        optimizer.reduce_gradients = average
+        return optimizer
+
+    get_gradients = optimizer.get_gradients
+    optimizer.get_gradients = lambda loss, params: average(get_gradients(loss, params))
+    return optimizer
+
+class DataParallelSync(Callback):
+    """Keeps data-parallel processes in sync: broadcasts the weights and learning rate of
+    rank 0 when training starts and after every epoch (e.g. after ReduceLROnPlateau,
+    which only runs on rank 0, and to align batch normalization statistics each process
+    computes on its data), and reports throughput and scaling efficiency.
+
+    Must be the last callback so rank 0 broadcasts after the other callbacks ran.
+
+    # Arguments
+        allreduce: SharedMemoryAllreduce
+        baseline: optional images/s of a single process to compute scaling efficiency
+    """
+
+    def __init__(self, allreduce, baseline=None):
+        super(DataParallelSync, self).__init__()
+        self.allreduce = allreduce
+        self.baseline  = baseline
+
+    def sync(self):
+        weights = self.model.get_weights() + [np.array([K.get_value(self.model.optimizer.lr)], dtype=np.float32)]
+        weights = self.allreduce.broadcast(weights)
+        if self.allreduce.rank != 0:
+            self.model.set_weights(weights[:-1])
+            K.set_value(self.model.optimizer.lr, weights[-1][0])
+
+    def on_train_begin(self, logs=None):
+        self.sync()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.images = 0
+        self.allreduce.allreduce_time = 0.
+        self.epoch_start = self.last_batch_end = time.time()
+
+    def on_batch_end(self, batch, logs=None):
+        self.images += (logs or {}).get('size', 0)
+        self.last_batch_end = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        elapsed = self.last_batch_end - self.epoch_start
+        self.allreduce.stats[self.allreduce.rank] = [self.images / max(elapsed, 1e-6), self.allreduce.allreduce_time / max(elapsed, 1e-6)]
+        self.sync()
+        if self.allreduce.rank == 0:
+            rates, allreduce_fractions = self.allreduce.stats[:, 0], self.allreduce.stats[:, 1]
+            total = np.sum(rates)
+            print("\nData parallel: {} processes {:.1f} images/s ({:.1f} per process), {:.1f}% of step time in allreduce{}".format(
+                self.allreduce.size, total, total / self.allreduce.size, 100. * np.mean(allreduce_fractions),
+                ", scaling efficiency {:.1f}% of {} x {:.1f} images/s".format(
+                    100. * total / (self.allreduce.size * self.baseline), self.allreduce.size, self.baseline) \
+                    if self.baseline else " (pass the images/s of -dp 1 as -dpb for scaling efficiency)"))
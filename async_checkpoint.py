@@ -0,0 +1,236 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import h5py
+import numpy as np
+from keras import backend as K
+from keras import optimizers
+from keras.callbacks import Callback
+from keras.engine.topology import load_weights_from_hdf5_group_by_name
+from keras.models import model_from_config
+import keras
+
+def _json_type(obj):
+    # as keras.models.save_model does
+    if hasattr(obj, 'get_config'):
+        return {'class_name': obj.__class__.__name__, 'config': obj.get_config()}
+    if type(obj).__module__ == np.__name__:
+        return obj.item() if isinstance(obj, np.generic) else obj.tolist()
+    if callable(obj):
+        return obj.__name__
+    if type(obj).__name__ == type.__name__:
+        return obj.__name__
+    raise TypeError('Not JSON Serializable: {}'.format(obj))
+
+def _weight_names(weights):
+    return [(str(w.name) if getattr(w, 'name', None) else 'param_' + str(i)).encode('utf8') for i, w in enumerate(weights)]
+
+def _write_weights(group, layers):
+    # layers: list of (name, weight names, values) in the format of keras save_weights_to_hdf5_group
+    group.attrs['layer_names'] = [name.encode('utf8') for name, _, _ in layers]
+    group.attrs['backend'] = K.backend().encode('utf8')
+    group.attrs['keras_version'] = str(keras.__version__).encode('utf8')
+    for name, weight_names, values in layers:
+        g = group.create_group(name)
+        g.attrs['weight_names'] = weight_names
+        for weight_name, value in zip(weight_names, values):
+            dataset = g.create_dataset(weight_name, value.shape, dtype=value.dtype)
+            if not value.shape:
+                dataset[()] = value
+            else:
+                dataset[:] = value
+
+def _atomic_write(filepath, write):
+    tmp_filepath = filepath + '.tmp'
+    with h5py.File(tmp_filepath, 'w') as f:
+        write(f)
+    os.replace(tmp_filepath, filepath)
+
+class AsyncModelCheckpoint(Callback):
+    """Saves the model after every epoch as ModelCheckpoint does, but the weights (and
+    optimizer weights) are copied in memory at epoch end and written to disk by a
+    background thread, so training goes on while hundreds of MB are written. Files are
+    written next to their final path and renamed when complete, so a crash never
+    leaves a half-written checkpoint. At most one snapshot waits to be written: a save
+    requested while the previous one is being written waits for it.
+
+    With `frozen_once`, weights of layers without trainable weights (e.g. a frozen
+    classifier) are written once to a separate file (named after the hash of their
+    values, next to the checkpoints) referenced by every checkpoint, which only holds
+    the weights of trainable layers. Such checkpoints must be loaded with `load_model`
+    of this module (plain checkpoints load with either).
+
+    `save(model, filepath)` can be used to save other models (or at other times) with
+    the same writer.
+
+    # Arguments
+        filepath, monitor, verbose, save_best_only, mode, period: as in ModelCheckpoint
+        include_optimizer: whether to save the optimizer weights
+        frozen_once: write weights of frozen layers only once
+    """
+
+    def __init__(self, filepath, monitor='val_loss', verbose=0, save_best_only=False, mode='auto', period=1,
+                 include_optimizer=True, frozen_once=False):
+        super(AsyncModelCheckpoint, self).__init__()
+        self.filepath          = filepath
+        self.monitor           = monitor
+        self.verbose           = verbose
+        self.save_best_only    = save_best_only
+        self.period            = period
+        self.include_optimizer = include_optimizer
+        self.frozen_once       = frozen_once
+        self.epochs_since_last_save = 0
+        self.frozen_files      = { }
+        self.thread            = None
+
+        if mode == 'min' or (mode == 'auto' and 'acc' not in monitor):
+            self.monitor_op, self.best = np.less, np.Inf
+        else:
+            self.monitor_op, self.best = np.greater, -np.Inf
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        self.epochs_since_last_save += 1
+        if self.epochs_since_last_save < self.period:
+            return
+        self.epochs_since_last_save = 0
+        filepath = self.filepath.format(epoch=epoch + 1, **logs)
+        if self.save_best_only:
+            current = logs.get(self.monitor)
+            if current is None:
+                print('Can save best model only with {} available, skipping.'.format(self.monitor))
+                return
+            if not self.monitor_op(current, self.best):
+                if self.verbose > 0:
+                    print('\nEpoch {:05d}: {} did not improve'.format(epoch + 1, self.monitor))
+                return
+            if self.verbose > 0:
+                print('\nEpoch {:05d}: {} improved from {:0.5f} to {:0.5f}, saving model to {}'.format(
+                    epoch + 1, self.monitor, self.best, current, filepath))
+            self.best = current
+        elif self.verbose > 0:
+            print('\nEpoch {:05d}: saving model to {}'.format(epoch + 1, filepath))
+        self.save(self.model, filepath)
+
+    def on_train_end(self, logs=None):
+        self.wait()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def save(self, model, filepath):
+        self.wait()
+        start = time.time()
+
+        # one batch_get_value for all weights, in the main thread between two steps
+        layers = [layer for layer in model.layers if layer.weights]
+        weights = [w for layer in layers for w in layer.weights]
+        optimizer = getattr(model, 'optimizer', None) if self.include_optimizer else None
+        optimizer_weights = optimizer.weights if optimizer is not None else []
+        values = K.batch_get_value(weights + optimizer_weights)
+        layer_values, optimizer_values = values[:len(weights)], values[len(weights):]
+
+        snapshot = [ ]
+        for layer in layers:
+            n = len(layer.weights)
+            snapshot.append((layer.name, _weight_names(layer.weights), layer_values[:n], not layer.trainable_weights))
+            layer_values = layer_values[n:]
+
+        attrs = {
+            'keras_version' : str(keras.__version__).encode('utf8'),
+            'backend'       : K.backend().encode('utf8'),
+            'model_config'  : json.dumps(
+                {'class_name': model.__class__.__name__, 'config': model.get_config()}, default=_json_type).encode('utf8'),
+        }
+        if optimizer is not None:
+            attrs['training_config'] = json.dumps({
+                'optimizer_config': {'class_name': optimizer.__class__.__name__, 'config': optimizer.get_config()},
+                'loss': model.loss,
+                'metrics': model.metrics,
+                'sample_weight_mode': model.sample_weight_mode,
+                'loss_weights': model.loss_weights,
+            }, default=_json_type).encode('utf8')
+        snapshot_time = time.time() - start
+
+        self.thread = threading.Thread(
+            target=self._write, args=(filepath, attrs, snapshot, _weight_names(optimizer_weights), optimizer_values, snapshot_time))
+        self.thread.start()
+
+    def _write(self, filepath, attrs, snapshot, optimizer_weight_names, optimizer_values, snapshot_time):
+        start = time.time()
+        frozen = [(name, weight_names, values) for name, weight_names, values, is_frozen in snapshot if is_frozen]
+        if self.frozen_once and frozen:
+            h = hashlib.sha1()
+            for name, _, values in frozen:
+                h.update(name.encode('utf8'))
+                for value in values:
+                    h.update(np.ascontiguousarray(value).tobytes())
+            key = h.hexdigest()[:16]
+            if key not in self.frozen_files:
+                frozen_filepath = os.path.join(os.path.dirname(filepath), 'frozen-{}.hdf5'.format(key))
+                if not os.path.exists(frozen_filepath):
+                    _atomic_write(frozen_filepath, lambda f: _write_weights(f.create_group('model_weights'), frozen))
+                self.frozen_files[key] = os.path.basename(frozen_filepath)
+            attrs = dict(attrs, frozen_weights=self.frozen_files[key].encode('utf8'))
+            layers = [(name, weight_names, values) for name, weight_names, values, is_frozen in snapshot if not is_frozen]
+        else:
+            layers = [(name, weight_names, values) for name, weight_names, values, _ in snapshot]
+
+        def write(f):
+            for name, value in attrs.items():
+                f.attrs[name] = value
+            _write_weights(f.create_group('model_weights'), layers)
+            if optimizer_weight_names:
+                group = f.create_group('optimizer_weights')
+                group.attrs['weight_names'] = optimizer_weight_names
+                for name, value in zip(optimizer_weight_names, optimizer_values):
+                    dataset = group.create_dataset(name, value.shape, dtype=value.dtype)
+                    if not value.shape:
+                        dataset[()] = value
+                    else:
+                        dataset[:] = value
+
+        _atomic_write(filepath, write)
+        print("\nCheckpoint {} written in {:.1f}s (training paused {:.2f}s to snapshot it)".format(
+            os.path.basename(filepath), time.time() - start, snapshot_time))
+
+def load_model(filepath, custom_objects=None, compile=True):
+    """Loads a model saved by AsyncModelCheckpoint, also with weights of frozen layers in
+    a separate file (see `frozen_once`); other models are loaded with keras load_model."""
+    with h5py.File(filepath, 'r') as f:
+        if 'frozen_weights' not in f.attrs:
+            return keras.models.load_model(filepath, custom_objects=custom_objects, compile=compile)
+
+        model = model_from_config(json.loads(f.attrs['model_config'].decode('utf8')), custom_objects=custom_objects)
+        with h5py.File(os.path.join(os.path.dirname(filepath), f.attrs['frozen_weights'].decode('utf8')), 'r') as frozen:
+            load_weights_from_hdf5_group_by_name(frozen['model_weights'], model.layers)
+        load_weights_from_hdf5_group_by_name(f['model_weights'], model.layers)
+
+        if not compile or 'training_config' not in f.attrs:
+            return model
+
+        # as keras load_model does
+        training_config = json.loads(f.attrs['training_config'].decode('utf8'))
+        custom_objects  = custom_objects or {}
+        def convert(obj):
+            if isinstance(obj, list):
+                return [convert(o) for o in obj]
+            if isinstance(obj, dict):
+                return { key : convert(value) for key, value in obj.items() }
+            return custom_objects.get(obj, obj) if isinstance(obj, str) else obj
+        optimizer = optimizers.deserialize(training_config['optimizer_config'], custom_objects=custom_objects)
+        model.compile(optimizer=optimizer,
+                      loss=convert(training_config['loss']),
+                      metrics=convert(training_config['metrics']),
+                      loss_weights=training_config['loss_weights'],
+                      sample_weight_mode=training_config['sample_weight_mode'])
+        if 'optimizer_weights' in f:
+            model._make_train_function()
+            group = f['optimizer_weights']
+            model.optimizer.set_weights([group[name][()] for name in group.attrs['weight_names']])
+        return model
@@ -0,0 +1,139 @@
+import csv
+import glob
+import os
+import re
+import time
+
+import numpy as np
+from keras.callbacks import Callback
+
+class CheckpointEvaluator(object):
+    """Validates checkpoints written by a training process (see --async-validation of
+    train.py) as they appear, so training never stops to validate. Every checkpoint
+    matching `pattern` is evaluated once and a row (epoch, checkpoint, seconds, metrics)
+    appended to the CSV file `csv_path`. A checkpoint improving `monitor` is kept as
+    `best_filepath` (formatted with epoch and val_* metrics, as ModelCheckpoint names
+    them), other evaluated checkpoints are deleted.
+
+    Checkpoints are evaluated when their size did not change for a poll (atomic writes
+    with -acp are not matched until renamed). Runs until the process `parent_pid` exits
+    and every checkpoint was evaluated (without `parent_pid`, until none is pending).
+    Checkpoints already in the CSV are skipped so an evaluator can be restarted.
+
+    # Arguments
+        pattern: glob of checkpoints to evaluate, e.g. models/ResNet50-...-epoch*-async.hdf5
+        csv_path: where metrics are appended
+        best_filepath: e.g. models/ResNet50-...-epoch{epoch:03d}-val_acc{val_categorical_accuracy:.6f}.hdf5
+        evaluate: function checkpoint path -> { metric name : value }
+        monitor: val_* metric selecting the best checkpoint
+        mode: one of {min, max}
+        parent_pid: pid of the training process
+        poll: seconds between scans
+    """
+
+    def __init__(self, pattern, csv_path, best_filepath, evaluate, monitor, mode, parent_pid=None, poll=10.):
+        self.pattern       = pattern
+        self.csv_path      = csv_path
+        self.best_filepath = best_filepath
+        self.evaluate      = evaluate
+        self.monitor       = monitor
+        self.monitor_op    = np.less if mode == 'min' else np.greater
+        self.best          = np.Inf if mode == 'min' else -np.Inf
+        self.parent_pid    = parent_pid
+        self.poll          = poll
+        self.sizes         = { }
+        self.done          = set()
+
+        if os.path.exists(csv_path):
+            with open(csv_path, 'r') as csvfile:
+                for row in csv.DictReader(csvfile):
+                    self.done.add(row['checkpoint'])
+                    if self.monitor in row and self.monitor_op(float(row[self.monitor]), self.best):
+                        self.best = float(row[self.monitor])
+
+    def parent_alive(self):
+        if self.parent_pid is None:
+            return False
+        try:
+            os.kill(self.parent_pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def pending(self):
+        # checkpoints whose size did not change since the previous scan
+        ready = [ ]
+        for filepath in sorted(glob.glob(self.pattern)):
+            if os.path.basename(filepath) in self.done:
+                continue
+            size = os.path.getsize(filepath)
+            if self.sizes.get(filepath) == size:
+                ready.append(filepath)
+            self.sizes[filepath] = size
+        return ready
+
+    def append(self, row):
+        new_file = not os.path.exists(self.csv_path)
+        with open(self.csv_path, 'a') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=list(row.keys()))
+            if new_file:
+                writer.writeheader()
+            writer.writerow(row)
+
+    def run(self):
+        while True:
+            parent_alive = self.parent_alive()
+            pending = self.pending()
+            for filepath in pending:
+                start = time.time()
+                logs  = { 'val_' + name : value for name, value in self.evaluate(filepath).items() }
+                match = re.search(r'-epoch(\d+)', os.path.basename(filepath))
+                epoch = int(match.group(1)) if match else 0
+                row = dict(epoch=epoch, checkpoint=os.path.basename(filepath), seconds=round(time.time() - start, 1), **logs)
+                self.append(row)
+                self.done.add(row['checkpoint'])
+                print("Async validation of {} ({:.0f}s): {}".format(row['checkpoint'], row['seconds'],
+                    " ".join("{} {:.4f}".format(name, value) for name, value in sorted(logs.items()))))
+                if self.monitor_op(logs[self.monitor], self.best):
+                    self.best = logs[self.monitor]
+                    best_filepath = self.best_filepath.format(epoch=epoch, **logs)
+                    os.replace(filepath, best_filepath)
+                    print("{} improved to {:.6f}, kept as {}".format(self.monitor, self.best, best_filepath))
+                else:
+                    os.remove(filepath)
+            # files seen for the first time are evaluated on the next scan
+            if not parent_alive and not pending and not any(
+                    os.path.basename(f) not in self.done for f in glob.glob(self.pattern)):
+                break
+            time.sleep(self.poll if parent_alive else 1.)
+
+class AsyncValidationMetrics(Callback):
+    """Puts the metrics of the latest checkpoint evaluated by a CheckpointEvaluator into
+    the epoch logs (as val_*), so ReduceLROnPlateau and other callbacks after it act on
+    validation metrics lagging training by the epochs the evaluator is behind. Logs get
+    metrics only at epochs a new evaluation arrived, so each counts once (e.g. in the
+    patience of ReduceLROnPlateau).
+
+    # Arguments
+        csv_path: CSV file the CheckpointEvaluator appends metrics to
+    """
+
+    def __init__(self, csv_path):
+        super(AsyncValidationMetrics, self).__init__()
+        self.csv_path = csv_path
+        self.rows_read = 0
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs if logs is not None else {}
+        if not os.path.exists(self.csv_path):
+            return
+        with open(self.csv_path, 'r') as csvfile:
+            rows = list(csv.DictReader(csvfile))
+        if len(rows) <= self.rows_read:
+            return
+        self.rows_read = len(rows)
+        row = rows[-1]
+        metrics = { name : float(value) for name, value in row.items() if name.startswith('val_') }
+        logs.update(metrics)
+        print("\nAsync validation of epoch {} ({} epochs behind): {}".format(int(row['epoch']), epoch + 1 - int(row['epoch']),
+            " ".join("{} {:.4f}".format(name, value) for name, value in sorted(metrics.items()))))
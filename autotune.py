@@ -0,0 +1,98 @@
+import argparse
+import json
+import subprocess
+import sys
+import time
+from multiprocessing import cpu_count
+
+from cpu_tuning import SETTINGS, profile_path, save_profile
+
+# Tunes TensorFlow session threads, gen() workers, OpenCV threads in workers and core pinning
+# for train.py on this host: runs short training trials (train.py --benchmark-steps) and saves
+# the configuration with the highest end-to-end images/s to tuning/cpu-<hostname>.json, which
+# train.py loads automatically (flags override it). Settings are tuned one at a time (in the
+# order below) keeping the best value found so far for the others.
+#
+# e.g. python autotune.py -s 40 -- -cm ResNet50 -b 32 -uiw
+
+n_cores = cpu_count()
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-s', '--steps', type=int, default=40, help='Training steps per trial (including warmup)')
+parser.add_argument('-w', '--warmup', type=int, default=10, help='Steps not timed in each trial')
+parser.add_argument('--workers', nargs='+', type=int, default=sorted({n_cores - 1, 3 * n_cores // 4, n_cores // 2}, reverse=True), help='gen() worker processes to try')
+parser.add_argument('--intra-op-threads', nargs='+', type=int, default=sorted({0, n_cores // 2, n_cores}), help='TensorFlow intra op threads to try (0 is TensorFlow default)')
+parser.add_argument('--inter-op-threads', nargs='+', type=int, default=[0, 2], help='TensorFlow inter op threads to try (0 is TensorFlow default)')
+parser.add_argument('--worker-threads', nargs='+', type=int, default=[0, 1], help='OpenCV threads in workers to try (0 is OpenCV default)')
+parser.add_argument('--pin-cores', nargs='+', type=int, default=[0, 1], help='Pin workers and TensorFlow to separate cores (0/1) to try')
+parser.add_argument('-t', '--timeout', type=float, default=1800., help='Seconds before a trial is considered failed')
+parser.add_argument('-o', '--output', default=profile_path(), help='Where to save the profile')
+parser.add_argument('train_args', nargs=argparse.REMAINDER, help='train.py arguments (after --)')
+args = parser.parse_args()
+
+train_args = [arg for arg in args.train_args if arg != '--']
+
+def trial_flags(config):
+    flags = [ ]
+    for key, flag in SETTINGS.items():
+        if key == 'pin_cores':
+            flags.append('--pin-cores' if config[key] else '--no-pin-cores')
+        else:
+            flags.extend([flag, str(config[key])])
+    return flags
+
+def run_trial(config):
+    command = [sys.executable, 'train.py'] + train_args + trial_flags(config) + \
+        ['--benchmark-steps', str(args.steps), '--benchmark-warmup', str(args.warmup), '--no-tuning-profile']
+    start = time.time()
+    try:
+        output = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True, timeout=args.timeout).stdout
+    except subprocess.TimeoutExpired:
+        output = ''
+    images_per_second = 0.
+    for line in output.splitlines():
+        if line.startswith('BENCHMARK '):
+            images_per_second = json.loads(line[len('BENCHMARK '):])['images_per_second']
+    print("{} -> {:.1f} images/s ({:.0f}s)".format(
+        ' '.join('{}={}'.format(key, value) for key, value in config.items()), images_per_second, time.time() - start))
+    sys.stdout.flush()
+    return images_per_second
+
+grids = {
+    'workers'          : args.workers,
+    'intra_op_threads' : args.intra_op_threads,
+    'inter_op_threads' : args.inter_op_threads,
+    'worker_threads'   : args.worker_threads,
+    'pin_cores'        : args.pin_cores,
+}
+
+def config_key(config):
+    return tuple(sorted(config.items()))
+
+best = { key : grid[0] for key, grid in grids.items() }
+results = { }
+for key in SETTINGS:
+    scores = { }
+    for value in grids[key]:
+        config = dict(best, **{ key : value })
+        if config_key(config) not in results:
+            results[config_key(config)] = run_trial(config)
+        scores[value] = results[config_key(config)]
+    best[key] = max(scores, key=scores.get)
+
+best_key = config_key(best)
+if results[best_key] == 0.:
+    sys.exit("All trials failed, run train.py {} --benchmark-steps {} to see why".format(' '.join(train_args), args.steps))
+
+profile = dict(best)
+profile['pin_cores'] = bool(profile['pin_cores'])
+profile.update({
+    'images_per_second' : results[best_key],
+    'cpu_count'         : n_cores,
+    'train_args'        : train_args,
+    'date'              : time.strftime('%Y-%m-%d %H:%M:%S'),
+    'trials'            : [dict(dict(k), images_per_second=v) for k, v in results.items()],
+})
+save_profile(args.output, profile)
+print("Best: {} {:.1f} images/s, saved to {}".format(
+    ' '.join('{}={}'.format(key, best[key]) for key in SETTINGS), results[best_key], args.output))
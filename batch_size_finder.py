@@ -0,0 +1,115 @@
+import time
+
+import numpy as np
+from keras import backend as K
+
+MB = 1024. * 1024.
+
+def reset_peak_rss():
+    # Linux >= 4.0: resets VmHWM (peak resident memory) of the process
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+    except (IOError, OSError):
+        pass
+
+def peak_rss():
+    with open('/proc/self/status', 'r') as fp:
+        for line in fp:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def total_memory():
+    with open('/proc/meminfo', 'r') as fp:
+        for line in fp:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def candidate_batch_sizes(max_batch_size, multiple_of=1):
+    """8, 12, 16, 24, 32, 48, 64, 96... up to max_batch_size, multiples of `multiple_of`."""
+    sizes, size = [ ], 8
+    while size <= max_batch_size:
+        sizes.extend([size, size * 3 // 2])
+        size *= 2
+    return [size for size in sizes if size <= max_batch_size and size % multiple_of == 0]
+
+def find_batch_size(model, batch_sizes, train=True, make_targets=None, crop_size=None, memory_cap=None,
+                    steps=5, warmup=2, knee=0.95):
+    """Times forward+backward (`train`, with `model.train_on_batch`) or forward only
+    (`model.predict_on_batch`) steps of `model` on random inputs at increasing batch sizes,
+    stopping when peak resident memory exceeds `memory_cap` bytes (default 80% of the host
+    memory) or the backend runs out of memory. Prints images/s and peak memory per batch
+    size and returns the knee of the curve: the smallest batch size reaching `knee` of the
+    best throughput.
+
+    Weights and optimizer weights are restored after timing training steps (optimizer
+    weights created by the first step are reset to zeros, as all Keras optimizers start
+    from), so training can start afterwards.
+
+    # Arguments
+        model: compiled model (for `train`)
+        batch_sizes: increasing batch sizes to try
+        make_targets: function batch_size -> targets for train_on_batch (default zeros
+            shaped as the outputs with a loss)
+        crop_size: size of None input dimensions (models taking any crop size)
+        steps, warmup: timed and untimed steps per batch size
+        knee: fraction of the best throughput the recommended batch size must reach
+    """
+    memory_cap = memory_cap or 0.8 * total_memory()
+    if train:
+        weights = model.get_weights()
+        optimizer_weights = K.batch_get_value(model.optimizer.weights)
+
+    def inputs(batch_size):
+        return [np.random.rand(*((batch_size, ) + tuple(d if d is not None else crop_size for d in K.int_shape(x)[1:])))
+                .astype(np.float32) for x in model.inputs]
+
+    def targets(batch_size):
+        if make_targets is not None:
+            return make_targets(batch_size)
+        # outputs without a loss (e.g. predictions of -ssm) take no targets
+        outputs = getattr(model, '_feed_outputs', model.outputs)
+        return [np.zeros((batch_size, ) + tuple(K.int_shape(y)[1:]), dtype=np.float32) for y in outputs]
+
+    print("{:>6} {:>10} {:>10} {:>12}".format('batch', 'images/s', 'ms/step', 'peak MB'))
+    results = [ ]
+    for batch_size in batch_sizes:
+        reset_peak_rss()
+        try:
+            x = inputs(batch_size)
+            y = targets(batch_size) if train else None
+            for step in range(warmup + steps):
+                if step == warmup:
+                    start = time.time()
+                if train:
+                    model.train_on_batch(x, y)
+                else:
+                    model.predict_on_batch(x)
+            elapsed = (time.time() - start) / steps
+        except Exception as e:
+            # e.g. tf.errors.ResourceExhaustedError
+            print("{:6} failed: {}".format(batch_size, str(e).splitlines()[0] if str(e) else type(e).__name__))
+            break
+        peak = peak_rss()
+        results.append((batch_size, batch_size / elapsed))
+        print("{:6} {:10.1f} {:10.1f} {:12.0f}".format(batch_size, batch_size / elapsed, 1000. * elapsed, peak / MB))
+        if peak > memory_cap:
+            print("Peak memory above {:.0f} MB, stopping".format(memory_cap / MB))
+            break
+
+    if train:
+        model.set_weights(weights)
+        if optimizer_weights:
+            model.optimizer.set_weights(optimizer_weights)
+        else:
+            K.batch_set_value([(w, np.zeros(K.int_shape(w))) for w in model.optimizer.weights])
+
+    if not results:
+        return None
+    best = max(images_per_second for _, images_per_second in results)
+    recommended = next(batch_size for batch_size, images_per_second in results if images_per_second >= knee * best)
+    print("Best {:.1f} images/s, recommended batch size {} ({:.0f}% of best)".format(
+        best, recommended, 100. * dict(results)[recommended] / best))
+    return recommended
@@ -1,4 +1,5 @@
 from keras.callbacks import *
+from collections import deque
 
 class CyclicLR(Callback):
     """This callback implements a cyclical learning rate policy (CLR).
@@ -57,10 +58,15 @@ class CyclicLR(Callback):
             Defines whether scale_fn is evaluated on 
             cycle number or cycle iterations (training
             iterations since start of cycle). Default is 'cycle'.
+        batches_per_update: number of batches per optimizer update,
+            e.g. when accumulating gradients (see AccumulateGradients).
+            Iterations (and step_size) count updates, not batches.
+        history_size: number of recent updates kept in `history`
+            (use MetricsLogger of metrics_log for the whole run).
     """
 
     def __init__(self, base_lr=0.001, max_lr=0.006, step_size=2000., mode='triangular',
-                 gamma=1., scale_fn=None, scale_mode='cycle'):
+                 gamma=1., scale_fn=None, scale_mode='cycle', batches_per_update=1, history_size=10000):
         super(CyclicLR, self).__init__()
 
         self.base_lr = base_lr
@@ -81,8 +87,11 @@ class CyclicLR(Callback):
         else:
             self.scale_fn = scale_fn
             self.scale_mode = scale_mode
+        self.batches_per_update = batches_per_update
+        self.batches = 0
         self.clr_iterations = 0.
         self.trn_iterations = 0.
+        self.history_size = history_size
         self.history = {}
 
         self._reset()
@@ -119,16 +128,98 @@ class CyclicLR(Callback):
     def on_batch_end(self, epoch, logs=None):
         
         logs = logs or {}
+        self.batches += 1
+        if self.batches % self.batches_per_update != 0:
+            return
         self.trn_iterations += 1
         self.clr_iterations += 1
         K.set_value(self.model.optimizer.lr, self.clr())
 
-        self.history.setdefault('lr', []).append(K.get_value(self.model.optimizer.lr))
-        self.history.setdefault('iterations', []).append(self.trn_iterations)
+        self.history.setdefault('lr', deque(maxlen=self.history_size)).append(K.get_value(self.model.optimizer.lr))
+        self.history.setdefault('iterations', deque(maxlen=self.history_size)).append(self.trn_iterations)
 
         for k, v in logs.items():
-            self.history.setdefault(k, []).append(v)
+            self.history.setdefault(k, deque(maxlen=self.history_size)).append(v)
             
             
 
   
+
+class LRRangeTest(CyclicLR):
+    """Learning rate range test (section 3.3 of https://arxiv.org/abs/1506.01186): increases
+    the learning rate from `min_lr` to `max_lr` over `num_updates` optimizer updates,
+    linearly or exponentially, recording the (exponentially smoothed, bias corrected) loss
+    at each learning rate. Stops training when the loss diverges.
+
+    `suggest()` returns (base_lr, max_lr) for CyclicLR: max_lr where the smoothed loss
+    stops decreasing (its minimum), base_lr a quarter of it as suggested in the paper,
+    and the learning rate of the steepest loss decrease, a good constant learning rate.
+
+    # Example
+        ```python
+            range_test = LRRangeTest(min_lr=1e-7, max_lr=1., num_updates=200)
+            model.fit_generator(gen, steps_per_epoch=200, epochs=1, callbacks=[range_test])
+            base_lr, max_lr, steepest_lr = range_test.suggest()
+        ```
+
+    # Arguments
+        min_lr, max_lr: learning rates the sweep starts and ends at
+        num_updates: number of optimizer updates of the sweep
+        mode: one of {exp, linear}
+        beta: loss smoothing factor
+        diverge: stop when the smoothed loss is above `diverge` x its minimum
+        monitor: log to record
+        batches_per_update: as in CyclicLR
+    """
+
+    def __init__(self, min_lr=1e-7, max_lr=1., num_updates=200, mode='exp', beta=0.98, diverge=4.,
+                 monitor='loss', batches_per_update=1):
+        assert mode in ('exp', 'linear')
+        super(LRRangeTest, self).__init__(base_lr=min_lr, max_lr=max_lr, step_size=num_updates,
+                                          batches_per_update=batches_per_update)
+        self.sweep_mode = mode
+        self.beta       = beta
+        self.diverge    = diverge
+        self.monitor    = monitor
+        self.lrs        = [ ]
+        self.losses     = [ ]
+        self.update_loss = 0.
+        self.avg_loss   = 0.
+        self.best_loss  = np.Inf
+
+    def clr(self):
+        x = min(self.clr_iterations / self.step_size, 1.)
+        if self.sweep_mode == 'exp':
+            return self.base_lr * (self.max_lr / self.base_lr) ** x
+        return self.base_lr + (self.max_lr - self.base_lr) * x
+
+    def on_batch_end(self, epoch, logs=None):
+        logs = logs or {}
+        self.update_loss += logs.get(self.monitor, np.nan)
+        if (self.batches + 1) % self.batches_per_update == 0:
+            # last batch of an update, trained with the learning rate set before it
+            loss = self.update_loss / self.batches_per_update
+            self.update_loss = 0.
+            self.avg_loss = self.beta * self.avg_loss + (1 - self.beta) * loss
+            smoothed = self.avg_loss / (1 - self.beta ** (len(self.losses) + 1))
+            self.lrs.append(float(K.get_value(self.model.optimizer.lr)))
+            self.losses.append(smoothed)
+            self.best_loss = min(self.best_loss, smoothed)
+            if not np.isfinite(smoothed) or smoothed > self.diverge * self.best_loss:
+                print("\nLoss diverged at learning rate {:.2e}, stopping".format(self.lrs[-1]))
+                self.model.stop_training = True
+        super(LRRangeTest, self).on_batch_end(epoch, logs)
+
+    def suggest(self, skip=5):
+        """Returns (base_lr, max_lr, steepest_lr), ignoring the first `skip` updates
+        (the smoothed loss is noisy there)."""
+        lrs, losses = np.array(self.lrs[skip:]), np.array(self.losses[skip:])
+        finite = np.isfinite(losses)
+        lrs, losses = lrs[finite], losses[finite]
+        if len(losses) < 2:
+            return None
+        best = int(np.argmin(losses))
+        x = np.log(lrs) if self.sweep_mode == 'exp' else lrs
+        slopes = np.gradient(losses[:best + 1], x[:best + 1]) if best > 0 else np.zeros(1)
+        max_lr = lrs[best]
+        return max_lr / 4., max_lr, lrs[int(np.argmin(slopes))]
@@ -0,0 +1,46 @@
+import json
+import os
+import socket
+from multiprocessing import cpu_count
+
+# settings of a tuning profile, with the train.py flags that set them (and override the profile)
+SETTINGS = {
+    'workers'          : '--workers',
+    'intra_op_threads' : '--intra-op-threads',
+    'inter_op_threads' : '--inter-op-threads',
+    'worker_threads'   : '--worker-threads',
+    'pin_cores'        : '--pin-cores',
+}
+
+def profile_path(directory='tuning'):
+    """Path of the tuning profile of this host, e.g. tuning/cpu-myhost.json"""
+    return os.path.join(directory, 'cpu-{}.json'.format(socket.gethostname()))
+
+def load_profile(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as fp:
+        return json.load(fp)
+
+def save_profile(path, profile):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(profile, fp, indent=2)
+    os.replace(path + '.tmp', path)
+
+def split_cores(workers):
+    """Returns (main process cores, worker cores): workers get the last `workers` cores
+    (leaving at least one), the main process (TensorFlow) the rest."""
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(cpu_count()))
+    n_worker_cores = max(1, min(workers, len(cores) - 1))
+    return cores[:len(cores) - n_worker_cores], cores[len(cores) - n_worker_cores:]
+
+def configure_worker(cores=None, threads=None):
+    """Pins the calling process to `cores` and limits OpenCV threads (0 or None keeps the defaults)."""
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    if threads:
+        import cv2
+        cv2.setNumThreads(threads)
@@ -0,0 +1,110 @@
+from keras import backend as K
+from keras.engine.topology import Layer
+from keras.layers import Dense
+from keras import activations
+import numpy as np
+
+from hadamard import HadamardClassifier
+
+class ExpandedDense(Layer):
+    """Dense layer of `units` outputs whose first `old_units` (e.g. the classes of a trained
+    `logits` layer, see `expand_layer`) have a kernel and bias of their own, trained only
+    with `train_old`, so new outputs can be trained without changing the old ones:
+
+        output = concatenate([x . old_kernel + old_bias, x . new_kernel + new_bias])
+
+    Weights are always [old_kernel, old_bias, new_kernel, new_bias] whichever are trainable.
+    Changing `train_old` needs the model to be compiled again.
+    """
+
+    def __init__(self, units, old_units, activation=None, train_old=False, **kwargs):
+        self.units      = units
+        self.old_units  = old_units
+        self.activation = activations.get(activation)
+        self.train_old  = train_old
+
+        super(ExpandedDense, self).__init__(**kwargs)
+
+    def build(self, input_shape):
+        self.old_kernel = self.add_weight(name='old_kernel',
+                                          shape=(input_shape[-1], self.old_units),
+                                          initializer='glorot_uniform')
+        self.old_bias   = self.add_weight(name='old_bias',
+                                          shape=(self.old_units,),
+                                          initializer='zeros')
+        self.new_kernel = self.add_weight(name='new_kernel',
+                                          shape=(input_shape[-1], self.units - self.old_units),
+                                          initializer='glorot_uniform')
+        self.new_bias   = self.add_weight(name='new_bias',
+                                          shape=(self.units - self.old_units,),
+                                          initializer='zeros')
+
+        super(ExpandedDense, self).build(input_shape)
+
+    @property
+    def weights(self):
+        return [self.old_kernel, self.old_bias, self.new_kernel, self.new_bias] if self.built else []
+
+    @property
+    def trainable_weights(self):
+        if not self.trainable or not self.built:
+            return []
+        return ([self.old_kernel, self.old_bias] if self.train_old else []) + [self.new_kernel, self.new_bias]
+
+    @property
+    def non_trainable_weights(self):
+        if not self.built:
+            return []
+        if not self.trainable:
+            return self.weights
+        return [] if self.train_old else [self.old_kernel, self.old_bias]
+
+    def call(self, x):
+        output = K.concatenate([
+            K.bias_add(K.dot(x, self.old_kernel), self.old_bias),
+            K.bias_add(K.dot(x, self.new_kernel), self.new_bias)], axis=-1)
+        if self.activation is not None:
+            output = self.activation(output)
+        return output
+
+    def compute_output_shape(self, input_shape):
+        return tuple(input_shape[:-1]) + (self.units,)
+
+    def get_config(self):
+        config = {
+            'units': self.units,
+            'old_units': self.old_units,
+            'activation': activations.serialize(self.activation),
+            'train_old': self.train_old,
+        }
+        base_config = super(ExpandedDense, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+def expand_layer(layer, units):
+    """Returns (layer with `units` outputs, its weights, outputs of `layer`) for a trained
+    Dense, ExpandedDense (its old and new outputs become old ones) or HadamardClassifier
+    `layer`, keeping the weights of its outputs. New Dense outputs get kernels of the
+    scale of the old ones and the mean old bias. HadamardClassifier outputs are a fixed
+    transform (the first columns of a larger Hadamard matrix are those of the smaller
+    one), new outputs only get a bias (none with use_bias=False)."""
+    weights = layer.get_weights()
+    if isinstance(layer, HadamardClassifier):
+        old_units = layer.output_dim
+        config = layer.get_config()
+        config['output_dim'] = units
+        if layer.use_bias:
+            scale, bias = weights
+            weights = [scale, np.concatenate([bias, np.full(units - old_units, np.mean(bias), dtype=bias.dtype)])]
+        return HadamardClassifier.from_config(config), weights, old_units
+
+    if isinstance(layer, ExpandedDense):
+        kernel = np.concatenate([weights[0], weights[2]], axis=-1)
+        bias   = np.concatenate([weights[1], weights[3]])
+    else:
+        assert isinstance(layer, Dense) and layer.use_bias, "only Dense (with bias), ExpandedDense or HadamardClassifier layers can be expanded"
+        kernel, bias = weights
+    old_units = kernel.shape[-1]
+    new_kernel = np.random.normal(0., np.std(kernel), size=(kernel.shape[0], units - old_units)).astype(kernel.dtype)
+    new_bias   = np.full(units - old_units, np.mean(bias), dtype=bias.dtype)
+    expanded = ExpandedDense(units, old_units, activation=activations.serialize(layer.activation), name=layer.name)
+    return expanded, [kernel, bias, new_kernel, new_bias], old_units
@@ -0,0 +1,138 @@
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+from keras.models import load_model
+from keras.utils import CustomObjectScope
+from kerassurgeon.operations import replace_layer
+from sklearn.utils.extmath import randomized_svd
+
+from hadamard import HadamardClassifier
+from low_rank import LowRankDense, factorize
+
+# Replaces the `logits` Dense layer of a trained model with a rank-r factorization (LowRankDense)
+# chosen by SVD energy, reporting accuracy, size and latency vs rank. Accuracy is measured on the
+# inputs of `logits` computed with `train.py -m <model> --knn --knn-logits-input -tt` (one <landmark>.npy
+# per landmark in features/<model>-logits-input). The written model loads with train.py -m (e.g. to
+# fine-tune briefly: python train.py -m <written model> -l 1e-5 --max-epoch <n>)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-m', '--model', required=True, help='hdf5 model with a Dense logits layer')
+parser.add_argument('-r', '--ranks', nargs='+', type=int, default=[], help='Ranks to evaluate, e.g. -r 256 512 1024')
+parser.add_argument('-e', '--energy', nargs='+', type=float, default=[0.8, 0.9, 0.95, 0.99], help='Evaluate smallest ranks keeping this fraction of SVD energy, e.g. -e 0.9 0.95')
+parser.add_argument('-mr', '--max-rank', type=int, default=2048, help='Singular values to compute with randomized SVD (0 for exact SVD)')
+parser.add_argument('-f', '--features-dir', default=None, help='Dir of <landmark>.npy inputs of logits to evaluate accuracy, computed with train.py -m <model> --knn --knn-logits-input -tt, e.g. features/<model>-logits-input')
+parser.add_argument('-n', '--max-features', type=int, default=20000, help='Max number of features to evaluate on')
+parser.add_argument('-b', '--batch-size', type=int, default=48, help='Batch size to measure latency')
+parser.add_argument('-s', '--save-rank', type=int, default=None, help='Write model factorized with this rank, e.g. -s 512')
+parser.add_argument('-se', '--save-energy', type=float, default=None, help='Write model factorized with smallest rank keeping this fraction of energy, e.g. -se 0.95')
+args = parser.parse_args()
+
+SEED = 42
+np.random.seed(SEED)
+
+with CustomObjectScope({
+    'HadamardClassifier' : HadamardClassifier,
+    'LowRankDense'       : LowRankDense}):
+    model = load_model(args.model, compile=False)
+
+logits = model.get_layer('logits')
+assert hasattr(logits, 'kernel'), "logits layer must be a Dense layer"
+weights = logits.get_weights()
+kernel  = weights[0]
+bias    = weights[1] if logits.use_bias else np.zeros(kernel.shape[1], dtype=np.float32)
+input_dim, units = kernel.shape
+print("logits {}x{}: {:.1f}M parameters".format(input_dim, units, kernel.size / 1e6))
+
+start = time.time()
+total_energy = np.sum(np.square(kernel, dtype=np.float64))
+if args.max_rank == 0 or args.max_rank >= min(kernel.shape):
+    svd = np.linalg.svd(kernel, full_matrices=False)
+else:
+    svd = randomized_svd(kernel, n_components=args.max_rank, n_iter=4, random_state=SEED)
+energy = np.cumsum(np.square(svd[1], dtype=np.float64)) / total_energy
+print("SVD with {} components in {:.1f}s keeps {:.4f} of energy".format(len(svd[1]), time.time() - start, energy[-1]))
+
+def rank_for_energy(fraction):
+    rank = int(np.searchsorted(energy, fraction)) + 1
+    if rank > len(energy):
+        print("Warning: {} of energy needs more than {} components, increase -mr".format(fraction, len(energy)))
+        rank = len(energy)
+    return rank
+
+ranks = set(r for r in args.ranks if r <= len(energy))
+ranks.update(rank_for_energy(fraction) for fraction in args.energy)
+ranks = sorted(ranks)
+
+X = labels = None
+if args.features_dir:
+    files = sorted(glob.glob(os.path.join(args.features_dir, '*.npy')))
+    features, labels = [], []
+    for file_name in files:
+        f = np.load(file_name)
+        features.append(f)
+        labels.extend([int(os.path.splitext(os.path.basename(file_name))[0])] * len(f))
+    X, labels = np.concatenate(features).astype(np.float32), np.array(labels)
+    assert X.shape[1] == input_dim, "features have {} dimensions, logits expect {} (compute them with --knn-logits-input)".format(X.shape[1], input_dim)
+    if len(X) > args.max_features:
+        subset = np.random.choice(len(X), args.max_features, replace=False)
+        X, labels = X[subset], labels[subset]
+    print("Evaluating on {} features of {} landmarks".format(len(X), len(files)))
+
+def latency(f):
+    x = np.random.randn(args.batch_size, input_dim).astype(np.float32)
+    f(x)
+    timings = []
+    for _ in range(10):
+        start = time.time()
+        f(x)
+        timings.append(time.time() - start)
+    return 1000. * np.median(timings)
+
+def predict_in_batches(f):
+    return np.concatenate([np.argmax(f(X[i:i+1024]), axis=1) for i in range(0, len(X), 1024)])
+
+full_f = lambda x: x.dot(kernel) + bias
+full_latency = latency(full_f)
+if X is not None:
+    full_predictions = predict_in_batches(full_f)
+    full_accuracy = np.mean(full_predictions == labels)
+
+print("{:>6} {:>8} {:>10} {:>9} {:>11} {:>9} {:>10}".format(
+    'rank', 'energy', 'params M', 'size MB', 'latency ms', 'accuracy', 'agreement'))
+print("{:>6} {:8.4f} {:10.2f} {:9.1f} {:11.2f} {:>9} {:>10}".format(
+    'full', 1., kernel.size / 1e6, kernel.nbytes / 2**20, full_latency,
+    '{:.4f}'.format(full_accuracy) if X is not None else '-', '-'))
+
+for rank in ranks:
+    u, v = factorize(kernel, rank, svd)
+    f = lambda x: x.dot(u).dot(v) + bias
+    if X is not None:
+        predictions = predict_in_batches(f)
+        accuracy  = '{:.4f}'.format(np.mean(predictions == labels))
+        agreement = '{:.4f}'.format(np.mean(predictions == full_predictions))
+    else:
+        accuracy = agreement = '-'
+    print("{:6} {:8.4f} {:10.2f} {:9.1f} {:11.2f} {:>9} {:>10}".format(
+        rank, energy[rank - 1], (u.size + v.size) / 1e6, (u.nbytes + v.nbytes) / 2**20, latency(f), accuracy, agreement))
+
+save_rank = args.save_rank if args.save_rank is not None else \
+    rank_for_energy(args.save_energy) if args.save_energy is not None else None
+
+if save_rank is not None:
+    u, v = factorize(kernel, save_rank, svd)
+    low_rank_logits = LowRankDense(units, save_rank, activation=logits.activation, use_bias=logits.use_bias, name='logits')
+    factorized_model = replace_layer(model, logits, low_rank_logits)
+    factorized_model.get_layer('logits').set_weights([u, v] + ([bias] if logits.use_bias else []))
+
+    # keep -epochNNN last so train.py -m parses the model name and epoch as usual
+    basename = os.path.splitext(args.model)[0]
+    if '-epoch' in basename:
+        prefix, suffix = basename.split('-epoch', 1)
+        filename = '{}-lr{}-epoch{}.hdf5'.format(prefix, save_rank, suffix)
+    else:
+        filename = '{}-lr{}.hdf5'.format(basename, save_rank)
+    factorized_model.save(filename)
+    print("Saved model with rank {} logits to {} ({:.1f} MB)".format(save_rank, filename, os.path.getsize(filename) / 2**20))
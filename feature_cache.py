@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+from keras.callbacks import Callback
+
+def weights_key(model, *extra):
+    """Returns a hex digest of the weights (values and shapes) of `model` and of `extra`
+    (e.g. classifier name, crop size, pooling) identifying the features it computes."""
+    h = hashlib.sha1()
+    for weights in model.get_weights():
+        h.update(str(weights.shape).encode())
+        h.update(np.ascontiguousarray(weights).tobytes())
+    h.update(repr(extra).encode())
+    return h.hexdigest()[:16]
+
+def copy_weights_by_name(src_model, dst_model):
+    """Copies weights of the layers of `src_model` into the layers with the same name in `dst_model`."""
+    for layer in src_model.layers:
+        if layer.weights:
+            try:
+                dst_layer = dst_model.get_layer(layer.name)
+            except ValueError:
+                continue
+            dst_layer.set_weights(layer.get_weights())
+
+class FeatureCache(object):
+    """Memory-mapped store of features computed by a frozen classifier (backbone) for a
+    list of items, so a head can be trained on them without running the backbone
+    every epoch.
+
+    Every item has `1 + augmentations` rows: row 0 holds the features of the (resized)
+    image and rows 1.. the features of fixed augmentations of it. Status of an item is
+    0 (not computed yet), 1 (computed) or -1 (image could not be loaded), so an
+    interrupted computation resumes where it stopped.
+
+    The directory should be unique to the backbone weights and preprocessing (see
+    `weights_key`); if the items, features shape or augmentations differ from the ones
+    stored in it, the store is recreated.
+
+    # Arguments
+        directory: where to store features.npy, status.npy and items.json
+        items: list of items (image paths)
+        feature_shape: shape of the features of one image, e.g. (2048,)
+        augmentations: number of fixed augmentations per item
+    """
+
+    def __init__(self, directory, items, feature_shape, augmentations=0):
+        self.directory     = directory
+        self.items         = [str(item) for item in items]
+        self.feature_shape = tuple(feature_shape)
+        self.rows_per_item = 1 + augmentations
+        self.index         = { item : i for i, item in enumerate(self.items) }
+
+        os.makedirs(directory, exist_ok=True)
+        features_path = os.path.join(directory, 'features.npy')
+        status_path   = os.path.join(directory, 'status.npy')
+        meta_path     = os.path.join(directory, 'items.json')
+        meta = {
+            'items'         : self.items,
+            'feature_shape' : list(self.feature_shape),
+            'augmentations' : augmentations,
+        }
+
+        reuse = False
+        if os.path.exists(meta_path) and os.path.exists(features_path) and os.path.exists(status_path):
+            with open(meta_path, 'r') as fp:
+                reuse = json.load(fp) == meta
+
+        shape = (len(self.items) * self.rows_per_item, ) + self.feature_shape
+        if reuse:
+            self.features = np.lib.format.open_memmap(features_path, mode='r+')
+            self.status   = np.lib.format.open_memmap(status_path,   mode='r+')
+        else:
+            self.features = np.lib.format.open_memmap(features_path, mode='w+', dtype=np.float32, shape=shape)
+            self.status   = np.lib.format.open_memmap(status_path,   mode='w+', dtype=np.int8, shape=(len(self.items),))
+            with open(meta_path, 'w') as fp:
+                json.dump(meta, fp)
+
+        print("Feature cache {}: {}/{} items computed ({} could not be loaded)".format(
+            directory, int(np.sum(self.status != 0)), len(self.items), int(np.sum(self.status == -1))))
+
+    def row(self, item, augmentation=0):
+        return self.index[str(item)] * self.rows_per_item + augmentation
+
+    def missing(self):
+        return [item for item, status in zip(self.items, self.status) if status == 0]
+
+    def is_good(self, item):
+        return self.status[self.index[str(item)]] == 1
+
+    def good_items(self, items):
+        return [item for item in map(str, items) if self.is_good(item)]
+
+    def write(self, items, augmentation, features):
+        for item, feature in zip(items, features):
+            self.features[self.row(item, augmentation)] = feature
+
+    def set_status(self, items, status):
+        for item in items:
+            self.status[self.index[str(item)]] = status
+
+    def flush(self):
+        self.features.flush()
+        self.status.flush()
+
+class HeadModelCheckpoint(Callback):
+    """Wraps a ModelCheckpoint when training a head model on cached features: before the
+    checkpoint runs, the head weights are copied (by layer name) into the full model
+    (classifier + head), which is the model the checkpoint saves.
+    """
+
+    def __init__(self, checkpoint, full_model, head_model):
+        super(HeadModelCheckpoint, self).__init__()
+        self.checkpoint = checkpoint
+        self.full_model = full_model
+        self.head_model = head_model
+
+    def set_model(self, model):
+        super(HeadModelCheckpoint, self).set_model(model)
+        self.checkpoint.set_model(self.full_model)
+
+    def on_epoch_end(self, epoch, logs=None):
+        copy_weights_by_name(self.head_model, self.full_model)
+        self.checkpoint.on_epoch_end(epoch, logs)
@@ -0,0 +1,97 @@
+import re
+
+from keras import backend as K
+from keras.models import Model
+
+STRATEGIES = ('memory', 'speed')
+
+def layer_names(model):
+    """Names of the layers of `model` and of models nested in it (not of the nested models)."""
+    names = [ ]
+    for layer in model.layers:
+        if isinstance(layer, Model):
+            names.extend(layer_names(layer))
+        else:
+            names.append(layer.name)
+    return names
+
+def checkpoint_layers(model, pattern):
+    """Names of the layers of `model` (and of models nested in it) matching the regular expression `pattern`."""
+    return [name for name in layer_names(model) if re.search(pattern, name)]
+
+def _layer_scope(op_name, names):
+    # (name scope, layer name) of the innermost scope of `op_name` named after a layer: keras runs
+    # every call of a layer, nested models included, under a scope of its name (tensorflow appends
+    # _1, _2... to scopes used more than once)
+    scopes = op_name.split('/')[:-1]
+    for i in reversed(range(len(scopes))):
+        name = scopes[i] if scopes[i] in names else re.sub(r'_\d+$', '', scopes[i])
+        if name in names:
+            return '/'.join(scopes[:i + 1]), name
+    return None, None
+
+def checkpoint_tensors(loss, params, layers, names):
+    """Output tensors of the calls of `layers` (names, out of all layer `names`) that are in
+    the graph of `loss` between `params` and `loss`: tensors of ops in the scope of a call
+    consumed by ops out of it.
+
+    Looking them up in the graph of `loss`, instead of taking the output tensors of the
+    layers, finds the tensors of the call of a nested model (e.g. the classifier) in the
+    trained model, not those of its own graph, which the loss does not depend on.
+    """
+    from tensorflow.contrib import graph_editor as ge
+
+    learning_phase = K.learning_phase()
+    backward = ge.get_backward_walk_ops([loss.op], inclusive=True)
+    # activations (depending on the inputs) that gradients of params depend on, not weights
+    inputs = [op for op in backward if op.type == 'Placeholder' and not (hasattr(learning_phase, 'op') and op == learning_phase.op)]
+    between = set(backward) & set(ge.get_forward_walk_ops([p.op for p in params], inclusive=True)) & \
+        set(ge.get_forward_walk_ops(inputs, inclusive=True))
+
+    layers = set(layers)
+    tensors = [ ]
+    for op in between:
+        scope, name = _layer_scope(op.name, names)
+        if name not in layers:
+            continue
+        for tensor in op.outputs:
+            if any(consumer in between and _layer_scope(consumer.name, names)[0] != scope for consumer in tensor.consumers()):
+                tensors.append(tensor)
+    return tensors
+
+def checkpoint_gradients(optimizer, model, checkpoints):
+    """Makes `optimizer` compute gradients keeping only the `checkpoints` activations in
+    memory and recomputing the others in the backward pass, trading about one extra
+    forward pass for activation memory of O(sqrt(layers)) instead of O(layers).
+
+    # Arguments
+        optimizer: optimizer of `model`
+        model: model whose loss the optimizer minimizes
+        checkpoints: 'memory'/'speed' for the automatic selection, or a regular expression
+            of names of layers (of `model` or of models nested in it) whose outputs are kept
+
+    Needs memory_saving_gradients.py of https://github.com/cybertronai/gradient-checkpointing
+    in the python path.
+    """
+    try:
+        import memory_saving_gradients
+    except ImportError:
+        raise ImportError("gradient checkpointing needs memory_saving_gradients.py of "
+            "https://github.com/cybertronai/gradient-checkpointing in the python path")
+
+    if checkpoints not in STRATEGIES:
+        names  = set(layer_names(model))
+        layers = checkpoint_layers(model, checkpoints)
+        if not layers:
+            raise ValueError("No layer name matches {}".format(checkpoints))
+
+    def get_gradients(loss, params):
+        tensors = checkpoints
+        if checkpoints not in STRATEGIES:
+            tensors = checkpoint_tensors(loss, params, layers, names)
+            if not tensors:
+                raise ValueError("No output of layers matching {} is between trainable weights and the loss".format(checkpoints))
+        return memory_saving_gradients.gradients(loss, params, checkpoints=tensors)
+
+    optimizer.get_gradients = get_gradients
+    return optimizer
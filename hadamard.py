@@ -10,23 +10,36 @@ import numpy as np
 from scipy.linalg import hadamard
 import math
 
+def fwht(x, n):
+    """Fast Walsh-Hadamard transform of the last axis of x (2D tensor, size n, a power of 2),
+    i.e. K.dot(x, hadamard(n)) in O(n log n) without materializing the matrix."""
+    # each pass applies the 2x2 hadamard to the lowest bit of the index and moves the result to
+    # the highest bit, after log2(n) passes every bit was transformed and is back in place
+    for _ in range(int(math.log(n, 2))):
+        x = K.reshape(x, (-1, n // 2, 2))
+        a, b = x[..., 0], x[..., 1]
+        x = K.concatenate([a + b, a - b], axis=-1)
+    return x
+
 class HadamardClassifier(Layer):
 
     def __init__(self, output_dim, activation=None, use_bias=True, 
-                 l2_normalize=True, output_raw_logits=False, **kwargs):
+                 l2_normalize=True, output_raw_logits=False, use_fwht=True, **kwargs):
         self.output_dim        = output_dim
         self.activation        = activations.get(activation)
         self.use_bias          = use_bias
         self.l2_normalize      = l2_normalize
         self.output_raw_logits = output_raw_logits
+        self.use_fwht          = use_fwht
 
         super(HadamardClassifier, self).__init__(**kwargs)
 
     def build(self, input_shape):
 
-        hadamard_size = 2 ** int(math.ceil(math.log(max(input_shape[1], self.output_dim), 2)))
-        self.hadamard = K.constant(
-            value=hadamard(hadamard_size, dtype=np.int8)[:input_shape[1], :self.output_dim])
+        self.hadamard_size = 2 ** int(math.ceil(math.log(max(input_shape[1], self.output_dim), 2)))
+        if not self.use_fwht:
+            self.hadamard = K.constant(
+                value=hadamard(self.hadamard_size, dtype=np.int8)[:input_shape[1], :self.output_dim])
 
         init_scale = 1. / math.sqrt(self.output_dim)
 
@@ -45,10 +58,22 @@ class HadamardClassifier(Layer):
 
     def call(self, x, training=None):
         is_training = training not in {0, False}
-        output = K.l2_normalize(x, axis=-1) if self.l2_normalize else x
-        output = -self.scale * K.dot(output, self.hadamard) # pity .dot requires both tensors to be same type, the last one could be int8
+        if self.use_fwht:
+            # zero padding x to hadamard_size keeps the first output_dim outputs of the transform
+            input_dim = K.int_shape(x)[-1]
+            padded = x
+            if input_dim < self.hadamard_size:
+                padded = K.concatenate([x, K.tile(K.zeros_like(x[:, :1]), (1, self.hadamard_size - input_dim))], axis=-1)
+            logits = -self.scale * fwht(padded, self.hadamard_size)[:, :self.output_dim]
+        else:
+            logits = -self.scale * K.dot(x, self.hadamard) # pity .dot requires both tensors to be same type, the last one could be int8
+        # the transform is linear so the logits of the l2 normalized x are the raw logits / |x|
+        if self.l2_normalize:
+            output = logits / K.sqrt(K.maximum(K.sum(K.square(x), axis=-1, keepdims=True), 1e-12))
+        else:
+            output = logits
         if self.output_raw_logits:
-            output_logits = -self.scale * K.dot(x, self.hadamard) # probably better to reuse output * l2norm
+            output_logits = logits
         if self.use_bias:
             output = K.bias_add(output, self.bias)
             if self.output_raw_logits:
@@ -71,6 +96,40 @@ class HadamardClassifier(Layer):
             'use_bias': self.use_bias,
             'l2_normalize': self.l2_normalize,
             'output_raw_logits' : self.output_raw_logits,
+            'use_fwht': self.use_fwht,
         }
         base_config = super(HadamardClassifier, self).get_config()
-        return dict(list(base_config.items()) + list(config.items()))
\ No newline at end of file
+        return dict(list(base_config.items()) + list(config.items()))
+
+if __name__ == '__main__':
+    # micro-benchmark of the dense matrix and the fast Walsh-Hadamard transform paths
+    import argparse
+    import time
+    from keras.layers import Input
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--batch-size', type=int, default=48, help='Batch size')
+    parser.add_argument('-i', '--input-dims', nargs='+', type=int, default=[512, 2048, 16384], help='Input sizes')
+    parser.add_argument('-o', '--output-dims', nargs='+', type=int, default=[1000, 14951], help='Output sizes (classes)')
+    parser.add_argument('-r', '--runs', type=int, default=20, help='Timed runs per configuration')
+    args = parser.parse_args()
+
+    print("{:>8} {:>8} {:>12} {:>12} {:>8} {:>10}".format('input', 'output', 'dense ms', 'fwht ms', 'speedup', 'max diff'))
+    for input_dim in args.input_dims:
+        for output_dim in args.output_dims:
+            x = np.random.randn(args.batch_size, input_dim).astype(np.float32)
+            timings, results = [], []
+            for use_fwht in [False, True]:
+                K.clear_session()
+                inputs = Input(shape=(input_dim,))
+                layer  = HadamardClassifier(output_dim, output_raw_logits=True, use_fwht=use_fwht)
+                f = K.function([inputs], layer(inputs))
+                layer.set_weights([np.ones((1,), dtype=np.float32), np.zeros((output_dim,), dtype=np.float32)])
+                results.append(f([x]))
+                start = time.time()
+                for _ in range(args.runs):
+                    f([x])
+                timings.append(1000. * (time.time() - start) / args.runs)
+            diff = max(np.max(np.abs(a - b)) for a, b in zip(*results))
+            print("{:8} {:8} {:12.2f} {:12.2f} {:7.1f}x {:10.2e}".format(
+                input_dim, output_dim, timings[0], timings[1], timings[0] / timings[1], diff))
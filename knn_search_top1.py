@@ -5,10 +5,21 @@ import math
 import numpy as np
 import tensorflow as tf
 from tqdm import tqdm
+from signal_profiler import SignalProfiler
+from metrics_server import Metrics
 
 FEATURES_NUMBER = 1000
 GPU = int(sys.argv[1])
 
+SignalProfiler('knn_search_top1').install()
+
+# optional 2nd argument: port to serve Prometheus metrics on
+metrics = Metrics(int(sys.argv[2]) if len(sys.argv) > 2 else None).serve()
+metrics.describe('knn_feature_files',              'gauge',   'Train feature files to search')
+metrics.describe('knn_feature_files_done_total',   'counter', 'Train feature files searched')
+metrics.describe('knn_queries_done_total',         'counter', 'Test features searched')
+metrics.describe('knn_queries_per_second',         'gauge',   'Test features searched per second (smoothed)')
+
 input_features = tf.placeholder(
     tf.float32, shape=[None, FEATURES_NUMBER], name="input_features")
 features_batch = tf.placeholder(
@@ -24,6 +35,8 @@ similarity = tf.reduce_sum(
 labels_filenames = sorted(glob.glob("db/train-labels*.npy"))
 features_filenames = sorted(glob.glob("db/train-features*.npy"))
 
+metrics.set('knn_feature_files', len(features_filenames))
+
 j = 0
 with tf.Session() as sess:
     for labels_filename, features_filename in zip(labels_filenames,
@@ -35,7 +48,7 @@ with tf.Session() as sess:
         data_labels = np.load(labels_filename)
         data_features = np.load(features_filename)[:, 0:FEATURES_NUMBER]
 
-        print features_filename
+        print(features_filename)
         tfh = open("bin/outdoor-test-features.csv.%s" % GPU, "r")
         for line in tqdm(tfh):
 
@@ -58,4 +71,7 @@ with tf.Session() as sess:
 
             results = sorted(results, key=lambda results: float(results[1]))[0]
             writer.writerow([input_label] + results)
+            metrics.inc('knn_queries_done_total')
+            metrics.rate('knn_queries_per_second', 1)
         ofh.close()
+        metrics.inc('knn_feature_files_done_total')
@@ -0,0 +1,121 @@
+import threading
+from collections import deque
+
+import numpy as np
+from keras import losses
+from keras.callbacks import Callback
+
+class LossAwareSampler(Callback):
+    """Samples training items in proportion to a moving average of their loss, so items
+    the model already gets right are decoded and trained on less often than hard ones.
+
+    Item i is drawn with probability p_i = floor / N + (1 - floor) * l_i / sum(l), l_i
+    being the exponential moving average of its per-sample loss (items not trained on yet
+    get the mean of the others), and is weighted by 1 / (N p_i) times its class weight so
+    the expected gradient is the one of uniform sampling. Probabilities are recomputed
+    every `chunk` draws.
+
+    The per-sample loss is fetched with each training step by wrapping the train function
+    of the model. The generator draws items with `sample`, gets the weight of the items it
+    puts in a batch with `weight` and calls `batch_yielded` with the items of every batch
+    it yields: the Keras enqueuer keeps batches in order, so the losses of a step are the
+    ones of the oldest batch yielded but not trained on yet.
+
+    # Arguments
+        items: list of training items
+        loss: loss of the output, name or function returning the per-sample loss
+        output_name: name of the output whose loss is tracked
+        decay: weight of the previous average in the moving average of the loss
+        floor: fraction of the probability spread uniformly over all items
+        class_weights: optional dict of class -> weight
+        get_class: function item -> class, needed with class_weights
+        chunk: number of items drawn with the same probabilities
+    """
+
+    def __init__(self, items, loss='categorical_crossentropy', output_name='predictions', decay=0.9, floor=0.2,
+                 class_weights=None, get_class=None, chunk=4096):
+        super(LossAwareSampler, self).__init__()
+        self.items       = list(items)
+        self.index       = { item : i for i, item in enumerate(self.items) }
+        self.loss        = losses.get(loss)
+        self.output_name = output_name
+        self.decay       = decay
+        self.floor       = floor
+        self.chunk       = chunk
+        self.item_class_weights = np.ones(len(self.items), dtype=np.float32)
+        if class_weights is not None:
+            self.item_class_weights[:] = [class_weights[get_class(item)] for item in self.items]
+
+        self.average_loss = np.zeros(len(self.items), dtype=np.float32)
+        self.trained      = np.zeros(len(self.items), dtype=bool)
+        self.lock         = threading.Lock()
+        self.drawn        = deque()
+        # weights of items drawn but not in a batch yet (an item may be drawn again meanwhile)
+        self.pending      = { }
+        self.yielded      = deque()
+        self.train_function = None
+
+    def probabilities(self):
+        with self.lock:
+            if not np.any(self.trained):
+                return np.full(len(self.items), 1. / len(self.items))
+            average_loss = np.where(self.trained, self.average_loss, np.mean(self.average_loss[self.trained]))
+        return self.floor / len(self.items) + (1. - self.floor) * average_loss / max(np.sum(average_loss), 1e-12)
+
+    def sample(self):
+        if not self.drawn:
+            p = self.probabilities()
+            cdf = np.cumsum(p)
+            drawn = np.minimum(np.searchsorted(cdf, np.random.rand(self.chunk) * cdf[-1]), len(self.items) - 1)
+            weights = self.item_class_weights[drawn] / (len(self.items) * p[drawn])
+            self.drawn.extend(zip(drawn, weights))
+        i, weight = self.drawn.popleft()
+        item = self.items[i]
+        self.pending.setdefault(item, deque()).append(weight)
+        return item
+
+    def weight(self, item):
+        weights = self.pending[item]
+        weight = weights.popleft()
+        if not weights:
+            del self.pending[item]
+        return weight
+
+    def discard(self, item):
+        self.weight(item)
+
+    def batch_yielded(self, items):
+        self.yielded.append(np.array([self.index[item] for item in items]))
+
+    def update(self, indices, sample_losses):
+        with self.lock:
+            trained = self.trained[indices]
+            self.average_loss[indices] = np.where(
+                trained, self.decay * self.average_loss[indices] + (1. - self.decay) * sample_losses, sample_losses)
+            self.trained[indices] = True
+
+    def on_train_begin(self, logs=None):
+        model = self.model
+        model._make_train_function()
+        # fit_generator may be called more than once with the same model
+        if model.train_function is self.train_function:
+            return
+        output_index = model.output_names.index(self.output_name)
+        function = model.train_function
+        function.outputs = function.outputs + [self.loss(model.targets[output_index], model.outputs[output_index])]
+
+        def train_function(inputs):
+            outputs = function(inputs)
+            self.update(self.yielded.popleft(), outputs[-1])
+            return outputs[:-1]
+
+        model.train_function = self.train_function = train_function
+
+    def on_epoch_end(self, epoch, logs=None):
+        p = self.probabilities()
+        with self.lock:
+            n_trained = np.sum(self.trained)
+        print("\nLoss-aware sampling: {:.1f}% items trained on, probability max/min {:.1f}, "
+            "expected distinct items per epoch {:.1f}%".format(
+                100. * n_trained / len(self.items), np.max(p) / np.min(p),
+                100. * np.mean(1. - np.exp(-len(self.items) * p))))
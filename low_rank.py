@@ -0,0 +1,65 @@
+from keras import backend as K
+from keras.engine.topology import Layer
+from keras import activations
+import numpy as np
+
+class LowRankDense(Layer):
+    """Dense layer with a rank `rank` kernel factorized as `u` (input_dim x rank) times `v`
+    (rank x units), i.e. (input_dim + units) * rank parameters instead of input_dim * units.
+
+    Use `factorize` to initialize it from the kernel of a trained Dense layer.
+    """
+
+    def __init__(self, units, rank, activation=None, use_bias=True, **kwargs):
+        self.units      = units
+        self.rank       = rank
+        self.activation = activations.get(activation)
+        self.use_bias   = use_bias
+
+        super(LowRankDense, self).__init__(**kwargs)
+
+    def build(self, input_shape):
+        self.u = self.add_weight(name='u',
+                                 shape=(input_shape[-1], self.rank),
+                                 initializer='glorot_uniform',
+                                 trainable=True)
+        self.v = self.add_weight(name='v',
+                                 shape=(self.rank, self.units),
+                                 initializer='glorot_uniform',
+                                 trainable=True)
+        if self.use_bias:
+            self.bias = self.add_weight(name='bias',
+                                        shape=(self.units,),
+                                        initializer='zeros',
+                                        trainable=True)
+
+        super(LowRankDense, self).build(input_shape)
+
+    def call(self, x):
+        output = K.dot(K.dot(x, self.u), self.v)
+        if self.use_bias:
+            output = K.bias_add(output, self.bias)
+        if self.activation is not None:
+            output = self.activation(output)
+        return output
+
+    def compute_output_shape(self, input_shape):
+        return tuple(input_shape[:-1]) + (self.units,)
+
+    def get_config(self):
+        config = {
+            'units': self.units,
+            'rank': self.rank,
+            'activation': activations.serialize(self.activation),
+            'use_bias': self.use_bias,
+        }
+        base_config = super(LowRankDense, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+def factorize(kernel, rank, svd=None):
+    """Returns u, v such that u.dot(v) is the best rank `rank` approximation of kernel, the
+    singular values split evenly between both. `svd` is an optional precomputed (U, S, Vt)
+    with at least `rank` components."""
+    U, S, Vt = svd if svd is not None else np.linalg.svd(kernel, full_matrices=False)
+    sqrt_S = np.sqrt(S[:rank])
+    return (U[:, :rank] * sqrt_S).astype(np.float32), (sqrt_S[:, None] * Vt[:rank]).astype(np.float32)
@@ -0,0 +1,161 @@
+import os
+import sys
+from collections import deque
+
+from keras.callbacks import Callback
+
+MB = 1024. * 1024.
+
+def process_memory(pid='self'):
+    """Returns Rss, Pss, Uss and Swap (bytes) of a process from /proc/<pid>/smaps_rollup
+    (Linux >= 4.14) or /proc/<pid>/smaps. Uss is the memory private to the process, i.e.
+    what would be freed if it exited, Pss adds its proportional share of shared pages.
+    """
+    fields = { 'Rss' : 0, 'Pss' : 0, 'Private_Clean' : 0, 'Private_Dirty' : 0, 'Swap' : 0 }
+    path = '/proc/{}/smaps_rollup'.format(pid)
+    if not os.path.exists(path):
+        path = '/proc/{}/smaps'.format(pid)
+    with open(path, 'r') as fp:
+        for line in fp:
+            parts = line.split()
+            key = parts[0][:-1]
+            if key in fields and len(parts) == 3:
+                fields[key] += int(parts[1]) * 1024
+    return {
+        'rss'  : fields['Rss'],
+        'pss'  : fields['Pss'],
+        'uss'  : fields['Private_Clean'] + fields['Private_Dirty'],
+        'swap' : fields['Swap'],
+    }
+
+def rss_breakdown(pid='self'):
+    """Returns the Rss (bytes) of a process grouped by kind of mapping."""
+    breakdown = { 'heap/anonymous' : 0, 'shared anonymous' : 0, 'libraries' : 0, 'files' : 0, 'stack' : 0 }
+    kind = None
+    with open('/proc/{}/smaps'.format(pid), 'r') as fp:
+        for line in fp:
+            parts = line.split()
+            if '-' in parts[0] and not parts[0].endswith(':'):
+                # mapping header: address perms offset dev inode [pathname]
+                pathname = ' '.join(parts[5:])
+                shared = parts[1][3] == 's'
+                if pathname in ('', '[heap]') or pathname.startswith('[anon'):
+                    kind = 'shared anonymous' if shared else 'heap/anonymous'
+                elif pathname.startswith('/dev/zero') or pathname.startswith('/dev/shm') or pathname.startswith('/SYSV'):
+                    kind = 'shared anonymous'
+                elif pathname.startswith('[stack'):
+                    kind = 'stack'
+                elif '.so' in pathname:
+                    kind = 'libraries'
+                elif pathname.startswith('['):
+                    kind = 'heap/anonymous'
+                else:
+                    kind = 'files'
+            elif parts[0] == 'Rss:' and kind is not None:
+                breakdown[kind] += int(parts[1]) * 1024
+    return breakdown
+
+def deep_sizeof(obj, seen=None):
+    """Approximate size in bytes of a python object including the objects it references
+    (dicts, lists, tuples, sets and their contents). numpy arrays count their buffers."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if hasattr(obj, 'nbytes') and hasattr(obj, 'dtype'):
+        return size + (obj.nbytes if obj.base is None else 0)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(deep_sizeof(e, seen) for e in obj)
+    elif hasattr(obj, '__dict__'):
+        size += deep_sizeof(obj.__dict__, seen)
+    return size
+
+class MemoryReport(Callback):
+    """Prints a memory report at the start of training, after the first batch the generator
+    workers were running for and at the end of every epoch: Pss/Uss of the main process
+    and of every generator worker (per pid and totals), the Rss breakdown of the
+    main process, the bytes of the generator shared buffers, the size of (possibly
+    copy-on-write duplicated) python objects and a projected peak.
+
+    # Arguments
+        generators: dict of generator name -> dict with 'workers' (list of Process),
+            'buffers' (dict name -> numpy array) and 'queues' (dict name -> Queue), filled
+            in by the generators once they start
+        objects: dict of name -> python objects to account for, e.g. the label dicts
+        projected_workers: total number of generator workers the run is configured to use
+        projected_buffers: dict of name -> bytes of the buffers all generators will allocate
+        estimated_worker_bytes: estimated working set of a worker (decoding/augmenting an
+            image); until workers are running their private bytes are estimated as this plus
+            the python objects, as reading them touches refcounts and copies their pages
+    """
+
+    def __init__(self, generators, objects, projected_workers, projected_buffers, estimated_worker_bytes):
+        super(MemoryReport, self).__init__()
+        self.generators             = generators
+        self.objects                = objects
+        self.projected_workers      = projected_workers
+        self.projected_buffers      = projected_buffers
+        self.estimated_worker_bytes = estimated_worker_bytes
+        self.workers_reported       = False
+
+    def on_train_begin(self, logs=None):
+        self.report('startup')
+
+    def on_batch_end(self, batch, logs=None):
+        # workers start with the first batches, report their actual memory once
+        if not self.workers_reported and any(
+                w.is_alive() for generator in self.generators.values() for w in generator['workers']):
+            self.workers_reported = True
+            self.report('workers running')
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.report('epoch {}'.format(epoch + 1))
+
+    def report(self, when):
+        main = process_memory()
+        print("\nMemory report ({})".format(when))
+        print("  main process          pss {:9.1f} MB uss {:9.1f} MB rss {:9.1f} MB swap {:7.1f} MB".format(
+            main['pss'] / MB, main['uss'] / MB, main['rss'] / MB, main['swap'] / MB))
+        for kind, size in sorted(rss_breakdown().items()):
+            print("    rss {:18}    {:9.1f} MB".format(kind, size / MB))
+
+        objects_bytes = 0
+        for name, obj in sorted(self.objects.items()):
+            size = deep_sizeof(obj)
+            objects_bytes += size
+            print("    {:22}    {:9.1f} MB".format(name, size / MB))
+        print("    python objects total      {:9.1f} MB".format(objects_bytes / MB))
+
+        total_pss = main['pss']
+        total_uss = main['uss']
+        max_worker_uss = 0
+        for name, generator in sorted(self.generators.items()):
+            workers = [w for w in generator['workers'] if w.is_alive()]
+            usages  = [process_memory(w.pid) for w in workers]
+            pss     = sum(u['pss'] for u in usages)
+            uss     = sum(u['uss'] for u in usages)
+            total_pss += pss
+            total_uss += uss
+            if usages:
+                max_worker_uss = max(max_worker_uss, max(u['uss'] for u in usages))
+                print("  {:10} {:3} workers pss {:9.1f} MB uss {:9.1f} MB".format(name, len(workers), pss / MB, uss / MB))
+                for worker, usage in zip(workers, usages):
+                    print("    worker pid {:<8}       pss {:9.1f} MB uss {:9.1f} MB".format(
+                        worker.pid, usage['pss'] / MB, usage['uss'] / MB))
+            for buffer_name, buffer in sorted(generator['buffers'].items()):
+                if buffer is not None:
+                    print("    {:22}    {:9.1f} MB {}".format(buffer_name, buffer.nbytes / MB, buffer.shape))
+            for queue_name, queue in sorted(generator['queues'].items()):
+                print("    queue {:16}    {:5} items".format(queue_name, queue.qsize()))
+
+        worker_bytes = max_worker_uss if max_worker_uss else self.estimated_worker_bytes + objects_bytes
+        buffers_bytes = sum(self.projected_buffers.values())
+        projected = main['uss'] + self.projected_workers * worker_bytes + buffers_bytes
+        print("  total (main + workers) pss {:9.1f} MB uss {:9.1f} MB".format(total_pss / MB, total_uss / MB))
+        print("  projected peak {:9.1f} MB = main uss + {} workers x {:.1f} MB{} + {:.1f} MB buffers ({})".format(
+            projected / MB, self.projected_workers, worker_bytes / MB, '' if max_worker_uss else ' (estimated)',
+            buffers_bytes / MB, ', '.join('{} {:.1f} MB'.format(k, v / MB) for k, v in sorted(self.projected_buffers.items()))))
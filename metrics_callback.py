@@ -0,0 +1,39 @@
+from keras import backend as K
+from keras.callbacks import Callback
+
+from metrics_server import sanitize
+
+class MetricsCallback(Callback):
+    """Exports training progress to a Metrics server: images trained and images/sec,
+    current learning rate, loss/metrics of the last batch (not the epoch running average
+    the progress bar shows) and epoch end (validation) logs.
+    """
+
+    def __init__(self, metrics):
+        super(MetricsCallback, self).__init__()
+        self.metrics = metrics
+        metrics.describe('train_images_total',            'counter', 'Images trained on')
+        metrics.describe('train_images_per_second',       'gauge',   'Images trained on per second (smoothed)')
+        metrics.describe('train_steps_total',             'counter', 'Training steps')
+        metrics.describe('train_epoch',                   'gauge',   'Current epoch')
+        metrics.describe('train_learning_rate',           'gauge',   'Current learning rate')
+        metrics.describe('train_batch_metric',            'gauge',   'Loss and metrics of the last training batch')
+        metrics.describe('train_epoch_metric',            'gauge',   'Loss and metrics (including validation) of the last epoch')
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.metrics.set('train_epoch', epoch + 1)
+
+    def on_batch_end(self, batch, logs=None):
+        logs = logs or {}
+        size = logs.get('size', 0)
+        self.metrics.inc('train_images_total', size)
+        self.metrics.inc('train_steps_total')
+        self.metrics.rate('train_images_per_second', size)
+        self.metrics.set('train_learning_rate', float(K.get_value(self.model.optimizer.lr)))
+        for k, v in logs.items():
+            if k not in ('batch', 'size'):
+                self.metrics.set('train_batch_metric', float(v), labels={ 'name' : sanitize(k) })
+
+    def on_epoch_end(self, epoch, logs=None):
+        for k, v in (logs or {}).items():
+            self.metrics.set('train_epoch_metric', float(v), labels={ 'name' : sanitize(k) })
@@ -0,0 +1,151 @@
+import os
+
+import numpy as np
+from keras import backend as K
+from keras.callbacks import Callback
+
+# keras batch logs that are not metrics
+IGNORED_LOGS = ('batch', 'size')
+
+class MetricsLog(object):
+    """Append-only columnar log of float metrics: a directory with a raw little endian
+    float64 file per column (<column>.f8), all with the same number of rows (missing
+    values are NaN). Rows are buffered in fixed size numpy buffers and appended to the
+    files when `buffer_rows` rows are buffered, so memory stays constant however long
+    training runs. Opening an existing log appends to it.
+
+    # Example
+        ```python
+            log = MetricsLog('models/ResNet50-metrics')
+            log.append({ 'loss' : 0.5, 'lr' : 1e-4 })
+            log.flush()
+            columns = read_metrics_log('models/ResNet50-metrics')
+        ```
+
+    # Arguments
+        directory: where column files are written
+        buffer_rows: rows buffered in memory
+    """
+
+    def __init__(self, directory, buffer_rows=1024):
+        self.directory   = directory
+        self.buffer_rows = buffer_rows
+        self.buffers     = { }
+        self.buffered    = 0
+        os.makedirs(directory, exist_ok=True)
+        columns = [os.path.splitext(f)[0] for f in os.listdir(directory) if f.endswith('.f8')]
+        self.rows = max([os.path.getsize(self._path(c)) // 8 for c in columns] + [0])
+        for column in columns:
+            self._add_column(column)
+
+    def _path(self, column):
+        return os.path.join(self.directory, column.replace('/', '_') + '.f8')
+
+    def _add_column(self, column):
+        path = self._path(column)
+        # pad so every column has the rows written so far
+        missing = self.rows - (os.path.getsize(path) // 8 if os.path.exists(path) else 0)
+        with open(path, 'ab') as fp:
+            np.full(missing, np.nan, dtype='<f8').tofile(fp)
+        self.buffers[column] = np.full(self.buffer_rows, np.nan, dtype='<f8')
+
+    def append(self, values):
+        for column, value in values.items():
+            if column not in self.buffers:
+                self._add_column(column)
+            self.buffers[column][self.buffered] = value
+        self.buffered += 1
+        if self.buffered == self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        if self.buffered == 0:
+            return
+        for column, buffer in self.buffers.items():
+            with open(self._path(column), 'ab') as fp:
+                buffer[:self.buffered].tofile(fp)
+            buffer.fill(np.nan)
+        self.rows += self.buffered
+        self.buffered = 0
+
+def read_metrics_log(directory, columns=None):
+    """Returns { column : read-only memory mapped float64 array } of a MetricsLog
+    directory (all columns, or `columns`), truncated to the rows of all columns."""
+    if columns is None:
+        columns = sorted(os.path.splitext(f)[0] for f in os.listdir(directory) if f.endswith('.f8'))
+    paths = { column : os.path.join(directory, column.replace('/', '_') + '.f8') for column in columns }
+    rows = min([os.path.getsize(path) // 8 for path in paths.values()] or [0])
+    return { column : np.memmap(path, dtype='<f8', mode='r', shape=(rows, )) if rows else np.empty(0)
+             for column, path in paths.items() }
+
+class MetricsLogger(Callback):
+    """Streams the logs of every batch, the learning rate it was trained with, the epoch
+    and a batch counter ('iterations', continued from the rows already in the log) to a
+    MetricsLog."""
+
+    def __init__(self, metrics_log):
+        super(MetricsLogger, self).__init__()
+        self.metrics_log = metrics_log
+        self.iterations  = metrics_log.rows
+        self.epoch       = 0
+        self.lr          = np.nan
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_batch_begin(self, batch, logs=None):
+        self.lr = K.get_value(self.model.optimizer.lr)
+
+    def on_batch_end(self, batch, logs=None):
+        self.iterations += 1
+        values = { k : float(v) for k, v in (logs or {}).items() if k not in IGNORED_LOGS and np.isscalar(v) }
+        values.update({
+            'iterations' : self.iterations,
+            'epoch'      : self.epoch,
+            'lr'         : self.lr,
+        })
+        self.metrics_log.append(values)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.metrics_log.flush()
+
+    def on_train_end(self, logs=None):
+        self.metrics_log.flush()
+
+if __name__ == '__main__':
+    # plots columns of a metrics log, e.g. python metrics_log.py models/ResNet50-...-metrics -c loss -x lr -s 100
+    import argparse
+    import matplotlib
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', help='MetricsLog directory')
+    parser.add_argument('-c', '--columns', nargs='+', default=['loss'], help='Columns to plot')
+    parser.add_argument('-x', '--x', default='iterations', help='Column of the x axis, e.g. -x lr')
+    parser.add_argument('-s', '--smooth', type=int, default=1, help='Moving average window (rows)')
+    parser.add_argument('-l', '--last', type=int, default=None, help='Only plot the last n rows')
+    parser.add_argument('-o', '--output', default=None, help='Save the plot to this file instead of showing it')
+    args = parser.parse_args()
+
+    if args.output:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    log = read_metrics_log(args.directory, args.columns + [args.x])
+    rows = slice(-args.last, None) if args.last else slice(None)
+    x = np.asarray(log[args.x][rows])
+    for column in args.columns:
+        y = np.asarray(log[column][rows])
+        if args.smooth > 1:
+            # NaN rows (e.g. a column added later) do not count in the average
+            valid = np.isfinite(y)
+            window = np.ones(args.smooth)
+            y = np.convolve(np.where(valid, y, 0.), window, 'same') / np.maximum(np.convolve(valid, window, 'same'), 1)
+        plt.plot(x, y, label=column)
+        print("{}: {} rows, last {:.6g}, min {:.6g}".format(column, len(y), y[-1] if len(y) else np.nan, np.nanmin(y) if len(y) else np.nan))
+    if args.x == 'lr':
+        plt.xscale('log')
+    plt.xlabel(args.x)
+    plt.legend()
+    if args.output:
+        plt.savefig(args.output)
+    else:
+        plt.show()
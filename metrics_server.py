@@ -0,0 +1,117 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+class Metrics(object):
+    """Gauges and counters exposed in the Prometheus text format on
+    http://<host>:<port>/metrics by a daemon thread, so throughput of long running jobs
+    can be scraped instead of parsing tqdm output.
+
+    Values are either set (`set`, `inc`, `rate`) or read when scraped (`gauge_fn`, e.g.
+    queue depths). If `port` is None the server is not started and all calls are no-ops.
+
+    # Example
+        ```python
+            metrics = Metrics(9100).serve()
+            metrics.describe('inference_items_done_total', 'counter', 'Images processed')
+            metrics.inc('inference_items_done_total', len(items))
+            metrics.gauge_fn('generator_queue_depth', jobs.qsize, labels={ 'queue' : 'jobs' })
+        ```
+    """
+
+    def __init__(self, port=None, host='127.0.0.1'):
+        self.port    = port
+        self.host    = host
+        self.enabled = port is not None
+        self._lock   = threading.Lock()
+        self._help   = { }
+        self._values = OrderedDict()
+        self._rates  = { }
+
+    def describe(self, name, kind, help):
+        self._help[name] = (kind, help)
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted(labels.items())) if labels else ())
+
+    def set(self, name, value, labels=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._values[self._key(name, labels)] = value
+
+    def inc(self, name, amount=1, labels=None):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def gauge_fn(self, name, fn, labels=None):
+        self.set(name, fn, labels=labels)
+
+    def rate(self, name, amount, labels=None, smoothing=0.9):
+        """Updates gauge `name` with a smoothed rate per second of `amount` since the last call."""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        now = time.time()
+        with self._lock:
+            last, value = self._rates.get(key, (None, None))
+            if last is not None and now > last:
+                current = amount / (now - last)
+                value = current if value is None else smoothing * value + (1. - smoothing) * current
+                self._values[key] = value
+            self._rates[key] = (now, value)
+
+    def render(self):
+        # samples of a metric must be grouped, sorted() is stable so labels keep insertion order
+        with self._lock:
+            values = sorted(self._values.items(), key=lambda kv: kv[0][0])
+        lines = []
+        described = set()
+        for (name, labels), value in values:
+            if name not in described:
+                described.add(name)
+                kind, help = self._help.get(name, ('untyped', name))
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} {}'.format(name, kind))
+            if callable(value):
+                try:
+                    value = value()
+                except Exception:
+                    continue
+            labels = ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels)
+            lines.append('{}{} {}'.format(name, '{' + labels + '}' if labels else '', float(value)))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self):
+        if not self.enabled:
+            return self
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer((self.host, self.port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print("Serving metrics on http://{}:{}/metrics".format(self.host, self.port))
+        return self
+
+def sanitize(name):
+    """Returns `name` (e.g. a Keras log key) usable as a Prometheus metric or label name."""
+    return re.sub(r'[^a-zA-Z0-9_:]', '_', name)
@@ -0,0 +1,165 @@
+import re
+
+import numpy as np
+from keras import backend as K
+from keras.engine.topology import InputLayer
+from keras.models import Model
+
+GB = 1024. ** 3
+
+# optimizer state per trainable parameter (slots)
+OPTIMIZER_SLOTS = {
+    'adam'     : 2,
+    'sgd'      : 1,
+    'adadelta' : 2,
+}
+
+def _nodes(layer):
+    return getattr(layer, '_inbound_nodes', None) or getattr(layer, 'inbound_nodes', [])
+
+def _shapes(shape):
+    return shape if isinstance(shape, list) else [shape]
+
+def _elements(shape):
+    return sum(int(np.prod(s[1:])) for s in _shapes(shape))
+
+def layer_flops(layer):
+    """Forward FLOPs (a multiply-add is 2) of a layer for one sample, from its first call."""
+    input_shape, output_shape = layer.get_input_shape_at(0), layer.get_output_shape_at(0)
+    name = layer.__class__.__name__
+    if name in ('Conv2D', 'Conv2DTranspose'):
+        kh, kw = layer.kernel_size
+        channels = input_shape[-1] if layer.data_format == 'channels_last' else input_shape[1]
+        return 2 * _elements(output_shape) * kh * kw * channels
+    if name == 'SeparableConv2D':
+        kh, kw = layer.kernel_size
+        channels = input_shape[-1] if layer.data_format == 'channels_last' else input_shape[1]
+        positions = _elements(output_shape) // layer.filters
+        return 2 * positions * channels * layer.depth_multiplier * (kh * kw + layer.filters)
+    if name == 'DepthwiseConv2D':
+        kh, kw = layer.kernel_size
+        return 2 * _elements(output_shape) * kh * kw
+    if name in ('Dense', 'LowRankDense', 'ExpandedDense'):
+        positions = int(np.prod(input_shape[1:-1])) if len(input_shape) > 2 else 1
+        return 2 * positions * layer.count_params()
+    if name == 'HadamardClassifier':
+        # fixed (not trainable) transform computed once for both outputs (with output_raw_logits),
+        # a fast Walsh-Hadamard transform adds log2(hadamard_size) times, plus elementwise scale/bias
+        if layer.use_fwht:
+            transform = layer.hadamard_size * int(np.log2(layer.hadamard_size))
+        else:
+            transform = 2 * _elements(input_shape) * layer.output_dim
+        return transform + _elements(output_shape)
+    if isinstance(layer, InputLayer):
+        return 0
+    # elementwise (activations, batch normalization, pooling, merges...)
+    return _elements(output_shape)
+
+def _leaf_layers(model, calls=1):
+    """(layer, number of calls) of layers of `model`, in topological order, layers of nested
+    models included (called as many times as their model)."""
+    for layer in model.layers:
+        if isinstance(layer, Model):
+            # the first node of a model connects its own inputs and outputs
+            for leaf in _leaf_layers(layer, calls * max(len(_nodes(layer)) - 1, 1)):
+                yield leaf
+        else:
+            yield layer, calls
+
+def model_stats(model, optimizer='adam', amsgrad=False, accumulate=False, checkpoints=None, dtype_bytes=4):
+    """Estimates memory and compute of `model` (shapes must be fully defined but for the
+    batch) without running it, e.g. one built with weights=None.
+
+    Training keeps the activations of every layer from the first trainable one on (the
+    frozen layers before need no gradients) and backward FLOPs are 2x forward FLOPs of
+    layers with trainable weights (gradients of inputs and weights) and 1x forward of the
+    frozen layers after the first trainable one (gradients of inputs only). Inference
+    keeps at most the input and output of one layer at a time.
+
+    With gradient `checkpoints` training keeps the outputs of matching layers and the
+    activations of the longest segment between two of them (recomputed in the backward
+    pass, one more forward pass of the layers after the first trainable one). The automatic
+    strategies of memory_saving_gradients are estimated as checkpoints every sqrt(n) of the
+    n layers after the first trainable one ('memory') or at the outputs of convolution and
+    dense layers ('speed').
+
+    # Arguments
+        optimizer: one of OPTIMIZER_SLOTS
+        amsgrad: adam/adadelta keep a third slot
+        accumulate: gradients accumulated over batches (see AccumulateGradients)
+        checkpoints: regex of names of layers whose outputs are gradient checkpoints, or
+            'memory'/'speed' (see gradient_checkpointing.py)
+
+    # Returns
+        dict of param/trainable/gradient/optimizer bytes, activation bytes per sample and
+        FLOPs per image for training and inference
+    """
+    params    = sum(layer.count_params() for layer, _ in _leaf_layers(model))
+    trainable = int(sum(K.count_params(w) for w in model.trainable_weights))
+
+    leaves = list(_leaf_layers(model))
+    first_trainable = next((i for i, (layer, _) in enumerate(leaves) if layer.trainable_weights), len(leaves))
+    every = max(int(np.sqrt(len(leaves) - first_trainable)), 1)
+
+    def is_checkpoint(i, layer):
+        if checkpoints is None:
+            return True
+        if checkpoints == 'memory':
+            return (i - first_trainable) % every == every - 1
+        if checkpoints == 'speed':
+            return layer.__class__.__name__ in ('Conv2D', 'Conv2DTranspose', 'SeparableConv2D', 'DepthwiseConv2D',
+                                                'Dense', 'LowRankDense', 'ExpandedDense')
+        return re.search(checkpoints, layer.name) is not None
+
+    flops = train_flops = activations = train_activations = peak_activations = 0
+    segment = longest_segment = 0
+    for i, (layer, calls) in enumerate(leaves):
+        f = calls * layer_flops(layer)
+        a = calls * _elements(layer.get_output_shape_at(0))
+        flops            += f
+        activations      += a
+        peak_activations  = max(peak_activations, _elements(layer.get_input_shape_at(0)) + a // calls)
+        if i >= first_trainable:
+            train_flops       += f * (3 if layer.trainable_weights else 2)
+            if is_checkpoint(i, layer):
+                train_activations += a
+                segment = 0
+            else:
+                train_flops += f
+                segment += a
+                longest_segment = max(longest_segment, segment)
+        else:
+            train_flops       += f
+
+    slots = OPTIMIZER_SLOTS.get(optimizer, 2) + (1 if amsgrad else 0) + (1 if accumulate else 0)
+    return {
+        'params'                      : params,
+        'trainable_params'            : trainable,
+        'param_bytes'                 : params * dtype_bytes,
+        'gradient_bytes'              : trainable * dtype_bytes,
+        'optimizer_bytes'             : slots * trainable * dtype_bytes,
+        'train_activation_bytes'      : (train_activations + longest_segment) * dtype_bytes,
+        'inference_activation_bytes'  : peak_activations * dtype_bytes,
+        'all_activation_bytes'        : activations * dtype_bytes,
+        'train_flops'                 : train_flops,
+        'inference_flops'             : flops,
+    }
+
+def memory_needed(stats, batch_size, training=True):
+    """Bytes of weights, gradients, optimizer state and activations for `batch_size`."""
+    if training:
+        return stats['param_bytes'] + stats['gradient_bytes'] + stats['optimizer_bytes'] + \
+            batch_size * stats['train_activation_bytes']
+    return stats['param_bytes'] + batch_size * stats['inference_activation_bytes']
+
+def print_stats(stats, batch_size):
+    print("Parameters:                {:,} ({:,} trainable) {:.2f} GB".format(
+        stats['params'], stats['trainable_params'], stats['param_bytes'] / GB))
+    print("Gradients:                 {:.2f} GB".format(stats['gradient_bytes'] / GB))
+    print("Optimizer state:           {:.2f} GB".format(stats['optimizer_bytes'] / GB))
+    print("Activations per sample:    {:.1f} MB training, {:.1f} MB inference".format(
+        stats['train_activation_bytes'] / 1024. ** 2, stats['inference_activation_bytes'] / 1024. ** 2))
+    print("GFLOPs per image:          {:.2f} training, {:.2f} inference".format(
+        stats['train_flops'] / 1e9, stats['inference_flops'] / 1e9))
+    print("Memory at batch size {}:   {:.2f} GB training, {:.2f} GB inference".format(
+        batch_size, memory_needed(stats, batch_size) / GB, memory_needed(stats, batch_size, training=False) / GB))
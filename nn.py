@@ -7,6 +7,7 @@ import math
 import os
 import pickle
 import argparse
+from metrics_server import Metrics
 
 parser = argparse.ArgumentParser()
 
@@ -20,10 +21,15 @@ parser.add_argument('--results-dir', default='results', help='Prefix dir of comp
 parser.add_argument('-n', '--net', default='VGG16Places365-cs256', help='Subdir of computed features, e.g. -n VGG16Places365-cs256')
 parser.add_argument('-pr', '--print-results', default=0, type=int, help='Print results of the n first queries, e.g. -pr 16')
 parser.add_argument('-f16', '--float16', action='store_true', help='Use float16 lookup tables')
+parser.add_argument('-mp', '--metrics-port', type=int, default=None, help='Serve Prometheus metrics (progress) on localhost port, e.g. -mp 9100')
 parser.add_argument('-etnn', '--extract-train-nn', action='store_true', help='Extract train nearest neighbors instead of test ones')
 
 args = parser.parse_args()
 
+metrics = Metrics(args.metrics_port).serve()
+metrics.describe('nn_items',            'gauge',   'Features to search nearest neighbors for')
+metrics.describe('nn_items_done_total', 'counter', 'Features searched')
+
 FEATURES_NUMBER = args.features
 PCA_FEATURES    = args.pca
 
@@ -152,7 +158,9 @@ if not args.extract_train_nn:
     index_dict[-1] = -1
     test = test[:subset_i]
     print("Search... started")  
+    metrics.set('nn_items', len(test))
     D, I = index.search(mat.apply_py(test) if pca else test, args.top_k)
+    metrics.inc('nn_items_done_total', len(test))
     print("Search... finished")
 else:
     label_features = { }
@@ -171,9 +179,11 @@ else:
     D = np.empty((n_train_set, args.top_k+1), np.float32)
     I = np.empty((n_train_set, args.top_k+1), np.int32)
     i = 0
+    metrics.set('nn_items', n_train_set)
     for label, features in tqdm(label_features.items()):
         n_features = features.shape[0]
         _D, _I = index.search(mat.apply_py(features) if pca else features, args.top_k+1)
+        metrics.inc('nn_items_done_total', n_features)
         D[i:i+n_features,...] = _D
         I[i:i+n_features,...] = _I
         i += n_features
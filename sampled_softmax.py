@@ -0,0 +1,127 @@
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+from keras.callbacks import Callback
+from keras.layers import Activation
+from keras.models import Model
+
+def sampled_softmax_model(model, logits_name='logits', predictions_name='predictions'):
+    """Returns a training model sharing the layers of `model` whose outputs are the
+    features fed to the `logits` Dense layer (named 'sampled_features', to train with
+    `sampled_softmax_loss`) and the full softmax predictions (no loss, so they are not
+    computed in training steps but keep the logits layer weights in the model).
+    """
+    features = Activation('linear', name='sampled_features')(model.get_layer(logits_name).input)
+    return Model(inputs=model.inputs, outputs=[features, model.get_layer(predictions_name).output])
+
+def sampled_softmax_loss(logits_layer, num_sampled):
+    """Keras loss for the 'sampled_features' output: softmax cross entropy over the true
+    class and `num_sampled` classes sampled uniformly, using the kernel and bias of the
+    `logits` Dense layer, y_true being the one-hot classes (as for the full softmax).
+    """
+    num_classes = logits_layer.units
+
+    def sampled_softmax_loss(y_true, y_pred):
+        labels = K.expand_dims(K.argmax(y_true, axis=-1))
+        sampled_values = tf.nn.uniform_candidate_sampler(
+            true_classes=labels, num_true=1, num_sampled=num_sampled, unique=True, range_max=num_classes)
+        return tf.nn.sampled_softmax_loss(
+            weights        = tf.transpose(logits_layer.kernel),
+            biases         = logits_layer.bias if logits_layer.use_bias else tf.zeros((num_classes,)),
+            labels         = labels,
+            inputs         = y_pred,
+            num_sampled    = num_sampled,
+            num_classes    = num_classes,
+            sampled_values = sampled_values)
+
+    return sampled_softmax_loss
+
+class SampledSoftmaxValidation(Callback):
+    """Validates with the full softmax at the end of every epoch when training with a
+    sampled softmax (which has no full predictions to compute metrics on), writing
+    `val_loss` and `val_categorical_accuracy` into the epoch logs so callbacks added
+    after it (checkpoints, ReduceLROnPlateau) can monitor them.
+
+    # Arguments
+        inference_model: model (sharing layers with the trained one) outputting full softmax predictions
+        generator: validation generator yielding (images, one-hot classes)
+        steps: batches to validate on
+    """
+
+    def __init__(self, inference_model, generator, steps):
+        super(SampledSoftmaxValidation, self).__init__()
+        self.inference_model = inference_model
+        self.generator       = generator
+        self.steps           = steps
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs if logs is not None else {}
+        loss = correct = n = 0
+        for _ in range(self.steps):
+            X, y = next(self.generator)
+            predictions = self.inference_model.predict_on_batch(X)
+            loss    += -np.sum(y * np.log(np.clip(predictions, K.epsilon(), 1.)))
+            correct += np.sum(np.argmax(predictions, axis=-1) == np.argmax(y, axis=-1))
+            n       += len(y)
+        logs['val_loss']                 = loss / n
+        logs['val_categorical_accuracy'] = correct / n
+        print("\nFull softmax validation: val_loss {:.4f} val_categorical_accuracy {:.4f}".format(
+            logs['val_loss'], logs['val_categorical_accuracy']))
+
+class InferenceModelCheckpoint(Callback):
+    """Wraps a ModelCheckpoint so it saves the inference model (image -> full softmax
+    predictions, loadable with -m/-t like any other) instead of the training model.
+    """
+
+    def __init__(self, checkpoint, inference_model):
+        super(InferenceModelCheckpoint, self).__init__()
+        self.checkpoint      = checkpoint
+        self.inference_model = inference_model
+
+    def set_model(self, model):
+        super(InferenceModelCheckpoint, self).set_model(model)
+        self.checkpoint.set_model(self.inference_model)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.checkpoint.on_epoch_end(epoch, logs)
+
+if __name__ == '__main__':
+    # step time benchmark of the full softmax and sampled softmax heads
+    import argparse
+    import time
+    from keras.layers import Input, Dense
+    from keras.optimizers import SGD
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--batch-size', type=int, default=48, help='Batch size')
+    parser.add_argument('-f', '--features', nargs='+', type=int, default=[2048, 16384], help='Features fed to the logits layer')
+    parser.add_argument('-c', '--classes', type=int, default=14951, help='Number of classes')
+    parser.add_argument('-s', '--num-sampled', nargs='+', type=int, default=[512, 2048, 8192], help='Sampled classes')
+    parser.add_argument('-r', '--runs', type=int, default=20, help='Timed steps per configuration')
+    args = parser.parse_args()
+
+    def time_steps(model, loss, y):
+        model.compile(optimizer=SGD(lr=1e-3), loss=loss)
+        x = np.random.randn(args.batch_size, model.input_shape[1]).astype(np.float32)
+        model.train_on_batch(x, y)
+        start = time.time()
+        for _ in range(args.runs):
+            model.train_on_batch(x, y)
+        return 1000. * (time.time() - start) / args.runs
+
+    y = np.eye(args.classes, dtype=np.float32)[np.random.randint(args.classes, size=args.batch_size)]
+    print("{:>8} {:>8} {:>10} {:>10} {:>8}".format('features', 'sampled', 'full ms', 'step ms', 'speedup'))
+    for n_features in args.features:
+        K.clear_session()
+        inputs = Input(shape=(n_features,))
+        predictions = Activation('softmax', name='predictions')(Dense(args.classes, name='logits')(inputs))
+        full_ms = time_steps(Model(inputs, predictions), 'categorical_crossentropy', y)
+        print("{:8} {:>8} {:10.2f}".format(n_features, 'full', full_ms))
+        for num_sampled in args.num_sampled:
+            K.clear_session()
+            inputs = Input(shape=(n_features,))
+            logits = Dense(args.classes, name='logits')
+            predictions = Activation('softmax', name='predictions')(logits(inputs))
+            model = sampled_softmax_model(Model(inputs, predictions))
+            step_ms = time_steps(model, { 'sampled_features' : sampled_softmax_loss(logits, num_sampled) }, y)
+            print("{:8} {:8} {:10.2f} {:10.2f} {:7.1f}x".format(n_features, num_sampled, full_ms, step_ms, full_ms / step_ms))
@@ -0,0 +1,55 @@
+import argparse
+import json
+import subprocess
+import sys
+import time
+from multiprocessing import cpu_count
+
+# Measures data-parallel scaling of train.py on this host: runs short training trials
+# (train.py -dp n --benchmark-steps) for n = 1..N processes and reports the total images/s
+# (sum of the images/s every rank prints), the speedup over -dp 1 and the scaling efficiency
+# (speedup / n). The images/s of -dp 1 is what train.py -dpb expects.
+#
+# e.g. python scaling.py -n 4 -s 40 -- -cm ResNet50 -b 32 -uiw
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--processes', type=int, default=min(4, cpu_count()), help='Max data parallel processes, trials run -dp 1..n')
+parser.add_argument('-s', '--steps', type=int, default=40, help='Training steps per trial (including warmup)')
+parser.add_argument('-w', '--warmup', type=int, default=10, help='Steps not timed in each trial')
+parser.add_argument('-t', '--timeout', type=float, default=1800., help='Seconds before a trial is considered failed')
+parser.add_argument('train_args', nargs=argparse.REMAINDER, help='train.py arguments (after --)')
+args = parser.parse_args()
+
+train_args = [arg for arg in args.train_args if arg != '--']
+
+def run_trial(n):
+    command = [sys.executable, 'train.py'] + train_args + \
+        ['-dp', str(n), '--benchmark-steps', str(args.steps), '--benchmark-warmup', str(args.warmup)]
+    start = time.time()
+    try:
+        output = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True, timeout=args.timeout).stdout
+    except subprocess.TimeoutExpired:
+        output = ''
+    rates = { }
+    for line in output.splitlines():
+        if line.startswith('BENCHMARK '):
+            result = json.loads(line[len('BENCHMARK '):])
+            rates[result.get('rank', 0)] = result['images_per_second']
+    # a trial where some rank did not report failed
+    images_per_second = sum(rates.values()) if len(rates) == n else 0.
+    print("-dp {} -> {:.1f} images/s ({}) ({:.0f}s)".format(n, images_per_second,
+        ' '.join('{:.1f}'.format(rates[rank]) for rank in sorted(rates)), time.time() - start))
+    sys.stdout.flush()
+    return images_per_second
+
+results = { n : run_trial(n) for n in range(1, args.processes + 1) }
+
+baseline = results[1]
+if baseline == 0.:
+    sys.exit("-dp 1 failed, run train.py {} -dp 1 --benchmark-steps {} to see why".format(' '.join(train_args), args.steps))
+
+print("processes  images/s  speedup  efficiency")
+for n, images_per_second in sorted(results.items()):
+    speedup = images_per_second / baseline
+    print("{:9}  {:8.1f}  {:7.2f}  {:9.1f}%".format(n, images_per_second, speedup, 100. * speedup / n))
+print("Pass -dpb {:.1f} to train.py -dp n to report scaling efficiency while training".format(baseline))
@@ -0,0 +1,130 @@
+import glob
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+class SignalProfiler(object):
+    """Sampling profiler toggled by a signal (SIGUSR1 by default) so a long running job
+    can be profiled when it slows down, without restarting it.
+
+    When the main process receives the signal it forwards it to its child processes
+    (e.g. the generator workers or the Pool workers, which inherit the handler when
+    forked) and every process samples the python stacks of all its threads every
+    `interval` seconds for `window` seconds. Each process then writes its samples to
+    `out_dir/<session>/<name>-<pid>.folded` (collapsed stacks, usable by flamegraph.pl)
+    and the main process writes a merged `summary.txt` with the top functions of every
+    process. Nothing runs while not profiling: only the signal handler is installed.
+
+    # Example
+        ```python
+            SignalProfiler('train').install()
+            # then from a shell: kill -USR1 <pid>
+        ```
+    """
+
+    def __init__(self, name, out_dir='profiles', window=30., interval=0.005, signum=signal.SIGUSR1):
+        self.name     = name
+        self.out_dir  = out_dir
+        self.window   = window
+        self.interval = interval
+        self.signum   = signum
+        self.main_pid = os.getpid()
+        self.sampling = False
+
+    def install(self):
+        signal.signal(self.signum, self._handler)
+        print("Send signal {} to profile for {:.0f}s, e.g. kill -{} {}".format(
+            self.signum, self.window, signal.Signals(self.signum).name[3:], self.main_pid))
+        return self
+
+    def _session_file(self):
+        return os.path.join(self.out_dir, 'session')
+
+    def _handler(self, signum, frame):
+        if self.sampling:
+            return
+        self.sampling = True
+        is_main = os.getpid() == self.main_pid
+        if is_main:
+            session = time.strftime('%Y%m%d-%H%M%S')
+            os.makedirs(os.path.join(self.out_dir, session), exist_ok=True)
+            with open(self._session_file(), 'w') as fp:
+                fp.write(session)
+            children = multiprocessing.active_children()
+            for child in children:
+                os.kill(child.pid, signum)
+            print("\nProfiling {} and {} child processes for {:.0f}s into {}".format(
+                self.name, len(children), self.window, os.path.join(self.out_dir, session)))
+        else:
+            with open(self._session_file(), 'r') as fp:
+                session = fp.read().strip()
+        threading.Thread(target=self._profile, args=(session, is_main), daemon=True).start()
+
+    def _profile(self, session, is_main):
+        try:
+            stacks = self._sample()
+            name = self.name if is_main else self.name + '-worker'
+            filepath = os.path.join(self.out_dir, session, '{}-{}.folded'.format(name, os.getpid()))
+            with open(filepath, 'w') as fp:
+                for stack, count in stacks.most_common():
+                    fp.write('{} {}\n'.format(';'.join(stack), count))
+            if is_main:
+                # give children time to write their samples
+                time.sleep(min(self.window, 5.))
+                self._summary(os.path.join(self.out_dir, session))
+        finally:
+            self.sampling = False
+
+    def _sample(self):
+        own_ident = threading.get_ident()
+        stacks = Counter()
+        end = time.time() + self.window
+        while time.time() < end:
+            names = { thread.ident : thread.name for thread in threading.enumerate() }
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread-{}'.format(ident)))
+                stacks[tuple(reversed(stack))] += 1
+            time.sleep(self.interval)
+        return stacks
+
+    def _summary(self, session_dir, top=25):
+        lines = []
+        merged_self = Counter()
+        for filepath in sorted(glob.glob(os.path.join(session_dir, '*.folded'))):
+            self_samples = Counter()
+            total_samples = Counter()
+            samples = 0
+            with open(filepath, 'r') as fp:
+                for line in fp:
+                    stack, count = line.rsplit(' ', 1)
+                    frames, count = stack.split(';'), int(count)
+                    samples += count
+                    self_samples[frames[-1]] += count
+                    for frame in set(frames[1:]):
+                        total_samples[frame] += count
+            merged_self.update(self_samples)
+            lines.append('== {} ({} samples)'.format(os.path.basename(filepath), samples))
+            lines.append('   self%  total%  function')
+            for frame, count in self_samples.most_common(top):
+                lines.append('  {:6.2f}  {:6.2f}  {}'.format(
+                    100. * count / samples, 100. * total_samples[frame] / samples, frame))
+            lines.append('')
+        total = sum(merged_self.values())
+        lines.append('== all processes ({} samples)'.format(total))
+        lines.append('   self%  function')
+        for frame, count in merged_self.most_common(top):
+            lines.append('  {:6.2f}  {}'.format(100. * count / max(total, 1), frame))
+        with open(os.path.join(session_dir, 'summary.txt'), 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+        print("\nProfile summary written to {}".format(os.path.join(session_dir, 'summary.txt')))
@@ -0,0 +1,114 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from keras.callbacks import Callback
+
+class Timeline(object):
+    """Records spans of wall time in named lanes and streams them to a Chrome trace-event
+    JSON file (open it in chrome://tracing or https://ui.perfetto.dev).
+
+    Events are buffered and appended to the file (in the JSON array format, whose
+    closing bracket is optional) on `save()` or when `buffer_events` are buffered, so
+    memory stays constant however long training runs.
+
+    Times are `time.time()` seconds so spans measured in worker processes can be added
+    by the main process. If `filepath` is None the timeline is disabled and recording
+    is a no-op.
+
+    # Example
+        ```python
+            timeline = Timeline('trace.json')
+            with timeline.span('predict'):
+                model.predict(imgs)
+            timeline.add('process_item', start, end, lane='worker 3')
+            timeline.save()
+        ```
+    """
+
+    def __init__(self, filepath=None, buffer_events=10000):
+        self.filepath      = filepath
+        self.enabled       = filepath is not None
+        self.buffer_events = buffer_events
+        self.pid           = os.getpid()
+        self.events        = []
+        self.lanes         = {}
+        self.written       = 0
+        if self.enabled:
+            with open(filepath, 'w') as fp:
+                fp.write('[')
+
+    def add(self, name, start, end, lane='main', args=None):
+        if not self.enabled:
+            return
+        if lane not in self.lanes:
+            self.lanes[lane] = len(self.lanes)
+            self.events.append({
+                'name' : 'thread_name',
+                'ph'   : 'M',
+                'pid'  : self.pid,
+                'tid'  : self.lanes[lane],
+                'args' : { 'name' : lane },
+            })
+        event = {
+            'name' : name,
+            'ph'   : 'X',
+            'ts'   : start * 1e6,
+            'dur'  : (end - start) * 1e6,
+            'pid'  : self.pid,
+            'tid'  : self.lanes[lane],
+        }
+        if args:
+            event['args'] = args
+        self.events.append(event)
+        if len(self.events) >= self.buffer_events:
+            self.save()
+
+    @contextmanager
+    def span(self, name, lane='main', args=None):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.time(), lane=lane, args=args)
+
+    def save(self):
+        # appends the buffered events
+        if not self.enabled or not self.events:
+            return
+        events, self.events = self.events, []
+        with open(self.filepath, 'a') as fp:
+            for event in events:
+                fp.write((',\n' if self.written else '\n') + json.dumps(event))
+                self.written += 1
+
+class TimelineCallback(Callback):
+    """Adds per step spans to a Timeline: time spent in `train_on_batch` and time between
+    steps, which is mostly waiting for the generator (it also includes the batch callbacks
+    after this one, so add it first). The time between the last step and the end of the
+    epoch (validation) is also added. Events are written at the end of every epoch too so
+    the trace can be inspected while training.
+    """
+
+    def __init__(self, timeline):
+        super(TimelineCallback, self).__init__()
+        self.timeline = timeline
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.batch_end = time.time()
+
+    def on_batch_begin(self, batch, logs=None):
+        self.batch_begin = time.time()
+        self.timeline.add('wait generator', self.batch_end, self.batch_begin)
+
+    def on_batch_end(self, batch, logs=None):
+        self.batch_end = time.time()
+        self.timeline.add('train_on_batch', self.batch_begin, self.batch_end, args={ 'batch' : batch })
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.timeline.add('validation', self.batch_end, time.time(), args={ 'epoch' : epoch })
+        self.timeline.save()
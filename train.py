@@ -43,25 +43,51 @@ from scipy import signal
 import cv2
 import math
 import csv
+import time
+import zlib
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from multiprocessing import cpu_count, Process, Queue, JoinableQueue, Lock
 
 from functools import partial
 from itertools import  islice
 from conditional import conditional
 
-from collections import defaultdict
+from collections import defaultdict, deque
 import copy
+import threading
 
 import imgaug as ia
 from imgaug import augmenters as iaa
 import sharedmem
 from hadamard import HadamardClassifier
-from clr_callback import CyclicLR
-from kerassurgeon.operations import delete_layer, insert_layer, delete_channels
+from low_rank import LowRankDense
+from expanded_dense import ExpandedDense, expand_layer
+from clr_callback import CyclicLR, LRRangeTest
+from accumulate import AccumulateGradients
+from allreduce import SharedMemoryAllreduce, DataParallelSync, allreduce_gradients
+from gradient_checkpointing import checkpoint_layers, checkpoint_gradients, STRATEGIES
+from cpu_tuning import SETTINGS, profile_path, load_profile, split_cores, configure_worker
+from training_state import TrainingState
+from loss_sampler import LossAwareSampler
+from timeline import Timeline, TimelineCallback
+from memory_report import MemoryReport
+from model_stats import model_stats, memory_needed, print_stats, GB
+from async_validation import CheckpointEvaluator, AsyncValidationMetrics
+from metrics_log import MetricsLog, MetricsLogger
+from batch_size_finder import find_batch_size, candidate_batch_sizes
+from sampled_softmax import sampled_softmax_model, sampled_softmax_loss, SampledSoftmaxValidation, InferenceModelCheckpoint
+from async_checkpoint import AsyncModelCheckpoint, load_model as load_checkpoint
+from feature_cache import FeatureCache, HeadModelCheckpoint, weights_key, copy_weights_by_name
+from signal_profiler import SignalProfiler
+from metrics_server import Metrics
+from metrics_callback import MetricsCallback
+from kerassurgeon.operations import delete_layer, insert_layer, delete_channels, replace_layer
 
 from extra import *
 import inspect
+import json
+import subprocess
 
 SEED = 42
 
@@ -78,6 +104,11 @@ parser.add_argument('-b', '--batch-size', type=int, default=48, help='Batch Size
 parser.add_argument('-l', '--learning-rate', type=float, default=None, help='Initial learning rate')
 parser.add_argument('-clr', '--cyclic_learning_rate',action='store_true', help='Use cyclic learning rate https://arxiv.org/abs/1506.01186')
 parser.add_argument('-o', '--optimizer', type=str, default='adam', help='Optimizer to use in training -o adam|sgd|adadelta')
+parser.add_argument('-ga', '--gradient-accumulation', type=int, default=1, help='Update weights once every n batches with their mean gradient (effective batch size n x -b), e.g. -ga 8')
+parser.add_argument('-dp', '--data-parallel', type=int, default=0, help='Train with n processes (CPU) averaging gradients through shared memory, e.g. -dp 4')
+parser.add_argument('-dpb', '--data-parallel-baseline', type=float, default=None, help='Images/s of -dp 1 (see scaling.py) to report scaling efficiency of -dp n')
+parser.add_argument('--rank', type=int, default=0, help=argparse.SUPPRESS)
+parser.add_argument('--data-parallel-id', type=str, default=None, help=argparse.SUPPRESS)
 parser.add_argument('--amsgrad', action='store_true', help='Apply the AMSGrad variant of adam|adadelta from the paper "On the Convergence of Adam and Beyond".')
 
 # architecture/model
@@ -107,14 +138,67 @@ parser.add_argument('-nd', '--no-dense', action='store_true', help='Dont add any
 parser.add_argument('-bf', '--bottleneck-features', type=int, default=16384, help='If classifier supports it, override number of bottleneck feautures (typically 2048)')
 parser.add_argument('-pcf', '--project-classifier-features', type=int, default=0, help='For -id project classifier features into subspace of given size, e.g. -pcf 512')
 parser.add_argument('-tl', '--triplet-loss', action='store_true', help='Use triplet loss to train feature extractor model')
+parser.add_argument('-tpk', '--triplet-pk', type=int, default=0, help='With -tl sample batches of P classes x K images (K = batch size / P) and mine triplets in the batch, e.g. -tpk 12')
+parser.add_argument('-hnm', '--hard-negative-mining', type=int, default=0, help='With -tl refresh confusable classes used as negatives every n steps, e.g. -hnm 2000')
+parser.add_argument('-hnmc', '--hard-negative-mining-classes', type=int, default=2048, help='Classes embedded (2 items each) to find confusable classes with -hnm')
+parser.add_argument('-hnmn', '--hard-negative-mining-negatives', type=int, default=8, help='Confusable classes kept per class with -hnm')
+parser.add_argument('-tpkm', '--triplet-pk-mining', type=str, default='hard', help='Triplets mined in -tpk batches: hard (hardest positive/negative per anchor) or all (all non-zero loss triplets)')
 
 # training regime
 parser.add_argument('-cs', '--crop-size', type=int, default=256, help='Crop size')
+parser.add_argument('-css', '--crop-size-schedule', nargs='+', type=str, default=None, help='Train at increasing crop sizes from the given (0 based) epochs, needs -p avg|max, e.g. -css 0:160 4:224 8:256')
 parser.add_argument('-vpc', '--val-percent', type=float, default=0.15, help='Val percent')
 parser.add_argument('-ps', '--pavel-split', action='store_true', help='Use Pavel validation split trick')
 parser.add_argument('-fcm', '--freeze-classifier', action='store_true', help='Freeze classifier weights (useful to fine-tune FC layers)')
 parser.add_argument('-fac', '--freeze-all-classifiers', action='store_true', help='Freeze all classifier (feature extractor) weights when using -id')
+parser.add_argument('-fcache', '--feature-cache', action='store_true', help='Compute frozen classifier features once (memory-mapped cache) and train the head on them (implies -fcm)')
+parser.add_argument('-fcachea', '--feature-cache-augmentations', type=int, default=0, help='Number of fixed augmentations per item to cache features for with -fcache, e.g. -fcachea 4')
+parser.add_argument('--feature-cache-dir', default='feature-cache', help='Where to store cached classifier features')
+parser.add_argument('-ssm', '--sampled-softmax', type=int, default=0, help='Train logits with a sampled softmax of n classes (full softmax for validation/inference), e.g. -ssm 2048')
+parser.add_argument('-las', '--loss-aware-sampling', action='store_true', help='Sample training items in proportion to a moving average of their loss (weighted to stay unbiased)')
+parser.add_argument('-lasd', '--loss-aware-sampling-decay', type=float, default=0.9, help='Weight of the previous average in the per item moving average of the loss with -las')
+parser.add_argument('-lasf', '--loss-aware-sampling-floor', type=float, default=0.2, help='Fraction of the sampling probability spread uniformly over all items with -las')
 parser.add_argument('-t25', '--top25', action='store_true', help='top 25%')
+parser.add_argument('-sse', '--save-state-every', type=int, default=0, help='Snapshot training state (weights, optimizer, sampler, CLR, RNG) every n steps, e.g. -sse 5000')
+parser.add_argument('-tr', '--trace', type=str, default=None, help='Record a per step timeline of training/inference and workers as Chrome trace JSON (written as it runs), e.g. -tr trace.json')
+parser.add_argument('-pw', '--profile-window', type=float, default=30., help='Seconds to profile main process and workers for when sent SIGUSR1 (kill -USR1 pid), e.g. -pw 60')
+parser.add_argument('-mp', '--metrics-port', type=int, default=None, help='Serve Prometheus metrics (throughput, queues, lr, loss, progress) on localhost port, e.g. -mp 9100')
+parser.add_argument('-acp', '--async-checkpoint', action='store_true', help='Snapshot checkpoints in memory and write them in a background thread (atomic rename)')
+parser.add_argument('-acpf', '--async-checkpoint-frozen-once', action='store_true', help='With -acp write weights of frozen layers once to a file shared by all checkpoints')
+parser.add_argument('-wk', '--workers', type=int, default=None, help='gen() worker processes (default: cores - 1 or the tuning profile)')
+parser.add_argument('-iot', '--intra-op-threads', type=int, default=None, help='TensorFlow intra op threads (0 is TensorFlow default)')
+parser.add_argument('-eot', '--inter-op-threads', type=int, default=None, help='TensorFlow inter op threads (0 is TensorFlow default)')
+parser.add_argument('-wt', '--worker-threads', type=int, default=None, help='OpenCV threads in each worker (0 is OpenCV default), e.g. -wt 1')
+parser.add_argument('--pin-cores', dest='pin_cores', action='store_const', const=True, default=None, help='Pin workers and TensorFlow to separate cores')
+parser.add_argument('--no-pin-cores', dest='pin_cores', action='store_const', const=False, help='Do not pin workers and TensorFlow to cores')
+parser.add_argument('--tuning-profile', type=str, default=None, help='CPU tuning profile of autotune.py (default: tuning/cpu-<hostname>.json if it exists)')
+parser.add_argument('--no-tuning-profile', action='store_true', help='Do not load the CPU tuning profile')
+parser.add_argument('--benchmark-steps', type=int, default=0, help='Only train n steps and print images/s (used by autotune.py and scaling.py)')
+parser.add_argument('--benchmark-warmup', type=int, default=10, help='Steps not timed with --benchmark-steps')
+parser.add_argument('-lrt', '--lr-range-test', action='store_true', help='Sweep the learning rate over --lr-range-test-steps updates, suggest -l (and CLR bounds) and exit')
+parser.add_argument('-lrts', '--lr-range-test-steps', type=int, default=200, help='Optimizer updates of the learning rate range test')
+parser.add_argument('-lrtb', '--lr-range-test-bounds', type=float, nargs=2, default=[1e-7, 1.], help='Learning rates the range test starts and ends at, e.g. -lrtb 1e-6 1e-1')
+parser.add_argument('-lrtm', '--lr-range-test-mode', type=str, default='exp', choices=['exp', 'linear'], help='Exponential or linear learning rate sweep')
+parser.add_argument('-fbs', '--find-batch-size', action='store_true', help='Time training (or inference with -t/--knn) steps at increasing batch sizes, recommend the knee of images/s and exit')
+parser.add_argument('-fbsa', '--find-batch-size-apply', action='store_true', help='As --find-batch-size but go on with the recommended batch size')
+parser.add_argument('-fbsm', '--find-batch-size-max', type=int, default=512, help='Largest batch size tried by --find-batch-size')
+parser.add_argument('-fbsc', '--find-batch-size-memory-cap', type=float, default=None, help='Stop --find-batch-size above this peak memory in GB (default: 80%% of host memory)')
+parser.add_argument('-vspc', '--val-subset-per-class', type=int, default=None, help='Validate every epoch on a fixed subset of n items per landmark (the full split with --full-val-every and after the last epoch)')
+parser.add_argument('-fve', '--full-val-every', type=int, default=None, help='With -vspc validate on the full split every n epochs (metrics val_full_*, checkpoints -valfull_acc)')
+parser.add_argument('-av', '--async-validation', action='store_true', help='Do not validate while training: checkpoint every epoch and validate checkpoints in an evaluator process (metrics in models/<model>-async-val.csv)')
+parser.add_argument('-avw', '--async-validation-workers', type=int, default=2, help='gen() workers of the -av evaluator process')
+parser.add_argument('-avt', '--async-validation-threads', type=int, default=2, help='TensorFlow intra op threads of the -av evaluator process')
+parser.add_argument('--evaluate-checkpoints', action='store_true', help='Evaluator of -av (started by it): validate -av checkpoints of a run with the same arguments')
+parser.add_argument('--evaluate-parent', type=int, default=None, help=argparse.SUPPRESS)
+parser.add_argument('-ec', '--expand-classes', type=int, default=0, help='Add the new landmarks to the logits of -m and train only their outputs n epochs (then -ecr epochs also the old ones), e.g. -ec 2. Hadamard (-hp) logits are fixed so the head layers before them train from the first epoch and -ecr is just more epochs')
+parser.add_argument('-ecr', '--expand-classes-rebalance', type=int, default=1, help='Epochs training old and new outputs of the logits after -ec')
+parser.add_argument('-ecf', '--expand-classes-new-fraction', type=float, default=0.8, help='Fraction of training items of the new landmarks with -ec (the rest are of old landmarks)')
+parser.add_argument('-gc', '--gradient-checkpointing', type=str, default=None, help='Keep only outputs of layers matching this regex (or memory|speed for automatic selection) and recompute other activations in the backward pass, e.g. -gc "^add_"')
+parser.add_argument('-dr', '--dry-run', action='store_true', help='Build the model without weights, report parameters, optimizer state, activation memory and FLOPs, and exit')
+parser.add_argument('-mb', '--memory-budget', type=float, default=None, help='Refuse to run if the estimated memory (weights, optimizer state, activations of a batch) is above this many GB')
+parser.add_argument('-mlog', '--metrics-log', action='store_true', help='Stream per-batch metrics and learning rate to models/<model>-metrics (plot with metrics_log.py)')
+parser.add_argument('-mr', '--memory-report', action='store_true', help='Report memory of main process, workers and shared buffers at startup, once workers run and every epoch')
+parser.add_argument('-rs', '--resume-state', type=str, default=None, help='Resume training at the exact step of a training state snapshot, e.g. -rs models/ResNet50-...-state.pkl')
 
 # augmentations
 parser.add_argument('-aa', '--augment-always', action='store_true', help='If set will try to augment (based on prob) always (does not wait until 1st seen sample)')
@@ -144,6 +228,7 @@ parser.add_argument('-ssd',  '--scale-score-distractors', action='store_true', h
 
 # NN related
 parser.add_argument('-knn', '--knn', action='store_true', help='Test model using distance metric')
+parser.add_argument('-knnli', '--knn-logits-input', action='store_true', help='With --knn and -m use the inputs of the logits layer of the model as features (saved in <features-dir>/<model>-logits-input, e.g. for factorize_logits.py -f)')
 parser.add_argument('-knnls', '--knn-landmark-samples', default=8, type=int, help='Max number of samples to compute features for each landmark')
 parser.add_argument('--test-csv', default='test.csv', help='Override test.csv')
 parser.add_argument('--train-csv', default='train.csv', help='Override train.csv')
@@ -155,6 +240,75 @@ args = parser.parse_args()
 
 training = not (args.test or args.test_train)
 
+if args.async_validation or args.evaluate_checkpoints:
+    assert training and not (args.triplet_loss or args.feature_cache or args.data_parallel or args.val_subset_per_class or \
+        args.find_batch_size or args.lr_range_test or args.benchmark_steps), \
+        "--async-validation needs training without -tl, -fcache, -dp, -vspc, -fbs, -lrt or --benchmark-steps"
+    if os.environ.get('PYTHONHASHSEED') != str(SEED):
+        # same iteration order of sets (train/val split) in the evaluator process
+        os.environ['PYTHONHASHSEED'] = str(SEED)
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+if args.evaluate_checkpoints:
+    # the training process serves metrics, records the timeline and logs metrics
+    args.metrics_port, args.trace, args.metrics_log, args.memory_report = None, None, False, False
+
+# the process started with -dp n is rank 0 and starts ranks 1..n-1 with the same arguments
+data_parallel_processes = [ ]
+if args.data_parallel and args.rank == 0:
+    assert training and not (args.class_aware_sampling or args.feature_cache or args.resume_state), \
+        "--data-parallel is for training (not -cas, -fcache or -rs)"
+    if os.environ.get('PYTHONHASHSEED') != str(SEED):
+        # same iteration order of sets (items, train/val split) in all processes
+        os.environ['PYTHONHASHSEED'] = str(SEED)
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+    args.data_parallel_id = 'landmark-dp-{}'.format(os.getpid())
+    for rank in range(1, args.data_parallel):
+        data_parallel_processes.append(subprocess.Popen(
+            [sys.executable] + sys.argv + ['--rank', str(rank), '--data-parallel-id', args.data_parallel_id]))
+
+# CPU threads, gen() workers and core pinning: flags override the profile autotune.py saved for this host
+# (tuned for a single process so not used with -dp, which splits cores between processes)
+if not (args.no_tuning_profile or args.data_parallel):
+    tuning_profile = load_profile(args.tuning_profile or profile_path())
+    if tuning_profile is not None:
+        for key in SETTINGS:
+            if getattr(args, key) is None:
+                setattr(args, key, tuning_profile[key])
+        print("Info: CPU tuning profile {} ({:.1f} images/s): {}".format(
+            args.tuning_profile or profile_path(), tuning_profile['images_per_second'],
+            " ".join("{}={}".format(key, getattr(args, key)) for key in SETTINGS)))
+
+N_WORKERS = args.workers or max(1, (cpu_count() - 1) // max(args.data_parallel, 1))
+MAIN_CORES, WORKER_CORES = split_cores(N_WORKERS) if args.pin_cores else (None, None)
+if args.pin_cores:
+    # threads started from now on (TensorFlow) inherit the cores of the main thread
+    os.sched_setaffinity(0, MAIN_CORES)
+
+intra_op_threads = args.intra_op_threads or (max(1, cpu_count() // args.data_parallel) if args.data_parallel else 0)
+inter_op_threads = args.inter_op_threads or (2 if args.data_parallel else 0)
+def configure_session():
+    if intra_op_threads or inter_op_threads:
+        import tensorflow as tf
+        K.set_session(tf.Session(config=tf.ConfigProto(
+            intra_op_parallelism_threads=intra_op_threads, inter_op_parallelism_threads=inter_op_threads)))
+
+configure_session()
+
+timeline = Timeline(args.trace if args.rank == 0 else None)
+SignalProfiler('train', window=args.profile_window).install()
+
+metrics = Metrics(args.metrics_port if args.rank == 0 else None).serve()
+metrics.describe('generator_queue_depth',          'gauge',   'Items waiting in generator queues')
+metrics.describe('generator_workers',              'gauge',   'Generator worker processes alive')
+metrics.describe('generator_items_rejected_total', 'counter', 'Items generator workers failed to load')
+metrics.describe('crop_size',                      'gauge',   'Crop size of the --crop-size-schedule stage')
+metrics.describe('inference_items',                'gauge',   'Images to compute predictions or features for')
+metrics.describe('inference_items_done_total',     'counter', 'Images processed for predictions or features')
+metrics.describe('inference_images_per_second',    'gauge',   'Images processed per second (smoothed)')
+metrics.describe('hard_negatives_refresh_seconds', 'gauge',   'Time to embed the sample and find confusable classes')
+metrics.describe('hard_negatives_active_triplets', 'gauge',   'Fraction of sample triplets with non-zero loss')
+
 if not args.verbose:
     import warnings
     warnings.filterwarnings("ignore")
@@ -167,6 +321,56 @@ if args.include_distractors:
     args.freeze_classifier = True
     print("Info: auto-setting --freeze-classifier because --include-distractors")
 
+if args.feature_cache:
+    assert not (args.model or args.triplet_loss or args.class_aware_sampling or args.vgg_places365 or args.vgg_places1365), \
+        "--feature-cache needs a head built on classifier features only (not -m, -tl, -cas, -p365 or -p1365)"
+    if not args.freeze_classifier:
+        args.freeze_classifier = True
+        print("Info: auto-setting --freeze-classifier because --feature-cache")
+
+if args.sampled_softmax:
+    # -cas needs the batch categorical_accuracy of predictions, which have no loss with -ssm
+    assert not (args.hadamard or args.no_dense or args.include_distractors or args.triplet_loss or args.feature_cache or \
+        args.class_aware_sampling), "--sampled-softmax needs a Dense logits layer and full predictions (not -hp, -nd, -id, -tl, -fcache or -cas)"
+
+CROP_SIZE_SCHEDULE = None
+if args.crop_size_schedule:
+    CROP_SIZE_SCHEDULE = sorted((int(epoch), int(size)) for epoch, size in (stage.split(':') for stage in args.crop_size_schedule))
+    assert CROP_SIZE_SCHEDULE[0][0] == 0, "--crop-size-schedule must start at epoch 0"
+    # the model takes any crop size so the classifier features must be pooled to a fixed size
+    assert args.pooling in ('avg', 'max') and not (args.post_pooling or args.triplet_loss or args.feature_cache or \
+        args.include_distractors), "--crop-size-schedule needs -p avg|max (and not -pp, -tl, -fcache or -id)"
+    args.crop_size = CROP_SIZE_SCHEDULE[0][1]
+
+if args.loss_aware_sampling:
+    assert not (args.triplet_loss or args.class_aware_sampling or args.include_distractors or args.feature_cache or \
+        args.sampled_softmax or args.save_state_every or args.resume_state), \
+        "--loss-aware-sampling needs a predictions output trained on images (not -tl, -cas, -id, -fcache, -ssm, -sse or -rs)"
+
+if args.find_batch_size_apply:
+    args.find_batch_size = True
+
+if args.val_subset_per_class:
+    assert training and not (args.triplet_loss or args.sampled_softmax), "--val-subset-per-class needs training without -tl or -ssm"
+assert not args.full_val_every or args.val_subset_per_class, "--full-val-every needs --val-subset-per-class"
+
+if args.expand_classes:
+    assert args.model and training and not (args.triplet_loss or args.include_distractors or args.sampled_softmax or \
+        args.feature_cache or args.class_aware_sampling or args.loss_aware_sampling or args.resume_state), \
+        "--expand-classes needs -m of a classifier (not -tl, -id, -ssm, -fcache, -cas, -las or -rs)"
+
+if args.dry_run and args.use_imagenet_weights:
+    args.use_imagenet_weights = False
+    print("Info: not loading imagenet weights because --dry-run")
+
+if args.lr_range_test:
+    assert training and not (args.data_parallel or args.benchmark_steps or args.resume_state or args.feature_cache), \
+        "--lr-range-test needs training without -dp, --benchmark-steps, -rs or -fcache"
+
+if args.find_batch_size:
+    assert not (args.data_parallel or args.benchmark_steps), "--find-batch-size does not work with -dp or --benchmark-steps"
+    assert not (args.find_batch_size_apply and args.triplet_pk), "--find-batch-size-apply does not work with -tpk (batches are P x K)"
+
 if (args.model or args.weights) and (not args.triplet_loss) and training and (not args.no_auto_augment):
     args.augment_always = True
     print("Info: auto-setting --augment-always because -m or -w")
@@ -179,8 +383,18 @@ def get_available_gpus():
 if args.gpus is None:
     args.gpus = len(get_available_gpus())   
 
+assert not (args.gradient_checkpointing and args.gpus > 1), "--gradient-checkpointing works with one device (not -g > 1)"
+
 args.batch_size *= max(args.gpus, 1)
 
+if args.triplet_pk:
+    assert args.triplet_loss, "--triplet-pk needs --triplet-loss"
+    assert args.triplet_pk_mining in ('hard', 'all')
+    TRIPLET_PK_K = args.batch_size // args.triplet_pk
+    assert TRIPLET_PK_K >= 2, "--triplet-pk needs at least 2 images per class in a batch"
+    args.batch_size = args.triplet_pk * TRIPLET_PK_K
+    print("Info: triplet batches of {} classes x {} images".format(args.triplet_pk, TRIPLET_PK_K))
+
 TRAIN_DIR    = args.train_dir
 TRAIN_JPGS   = set(Path(TRAIN_DIR).glob('*.jpg'))
 TRAIN_IDS    = { os.path.splitext(os.path.basename(item))[0] for item in TRAIN_JPGS }
@@ -540,9 +754,11 @@ def process_item_worker(worker_id, lock, shared_mem_X, shared_mem_y, jobs, resul
     # make sure augmentations are different for each worker
     np.random.seed()
     random.seed()
+    configure_worker([WORKER_CORES[worker_id % len(WORKER_CORES)]] if WORKER_CORES else None, args.worker_threads)
 
     while True:
         item, aug, training, predict = jobs.get()
+        start = time.time() if timeline.enabled else None
         img, one_hot_class_idx, item = process_item(item, aug, training, predict)
         is_good_item = False
         if one_hot_class_idx is not None:
@@ -550,27 +766,27 @@ def process_item_worker(worker_id, lock, shared_mem_X, shared_mem_y, jobs, resul
             shared_mem_X[worker_id,...] = img
             shared_mem_y[worker_id,...] = one_hot_class_idx
             is_good_item = True
-        results.put((worker_id, is_good_item, item))
+        results.put((worker_id, is_good_item, item, (start, time.time()) if start else None))
 
-# multiprocess worker to read items and put them in shared memory for consumer
+# multiprocess worker to read groups of items (p1, p2, n1 triplets or the K items of a class with
+# --triplet-pk) and put them in shared memory for consumer
 def process_item_worker_triplet(worker_id, lock, shared_mem_X, shared_mem_y, jobs, results):
     # make sure augmentations are different for each worker
     np.random.seed()
     random.seed()
+    configure_worker([WORKER_CORES[worker_id % len(WORKER_CORES)]] if WORKER_CORES else None, args.worker_threads)
 
     while True:
         items, augs, training, predict = jobs.get()
-        img_p1, one_hot_class_idx_p1, item_p1 = process_item(items[0], augs[0], training, predict)
-        img_p2, one_hot_class_idx_p2, item_p2 = process_item(items[1], augs[1], training, predict)
-        img_n1, one_hot_class_idx_n1, item_n1 = process_item(items[2], augs[2], training, predict)
+        start = time.time() if timeline.enabled else None
+        processed = [process_item(item, aug, training, predict) for item, aug in zip(items, augs)]
         is_good_item = False
-        if (one_hot_class_idx_p1 is not None) and (one_hot_class_idx_p2 is not None) and (one_hot_class_idx_n1 is not None):
+        if all(one_hot_class_idx is not None for _, one_hot_class_idx, _ in processed):
             lock.acquire()
-            shared_mem_X[worker_id,...,0] = img_p1
-            shared_mem_X[worker_id,...,1] = img_p2
-            shared_mem_X[worker_id,...,2] = img_n1
+            for k, (img, _, _) in enumerate(processed):
+                shared_mem_X[worker_id,...,k] = img
             is_good_item = True
-        results.put((worker_id, is_good_item, (item_p1, item_p2, item_n1)))
+        results.put((worker_id, is_good_item, tuple(item for _, _, item in processed), (start, time.time()) if start else None))
 
 
 # Callback to monitor accuracy on a per-batch basis
@@ -578,9 +794,11 @@ class AccuracyReset(Callback):
 
     N_BATCHES = args.class_aware_sampling_accuracy_batches
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, writer=None):
         super(AccuracyReset, self).__init__()
         self.filepath = filepath
+        # AsyncModelCheckpoint to save with (if None saves synchronously)
+        self.writer   = writer
 
     def on_train_begin(self, logs={}):
 
@@ -616,9 +834,12 @@ class AccuracyReset(Callback):
         self.last_accuracies = np.zeros(AccuracyReset.N_BATCHES)
         self.last_accuracies_i = 0
         if group != -1 and save:
-            self.model.save(
-                self.filepath.format(group= group, epoch= self.epoch + 1), 
-                overwrite=True)
+            if self.writer is not None:
+                self.writer.save(self.model, self.filepath.format(group= group, epoch= self.epoch + 1))
+            else:
+                self.model.save(
+                    self.filepath.format(group= group, epoch= self.epoch + 1), 
+                    overwrite=True)
         return
 
 # Callback to monitor accuracy on a per-batch basis
@@ -676,27 +897,194 @@ class MonitorDistance(Callback):
     def on_batch_end(self, batch, logs={}):
         return
 
+# Callback to refresh the confusable classes gen() picks negatives from with -tl: every n steps a
+# background thread embeds 2 items of a sample of classes with the current feature model and keeps the
+# classes with nearest centroids of each sampled class
+class HardNegativeMiner(Callback):
+
+    def __init__(self, feature_model, items_per_class, every, n_classes, n_negatives):
+        super(HardNegativeMiner, self).__init__()
+        self.feature_model   = feature_model
+        self.items_per_class = items_per_class
+        self.every           = every
+        self.n_classes       = n_classes
+        self.n_negatives     = n_negatives
+        self.negatives       = { }
+        self.steps           = 0
+        self.thread          = None
+
+    def on_train_begin(self, logs={}):
+        # build it here instead of concurrently from the mining thread
+        self.feature_model._make_predict_function()
+        return
+
+    def on_batch_end(self, batch, logs={}):
+        self.steps += 1
+        if self.steps % self.every == 0 and (self.thread is None or not self.thread.is_alive()):
+            self.thread = threading.Thread(target=self.refresh, daemon=True)
+            self.thread.start()
+        return
+
+    def refresh(self):
+        start = time.time()
+        classes = random.sample(list(self.items_per_class.keys()), min(self.n_classes, len(self.items_per_class)))
+        items = [ ]
+        for _class in classes:
+            class_items = self.items_per_class[_class]
+            items.extend(random.sample(class_items, 2) if len(class_items) >= 2 else class_items * 2)
+
+        # threads, not processes: the generators workers already use all cores and decoding releases the GIL
+        with ThreadPool(min(8, cpu_count())) as pool:
+            results = pool.map(partial(process_item, predict = True), items)
+        good = [i for i in range(len(classes)) if results[2*i][0] is not None and results[2*i+1][0] is not None]
+        classes = [classes[i] for i in good]
+        images = np.stack([results[2*i+k][0] for i in good for k in range(2)])
+        embeddings = self.feature_model.predict(images, batch_size=args.batch_size)
+        anchors, positives = embeddings[0::2], embeddings[1::2]
+
+        def squared_distances(a):
+            squared_norms = np.sum(np.square(a), axis=1)
+            d = squared_norms[:, None] - 2. * a.dot(a.T) + squared_norms[None, :]
+            np.fill_diagonal(d, np.inf)
+            return d
+
+        n_negatives = min(self.n_negatives, len(classes) - 1)
+        nearest = np.argpartition(squared_distances((anchors + positives) / 2.), n_negatives, axis=1)[:, :n_negatives]
+        negatives = dict(self.negatives)
+        negatives.update({ classes[i] : [classes[j] for j in nearest[i]] for i in range(len(classes)) })
+        self.negatives = negatives
+
+        # triplets (1st item, 2nd item, 1st item of another class) with non-zero loss for mined and uniform negatives
+        m = 2.
+        d_ap = np.sum(np.square(anchors - positives), axis=1)
+        d_an = squared_distances(anchors)
+        active_mined   = np.mean(m + d_ap[:, None] - d_an[np.arange(len(classes))[:, None], nearest] > 0)
+        active_uniform = np.sum(m + d_ap[:, None] - d_an > 0) / (len(classes) * (len(classes) - 1))
+
+        elapsed = time.time() - start
+        metrics.set('hard_negatives_refresh_seconds', elapsed)
+        metrics.set('hard_negatives_active_triplets', active_mined,   labels={ 'negatives' : 'mined' })
+        metrics.set('hard_negatives_active_triplets', active_uniform, labels={ 'negatives' : 'uniform' })
+        print("\nHard negatives of {} classes refreshed in {:.1f}s ({} classes with negatives), "
+            "non-zero loss triplets: {:.1f}% mined vs {:.1f}% uniform".format(
+                len(classes), elapsed, len(negatives), 100. * active_mined, 100. * active_uniform))
+
+# Callback to change the crop size at epoch boundaries with --crop-size-schedule: generators compare
+# crop_size with theirs before filling a batch and restart their workers and buffers if it changed.
+# Batches the Keras enqueuer read ahead are still trained on at the previous crop size
+class CropSizeSchedule(Callback):
+
+    def __init__(self, schedule, initial_epoch):
+        super(CropSizeSchedule, self).__init__()
+        self.schedule    = schedule
+        self.crop_size   = self.crop_size_at(initial_epoch)
+        self.stage_epoch = None
+        self.stage_time  = 0.
+        self.stage_images = 0
+
+    def crop_size_at(self, epoch):
+        return [size for start_epoch, size in self.schedule if start_epoch <= epoch][-1]
+
+    def on_epoch_begin(self, epoch, logs={}):
+        crop_size = self.crop_size_at(epoch)
+        if crop_size != self.crop_size or self.stage_epoch is None:
+            print("Crop size {} from epoch {}".format(crop_size, epoch + 1))
+            self.crop_size    = crop_size
+            self.stage_epoch  = epoch
+            self.stage_time   = 0.
+            self.stage_images = 0
+        metrics.set('crop_size', crop_size)
+        self.epoch_start = self.last_batch_end = time.time()
+
+    def on_batch_end(self, batch, logs={}):
+        self.stage_images  += logs.get('size', 0)
+        self.last_batch_end = time.time()
+
+    def on_epoch_end(self, epoch, logs={}):
+        # training steps only, not validation
+        self.stage_time += self.last_batch_end - self.epoch_start
+        print("\nCrop size {} (epochs {}-{}): {:.1f} images/s".format(
+            self.crop_size, self.stage_epoch + 1, epoch + 1, self.stage_images / max(self.stage_time, 1e-6)))
+
+crop_size_schedule = None
+
+# Callback validating on the full split every `every` epochs and after the last one (--full-val-every)
+class FullValidation(Callback):
+    # writes val_full_* metrics into the epoch logs and then calls `checkpoint` (monitoring them)
+    # only on those epochs
+
+    def __init__(self, generator, steps, every, epochs, checkpoint=None):
+        super(FullValidation, self).__init__()
+        self.generator  = generator
+        self.steps      = steps
+        self.every      = every
+        self.epochs     = epochs
+        self.checkpoint = checkpoint
+
+    def set_model(self, model):
+        super(FullValidation, self).set_model(model)
+        if self.checkpoint is not None:
+            self.checkpoint.set_model(model)
+
+    def on_epoch_end(self, epoch, logs={}):
+        if not ((self.every and (epoch + 1) % self.every == 0) or epoch + 1 == self.epochs):
+            return
+        start = time.time()
+        results = self.model.evaluate_generator(self.generator, self.steps)
+        results = results if isinstance(results, list) else [results]
+        for name, value in zip(self.model.metrics_names, results):
+            logs['val_full_' + name] = value
+        print("\nFull validation ({:.0f}s): ".format(time.time() - start) +
+            " ".join("val_full_{} {:.4f}".format(name, value) for name, value in zip(self.model.metrics_names, results)))
+        if self.checkpoint is not None:
+            self.checkpoint.on_epoch_end(epoch, logs)
+
+# Callback measuring training images/s after `warmup` steps (--benchmark-steps)
+class ThroughputBenchmark(Callback):
+
+    def __init__(self, warmup):
+        super(ThroughputBenchmark, self).__init__()
+        self.warmup = warmup
+        self.images_per_second = 0.
+
+    def on_train_begin(self, logs={}):
+        self.start  = time.time()
+        self.images = 0
+
+    def on_batch_end(self, batch, logs={}):
+        if batch + 1 <= self.warmup:
+            self.on_train_begin()
+        else:
+            self.images += logs.get('size', 0)
+            self.images_per_second = self.images / (time.time() - self.start)
+
+# resources of each running generator (workers, buffers and queues) used for monitoring
+generators = { }
+
 # main generator. Although predict=True mode works it is not used here.
-def gen(items, batch_size, training=True, predict=False, accuracy_callback=None):
+# if state_callback (TrainingState) is passed the generator keeps track of the jobs
+# in flight so its state can be snapshotted and resumed at the exact step
+def gen(items, batch_size, training=True, predict=False, accuracy_callback=None, state_callback=None, negatives_miner=None,
+    loss_sampler=None, name=None):
 
     validation = not training 
     items_set = set(items)
-
-    if args.triplet_loss:
-        Xp1 = np.empty((batch_size, CROP_SIZE, CROP_SIZE, 3), dtype=np.float32)
-        Xp2 = np.empty((batch_size, CROP_SIZE, CROP_SIZE, 3), dtype=np.float32)
-        Xn1 = np.empty((batch_size, CROP_SIZE, CROP_SIZE, 3), dtype=np.float32)
-    else:
-        # X image crops
-        X = np.empty((batch_size, CROP_SIZE, CROP_SIZE, 3), dtype=np.float32)
+    lane = 'gen {}'.format(name or ('train' if training else 'val'))
 
     if predict:
         training = False
 
     # class index
     y = np.zeros((batch_size, N_CLASSES),               dtype=np.float32)
+    if args.triplet_pk:
+        # class of each image of P x K batches, as (batch, 1) y_true for pk_triplet_loss
+        y_pk = np.empty((batch_size, 1),                dtype=np.float32)
     if args.include_distractors:
         d = np.empty((batch_size),                      dtype=np.float32)
+    if loss_sampler is not None:
+        # importance weights of the batch items, whose losses the sampler gets after the step
+        w = np.empty((batch_size),                      dtype=np.float32)
+        batch_items = [ ]
     
     n_group_classes = int(math.ceil(N_CLASSES / batch_size))
     if training and (args.class_aware_sampling or args.triplet_loss):
@@ -710,6 +1098,7 @@ def gen(items, batch_size, training=True, predict=False, accuracy_callback=None)
         classes_groups = np.array_split(np.argsort(n_items_per_class)[::-1], n_group_classes)
         classes_current_group = -1
         classes_current_group_items_to_see = 0
+        classes               = [ ]
         classes_running_copy  = [ ]
         classes_seen = set()
         previous_classes_seen = set()
@@ -733,35 +1122,178 @@ def gen(items, batch_size, training=True, predict=False, accuracy_callback=None)
             classes = list(range(N_CLASSES))
 
 
-    n_workers    = (cpu_count() - 1) if not predict else 1 # for prediction we need to guarantee order
-    if args.triplet_loss:
-        shared_mem_X = sharedmem.empty((n_workers, CROP_SIZE, CROP_SIZE, 3, 3), dtype=np.float32)
-        shared_mem_y = None
-    else:
-        shared_mem_X = sharedmem.empty((n_workers, CROP_SIZE, CROP_SIZE, 3), dtype=np.float32)
-        shared_mem_y = sharedmem.empty((n_workers, N_CLASSES),               dtype=np.float32)
-    locks        = [Lock()] * n_workers
-    jobs         = Queue(args.batch_size * 4 if not predict else 1)
-    results      = JoinableQueue(args.batch_size * 2 if not predict else 1)
+    n_workers    = N_WORKERS if not predict else 1 # for prediction we need to guarantee order
+    # items processed together in a job (and batch slots filled by its result)
+    group_size   = (TRIPLET_PK_K if args.triplet_pk else 3) if args.triplet_loss else 1
+    batch_groups = args.triplet_pk if args.triplet_pk else batch_size
+    X = Xp1 = Xp2 = Xn1 = shared_mem_X = shared_mem_y = locks = jobs = results = workers = None
+    crop_size = None
+
+    # image buffers are sized from CROP_SIZE and workers read it when forked, so with
+    # --crop-size-schedule they are started again when it changes
+    def start_workers():
+        nonlocal X, Xp1, Xp2, Xn1, shared_mem_X, shared_mem_y, locks, jobs, results, workers, crop_size
+        crop_size = CROP_SIZE
+        if args.triplet_loss and not args.triplet_pk:
+            Xp1 = np.empty((batch_size, CROP_SIZE, CROP_SIZE, 3), dtype=np.float32)
+            Xp2 = np.empty((batch_size, CROP_SIZE, CROP_SIZE, 3), dtype=np.float32)
+            Xn1 = np.empty((batch_size, CROP_SIZE, CROP_SIZE, 3), dtype=np.float32)
+        else:
+            # X image crops
+            X = np.empty((batch_size, CROP_SIZE, CROP_SIZE, 3), dtype=np.float32)
 
-    [Process(
-        target=process_item_worker if not args.triplet_loss else process_item_worker_triplet, 
-        args=(worker_id, lock, shared_mem_X, shared_mem_y, jobs, results)).start() for worker_id, lock in enumerate(locks)]
+        if args.triplet_loss:
+            shared_mem_X = sharedmem.empty((n_workers, CROP_SIZE, CROP_SIZE, 3, group_size), dtype=np.float32)
+            shared_mem_y = None
+        else:
+            shared_mem_X = sharedmem.empty((n_workers, CROP_SIZE, CROP_SIZE, 3), dtype=np.float32)
+            shared_mem_y = sharedmem.empty((n_workers, N_CLASSES),               dtype=np.float32)
+        locks        = [Lock()] * n_workers
+        jobs         = Queue(args.batch_size * 4 if not predict else 1)
+        results      = JoinableQueue(args.batch_size * 2 if not predict else 1)
+
+        workers = [Process(
+            target=process_item_worker if not args.triplet_loss else process_item_worker_triplet, 
+            args=(worker_id, lock, shared_mem_X, shared_mem_y, jobs, results)) for worker_id, lock in enumerate(locks)]
+        for worker in workers:
+            worker.start()
+
+        generators[lane] = {
+            'workers' : workers,
+            'buffers' : {
+                'shared_mem_X' : shared_mem_X,
+                'shared_mem_y' : shared_mem_y,
+                'batch X'      : X if not args.triplet_loss or args.triplet_pk else None,
+                'batch Xp1'    : Xp1 if args.triplet_loss and not args.triplet_pk else None,
+                'batch Xp2'    : Xp2 if args.triplet_loss and not args.triplet_pk else None,
+                'batch Xn1'    : Xn1 if args.triplet_loss and not args.triplet_pk else None,
+                'batch y'      : y,
+            },
+            'queues'  : { 'jobs' : jobs, 'results' : results },
+        }
+        for queue_name, queue in generators[lane]['queues'].items():
+            metrics.gauge_fn('generator_queue_depth', queue.qsize, labels={ 'generator' : lane, 'queue' : queue_name })
+        metrics.gauge_fn('generator_workers', lambda: sum(worker.is_alive() for worker in workers), labels={ 'generator' : lane })
+
+    start_workers()
 
     bad_items = set()
     i = 0
+    items_done = 0
+    shuffle_items = True
+    # with -tpk and -hnm classes confusable with the last sampled class, sampled next so they share batches
+    pk_classes = [ ]
+
+    # jobs bookkeeping (only if state_callback): jobs submitted to workers but not in a batch yet,
+    # jobs of the batch being filled, jobs of the last yielded batches (which may still wait in
+    # the Keras queue) and jobs to resubmit before sampling new items
+    track_jobs     = state_callback is not None
+    state_lock     = threading.Lock()
+    jobs_in_flight = [ ]
+    batch_jobs     = [ ]
+    yielded_jobs   = deque(maxlen=32)
+    replay_jobs    = [ ]
+    n_yielded      = 0
+
+    def job_item(job):
+        return tuple(job[0]) if args.triplet_loss else job[0]
+
+    # called with state_lock held
+    def get_state(batches_trained):
+        n_untrained = n_yielded - batches_trained
+        untrained_jobs = list(itertools.chain(*list(yielded_jobs)[len(yielded_jobs) - n_untrained:])) if n_untrained > 0 else []
+        state = {
+            'n_yielded'   : batches_trained,
+            'replay_jobs' : replay_jobs + untrained_jobs + batch_jobs + jobs_in_flight,
+            'items'       : list(items),
+            'i'           : i,
+            'items_done'  : items_done,
+        }
+        if training and (args.class_aware_sampling or args.triplet_loss):
+            state.update({
+                'items_per_class_running'            : { k : list(v) for k, v in items_per_class_running.items() },
+                'classes_current_group'              : classes_current_group,
+                'classes_current_group_items_to_see' : classes_current_group_items_to_see,
+                'classes'                            : list(classes),
+                'classes_running_copy'               : list(classes_running_copy),
+                'classes_seen'                       : set(classes_seen),
+                'previous_classes_seen'              : set(previous_classes_seen),
+                'save_model'                         : save_model,
+            })
+        return state
+
+    # called with state_lock held
+    def rewind(batches_trained):
+        nonlocal n_yielded
+        for _ in range(n_yielded - batches_trained):
+            replay_jobs[:0] = yielded_jobs.pop()
+        n_yielded = batches_trained
+
+    if track_jobs:
+        state_callback.set_generator(get_state, rewind, state_lock)
+        sampler = state_callback.resume_sampler
+        if sampler is not None:
+            state_callback.resume_sampler = None
+            items         = sampler['items']
+            i, items_done = sampler['i'], sampler['items_done']
+            replay_jobs   = sampler['replay_jobs']
+            n_yielded     = sampler['n_yielded']
+            shuffle_items = False
+            if 'classes' in sampler:
+                items_per_class_running            = defaultdict(list, sampler['items_per_class_running'])
+                classes_current_group              = sampler['classes_current_group']
+                classes_current_group_items_to_see = sampler['classes_current_group_items_to_see']
+                classes                            = sampler['classes']
+                classes_running_copy               = sampler['classes_running_copy']
+                classes_seen                       = sampler['classes_seen']
+                previous_classes_seen              = sampler['previous_classes_seen']
+                save_model                         = sampler['save_model']
+            print("Resuming generator with {} jobs to replay".format(len(replay_jobs)))
+
+    # called between batches: jobs in flight and results not consumed yet are dropped (or replayed
+    # if tracking jobs) and workers and buffers are started again at the new crop size
+    def restart_workers(new_crop_size):
+        global CROP_SIZE
+        start = time.time()
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+        if track_jobs:
+            with state_lock:
+                replay_jobs[:0] = jobs_in_flight
+                del jobs_in_flight[:]
+        if loss_sampler is not None:
+            loss_sampler.pending.clear()
+        old_crop_size = crop_size
+        CROP_SIZE = new_crop_size
+        start_workers()
+        print("\n{}: crop size {} -> {}, {} workers restarted in {:.1f}s".format(
+            lane, old_crop_size, crop_size, n_workers, time.time() - start))
 
     while True:
 
-        if training and not args.class_aware_sampling:
+        if training and not args.class_aware_sampling and shuffle_items:
             random.shuffle(items)
+        shuffle_items = True
 
-        batch_idx = 0
+        batch_idx  = 0
+        batch_jobs = [ ]
 
-        items_done  = 0
         while items_done < len(items):  
+            if crop_size_schedule is not None and not predict and batch_idx == 0 and crop_size_schedule.crop_size != crop_size:
+                restart_workers(crop_size_schedule.crop_size)
+            fill_start = time.time()
+            if track_jobs:
+                state_lock.acquire()
             # fill the queue to make sure CPU is always busy
             while not jobs.full():
+                if replay_jobs:
+                    # resubmit jobs of a resumed or rewound state before sampling new items
+                    job = replay_jobs.pop(0)
+                    jobs.put(job)
+                    jobs_in_flight.append(job)
+                    continue
                 if training and args.class_aware_sampling:
                     if np.random.rand() >= 0.2 or not previous_classes_seen:
                         # if already reached patience or accuracy, build classes list with this group's classes
@@ -804,13 +1336,15 @@ def gen(items, batch_size, training=True, predict=False, accuracy_callback=None)
                         training_item_chosen = item in items_set
                     classes_seen.add(random_class)
                 elif args.triplet_loss:
-                    if len(classes_running_copy) == 0:
-                        random.shuffle(classes)
-                        classes_running_copy = list(classes)
-                    random_classP = classes_running_copy.pop()
-                    random_classN = random_classP
-                    while random_classN == random_classP:
-                        random_classN = random.choice(classes)
+                    if pk_classes:
+                        random_classP = pk_classes.pop(0)
+                    else:
+                        if len(classes_running_copy) == 0:
+                            random.shuffle(classes)
+                            classes_running_copy = list(classes)
+                        random_classP = classes_running_copy.pop()
+                        if args.triplet_pk and negatives_miner is not None:
+                            pk_classes = list(negatives_miner.negatives.get(random_classP, []))[:args.triplet_pk - 1]
 
                     def pick_item_from_class(items_per_class_running, random_class):
                         if len(items_per_class_running[random_class]) == 0:
@@ -818,9 +1352,22 @@ def gen(items, batch_size, training=True, predict=False, accuracy_callback=None)
                             items_per_class_running[random_class]=copy.deepcopy(items_per_class[random_class])
                         return items_per_class_running[random_class].pop()
 
-                    item_p1 = pick_item_from_class(items_per_class_running, random_classP)
-                    item_p2 = pick_item_from_class(items_per_class_running, random_classP)
-                    item_n1 = pick_item_from_class(items_per_class_running, random_classN)
+                    if args.triplet_pk:
+                        # K items of the class, P of these jobs make a batch and triplets are mined in it
+                        group_items = [pick_item_from_class(items_per_class_running, random_classP) for _ in range(group_size)]
+                    else:
+                        confusable = negatives_miner.negatives.get(random_classP) if negatives_miner is not None else None
+                        if confusable:
+                            random_classN = random.choice(confusable)
+                        else:
+                            random_classN = random_classP
+                            while random_classN == random_classP:
+                                random_classN = random.choice(classes)
+
+                        item_p1 = pick_item_from_class(items_per_class_running, random_classP)
+                        item_p2 = pick_item_from_class(items_per_class_running, random_classP)
+                        item_n1 = pick_item_from_class(items_per_class_running, random_classN)
+                        group_items = [item_p1, item_p2, item_n1]
 
                 else:
                     # if not using class-aware sampling, just pick one item
@@ -831,18 +1378,17 @@ def gen(items, batch_size, training=True, predict=False, accuracy_callback=None)
                             i += 1
                             if (get_class(item) == -1 and pick_distractor) or (get_class(item) != -1 and not pick_distractor):
                                 break
+                    elif loss_sampler is not None:
+                        item = loss_sampler.sample()
                     else:
                         item = items[i % len(items)]
                         i += 1
                 if not predict:
                     if args.triplet_loss:
                         augs = []
-                        augs.append(False if ( (id_times_seen[get_id(item_p1)]==0) and not args.augment_always) else True)
-                        augs.append(False if ( (id_times_seen[get_id(item_p2)]==0) and not args.augment_always) else True)
-                        augs.append(False if ( (id_times_seen[get_id(item_n1)]==0) and not args.augment_always) else True)
-                        id_times_seen[get_id(item_p1)] += 1
-                        id_times_seen[get_id(item_p2)] += 1
-                        id_times_seen[get_id(item_n1)] += 1
+                        for group_item in group_items:
+                            augs.append(False if ( (id_times_seen[get_id(group_item)]==0) and not args.augment_always) else True)
+                            id_times_seen[get_id(group_item)] += 1
                     else:
                         # do not augment the first time the net has seen an item
                         aug = False if ( (id_times_seen[get_id(item)]==0) and not args.augment_always) else True
@@ -850,42 +1396,81 @@ def gen(items, batch_size, training=True, predict=False, accuracy_callback=None)
                 else:
                     # do not augment if predicting
                     if args.triplet_loss:
-                        augs = [False, False, False]
+                        augs = [False] * group_size
                     else:
                         aug = False
                 if args.triplet_loss:
-                    jobs.put(([item_p1, item_p2, item_n1], augs, training, predict))
+                    job = (group_items, augs, training, predict)
                 else:
-                    jobs.put((item, aug, training, predict))
+                    job = (item, aug, training, predict)
+                jobs.put(job)
+                if track_jobs:
+                    jobs_in_flight.append(job)
                 items_done += 1
+            if track_jobs:
+                state_lock.release()
+            timeline.add('fill jobs', fill_start, time.time(), lane=lane)
 
             # loop over results and yield until no more resuls left
             get_more_results = True
             while get_more_results:
-                worker_id, is_good_item, _item = results.get() # blocks/waits if None
+                wait_start = time.time()
+                worker_id, is_good_item, _item, worker_span = results.get() # blocks/waits if None
                 results.task_done()
+                timeline.add('wait workers', wait_start, time.time(), lane=lane)
+                if worker_span:
+                    timeline.add('process_item', *worker_span, lane='{} worker {}'.format(lane, worker_id))
+
+                if track_jobs:
+                    state_lock.acquire()
+                    job = next(job for job in jobs_in_flight if job_item(job) == _item)
+                    jobs_in_flight.remove(job)
 
                 if is_good_item:
-                    if args.triplet_loss:
+                    if args.triplet_pk:
+                        X[batch_idx*group_size:(batch_idx+1)*group_size] = np.moveaxis(shared_mem_X[worker_id], -1, 0)
+                        y_pk[batch_idx*group_size:(batch_idx+1)*group_size] = get_class(_item[0])
+                    elif args.triplet_loss:
                         Xp1[batch_idx], Xp2[batch_idx], Xn1[batch_idx] = \
                             shared_mem_X[worker_id, ...,0], shared_mem_X[worker_id, ...,1], shared_mem_X[worker_id, ...,2]
                     else:
                         X[batch_idx], y[batch_idx] = shared_mem_X[worker_id], shared_mem_y[worker_id]
                         if args.include_distractors:
                             d[batch_idx] = 1 if np.all(shared_mem_y[worker_id] == 1.) else 0
+                        if loss_sampler is not None:
+                            w[batch_idx] = loss_sampler.weight(_item)
+                            batch_items.append(_item)
                     locks[worker_id].release()
                     batch_idx += 1
+                    if track_jobs:
+                        batch_jobs.append(job)
                 else:
                     if predict:
                         X[batch_idx] = np.zeros((CROP_SIZE, CROP_SIZE, 3), dtype=np.float32)
                         batch_idx += 1
                         print("Warning {}".format(_item))
+                    if loss_sampler is not None:
+                        loss_sampler.discard(_item)
                     bad_items.add(_item)
+                    metrics.inc('generator_items_rejected_total', labels={ 'generator' : lane })
 
-                if batch_idx == batch_size:
+                if track_jobs:
+                    if batch_idx == batch_groups:
+                        yielded_jobs.append(batch_jobs)
+                        batch_jobs = [ ]
+                        n_yielded += 1
+                    state_lock.release()
+
+                if batch_idx == batch_groups:
                     if not predict:
-                        if args.triplet_loss:
+                        if args.triplet_pk:
+                            yield(X, y_pk)
+                        elif args.triplet_loss:
                             yield([Xp1, Xp2, Xn1], y)
+                        elif loss_sampler is not None:
+                            loss_sampler.batch_yielded(batch_items)
+                            batch_items = [ ]
+                            yield(X, y, w)
                         else:
                             _Y = y if not args.include_distractors else [y,d]
                             yield(X, _Y)
@@ -898,27 +1483,185 @@ def gen(items, batch_size, training=True, predict=False, accuracy_callback=None)
         if len(bad_items) > 0:
             print("\nRejected {} items: {}".format('trainining' if training else 'validation', len(bad_items)))
 
+        items_done = 0
+
+# process_item for Pool.map during inference, also returning the span of the pool worker
+def process_item_timed(item, **kwargs):
+    start = time.time()
+    return process_item(item, **kwargs), (os.getpid(), start, time.time())
+
+# Pool.map of process_item (predict mode) adding the pool workers activity to the timeline
+# and the progress to the metrics
+def pool_map_items(pool, items):
+    metrics.inc('inference_items_done_total', len(items))
+    metrics.rate('inference_images_per_second', len(items))
+    if not timeline.enabled:
+        return pool.map(partial(process_item, predict = True), items)
+    with timeline.span('Pool.map'):
+        results = pool.map(partial(process_item_timed, predict = True), items)
+    for _, (pid, start, end) in results:
+        timeline.add('process_item', start, end, lane='pool worker {}'.format(pid))
+    return [result for result, _ in results]
+
+# process_item for fixed augmentation number `augmentation` of an item: seeded from the item id
+# so the same augmentation is computed every time (see --feature-cache-augmentations)
+def process_item_augmented(item, augmentation):
+    seed = zlib.crc32('{}-{}'.format(get_id(item), augmentation).encode())
+    np.random.seed(seed)
+    random.seed(seed)
+    ia.seed(seed)
+    return process_item(item, aug = True, training = True, predict = True)
+
+# compute (or resume computing) the classifier features of all items in cache
+def extract_features(cache, classifier_model):
+    missing = cache.missing()
+    if len(missing) == 0:
+        return
+    imgs = np.empty((args.batch_size, CROP_SIZE, CROP_SIZE, 3), dtype=np.float32)
+    metrics.set('inference_items', len(missing) * cache.rows_per_item)
+    with Pool(min(args.batch_size, args.workers or cpu_count()), initializer=configure_worker, initargs=(WORKER_CORES, args.worker_threads)) as pool:
+        for ii in tqdm(range(0, len(missing), args.batch_size)):
+            items = missing[ii:ii+args.batch_size]
+            for augmentation in range(cache.rows_per_item):
+                if augmentation == 0:
+                    batch_results = pool_map_items(pool, items)
+                else:
+                    batch_results = pool.map(partial(process_item_augmented, augmentation = augmentation), items)
+                good_items = [ ]
+                for item, (img, _, _) in zip(items, batch_results):
+                    if img is not None:
+                        imgs[len(good_items)] = img
+                        good_items.append(item)
+                if augmentation == 0:
+                    cache.set_status(set(items).difference(good_items), -1)
+                if good_items:
+                    with timeline.span('predict'):
+                        cache.write(good_items, augmentation, classifier_model.predict(imgs[:len(good_items)]))
+            cache.set_status([item for item in items if cache.status[cache.index[item]] == 0], 1)
+    cache.flush()
+
+# generator of batches of cached classifier features, same batches as gen() but features instead of images
+# and a (random) cached augmentation instead of a fresh one; validation yields the last partial batch too
+# so ceil(len(items) / batch_size) steps see every item once
+def feature_gen(cache, items, batch_size, training=True):
+    items = cache.good_items(items)
+    if training and args.include_distractors:
+        # as gen(), every item is a distractor or a landmark with probability 0.5
+        kinds = [[item for item in items if get_class(item) != -1], [item for item in items if get_class(item) == -1]]
+        assert all(kinds), "--include-distractors needs cached features of landmarks and distractors"
+        for kind in kinds:
+            random.shuffle(kind)
+        drawn = [0, 0]
+    while True:
+        if training:
+            random.shuffle(items)
+        for ii in range(0, len(items) - batch_size + 1 if training else len(items), batch_size):
+            if training and args.include_distractors:
+                batch_items = [ ]
+                for _ in range(batch_size):
+                    kind = 1 if np.random.random() <= 0.5 else 0
+                    batch_items.append(kinds[kind][drawn[kind] % len(kinds[kind])])
+                    drawn[kind] += 1
+            else:
+                batch_items = items[ii:ii+batch_size]
+            rows = [ ]
+            for item in batch_items:
+                augmentation = 0
+                if training:
+                    # do not augment the first time the net has seen an item
+                    if id_times_seen[get_id(item)] != 0 or args.augment_always:
+                        augmentation = random.randrange(cache.rows_per_item)
+                    id_times_seen[get_id(item)] += 1
+                rows.append(cache.row(item, augmentation))
+            X = cache.features[rows]
+            y = np.zeros((len(batch_items), N_CLASSES), dtype=np.float32)
+            for i, item in enumerate(batch_items):
+                _class = get_class(item)
+                if _class != -1:
+                    y[i, _class] = 1.
+                else:
+                    y[i] = 1.
+            if args.include_distractors:
+                d = np.all(y == 1., axis=1).astype(np.float32)
+                yield(X, [y, d])
+            else:
+                yield(X, y)
+
 def zero_loss(y_true, y_pred):
     return  K.zeros(shape=(1,))
 
 def identity_loss(y_true, y_pred):
     return K.mean(y_pred)
 
+# triplet loss of --triplet-pk batches (P classes x K images, y_true the class of each image) with
+# triplets mined in the batch from the embeddings y_pred, same margin and regularizer as triplet_loss
+def pk_distances(y_true, y_pred):
+    import tensorflow as tf
+    labels    = K.reshape(y_true, (-1, 1))
+    same      = K.cast(K.equal(labels, K.transpose(labels)), 'float32')
+    positives = same - tf.eye(K.shape(y_pred)[0])
+    negatives = 1. - same
+
+    # squared euclidean distances between all embeddings
+    squared_norms = K.sum(K.square(y_pred), axis=-1, keepdims=True)
+    distances = K.relu(squared_norms - 2. * K.dot(y_pred, K.transpose(y_pred)) + K.transpose(squared_norms))
+    return distances, positives, negatives
+
+def pk_triplet_loss(y_true, y_pred):
+    m = 2.
+    distances, positives, negatives = pk_distances(y_true, y_pred)
+
+    if args.triplet_pk_mining == 'hard':
+        # hardest positive and hardest negative of each anchor
+        hardest_positive = K.max(distances * positives, axis=-1)
+        hardest_negative = K.min(distances + K.max(distances) * (1. - negatives), axis=-1)
+        loss = K.relu(m + hardest_positive - hardest_negative)
+    else:
+        # all (anchor, positive, negative) triplets, averaged over the ones with non-zero loss
+        triplets = K.relu(m + K.expand_dims(distances, 2) - K.expand_dims(distances, 1)) * \
+            K.expand_dims(positives, 2) * K.expand_dims(negatives, 1)
+        active = K.sum(K.cast(K.greater(triplets, 1e-16), 'float32'))
+        loss = K.sum(triplets, axis=[1, 2]) * K.cast(K.shape(y_pred)[0], 'float32') / K.maximum(active, 1.)
+
+    # Eq (3,4) regularizer
+    loss += 1e-3 * K.sum(K.square(y_pred), axis=-1)
+
+    return loss
+
+# fraction of all (anchor, positive, negative) triplets of a --triplet-pk batch with non-zero loss
+def active_triplets(y_true, y_pred):
+    m = 2.
+    distances, positives, negatives = pk_distances(y_true, y_pred)
+    valid    = K.expand_dims(positives, 2) * K.expand_dims(negatives, 1)
+    active   = K.cast(K.greater(m + K.expand_dims(distances, 2) - K.expand_dims(distances, 1), 0.), 'float32') * valid
+    return K.sum(active) / K.maximum(K.sum(valid), 1.)
+
+custom_objects = {
+    'HadamardClassifier': HadamardClassifier, 
+    'LowRankDense': LowRankDense,
+    'ExpandedDense': ExpandedDense,
+    'AccumulateGradients': AccumulateGradients,
+    'zero_loss': zero_loss,
+    'identity_loss' : identity_loss,
+    'pk_triplet_loss' : pk_triplet_loss,
+    'active_triplets' : active_triplets}
+
 # MAIN
 if args.model:
     print("Loading model " + args.model)
 
-    with CustomObjectScope({
-        'HadamardClassifier': HadamardClassifier, 
-        'zero_loss': zero_loss,
-        'identity_loss' : identity_loss}):
-        model = load_model(args.model, compile=False if not training or (args.learning_rate is not None) else True)
+    with CustomObjectScope(custom_objects):
+        # also loads checkpoints written with -acpf (frozen layers in a separate file)
+        model = load_checkpoint(args.model, compile=False if not training or (args.learning_rate is not None) else True)
     # e.g. ResNet50-hp-l2-ppavg2-losscategorical_crossentropy-cs256-nofc-doc0.0-do0.0-dol0.0-poolingnone-cas-epoch008-val_acc0.575105.hdf5
     model_basename = os.path.splitext(os.path.basename(args.model))[0]
     model_parts = model_basename.split('-')
     model_name = '-'.join([part for part in model_parts if part not in ['epoch', 'val_acc']])
     args.classifier = model_parts[0]
-    CROP_SIZE = args.crop_size  = model.get_input_shape_at(0)[1] if not args.triplet_loss else model.get_input_shape_at(0)[0][1]
+    model_crop_size = model.get_input_shape_at(0)[1] if not args.triplet_loss or args.triplet_pk else model.get_input_shape_at(0)[0][1]
+    # models trained with --crop-size-schedule take any crop size, keep -cs (or the schedule)
+    if model_crop_size is not None:
+        CROP_SIZE = args.crop_size = model_crop_size
     print("Overriding classifier: {} and crop size: {}".format(args.classifier, args.crop_size))
     last_epoch = int(list(filter(lambda x: x.startswith('epoch'), model_parts))[0][5:])
     print("Last epoch: {}".format(last_epoch))
@@ -929,6 +1672,18 @@ if args.model:
         args.learning_rate = K.eval(model.optimizer.lr)
         print("Resuming with learning rate: {:.2e}".format(args.learning_rate))
 
+    if args.expand_classes:
+        # keep the outputs (and weights) of the classes of the model, add the new ones and train only those
+        expanded_logits, logits_weights, EXPANDED_FROM = expand_layer(model.get_layer('logits'), N_CLASSES)
+        assert EXPANDED_FROM < N_CLASSES, "--expand-classes: the model already has {} outputs".format(EXPANDED_FROM)
+        model = replace_layer(model, model.get_layer('logits'), expanded_logits)
+        expanded_logits.set_weights(logits_weights)
+        for layer in model.layers:
+            # HadamardClassifier outputs are fixed, the layers before them learn the new classes
+            layer.trainable = layer is expanded_logits or \
+                (isinstance(expanded_logits, HadamardClassifier) and not isinstance(layer, Model))
+        print("Info: logits expanded from {} to {} classes".format(EXPANDED_FROM, N_CLASSES))
+
 elif True:
 
     if args.learning_rate is None:
@@ -936,12 +1691,18 @@ elif True:
 
     last_epoch = 0
 
+    # with --crop-size-schedule the model takes any crop size
+    INPUT_SIZE = CROP_SIZE if not CROP_SIZE_SCHEDULE else None
+    if args.dry_run and CROP_SIZE_SCHEDULE:
+        # estimates need every shape, use the largest crop size of the schedule
+        INPUT_SIZE = max(size for _, size in CROP_SIZE_SCHEDULE)
+
     classifier = globals()[args.classifier]
 
     kwargs = { \
         'include_top' : False,
         'weights'     : 'imagenet' if args.use_imagenet_weights else None,
-        'input_shape' : (CROP_SIZE, CROP_SIZE, 3), 
+        'input_shape' : (INPUT_SIZE, INPUT_SIZE, 3), 
         'pooling'     : args.pooling if args.pooling != 'none' else None,
      }
 
@@ -970,7 +1731,13 @@ elif True:
     if args.print_classifier_summary:
         classifier_model.summary()
 
-    if args.triplet_loss:
+    if args.triplet_pk:
+        # embed each image once, triplets are mined in the batch by pk_triplet_loss
+        input_image = Input(shape=(CROP_SIZE, CROP_SIZE, 3),  name = 'image' )
+
+        model = Model(inputs=input_image, outputs=classifier_model(input_image))
+
+    elif args.triplet_loss:
         input_image_p1 = Input(shape=(CROP_SIZE, CROP_SIZE, 3),  name = 'image_p1' )
         input_image_p2 = Input(shape=(CROP_SIZE, CROP_SIZE, 3),  name = 'image_p2' )
         input_image_n1 = Input(shape=(CROP_SIZE, CROP_SIZE, 3),  name = 'image_n1' )
@@ -1010,103 +1777,109 @@ elif True:
         model = Model(inputs=input_image, outputs=feature)
 
     else:
-        input_image = Input(shape=(CROP_SIZE, CROP_SIZE, 3),  name = 'image' )
-        x = input_image
-
-        x = classifier_model(x)
+        # head on top of the classifier features, a function so it can also be built on an Input
+        # of cached classifier features (see --feature-cache)
+        def build_head(x):
 
-        if args.reduce_pooling and x.shape.ndims == 4:
-            # reduce feature channels after classifier using convs
+            if args.reduce_pooling and x.shape.ndims == 4:
+                # reduce feature channels after classifier using convs
 
-            pool_features = int(x.shape[3])
+                pool_features = int(x.shape[3])
 
-            for it in range(int(math.log2(pool_features/args.reduce_pooling))):
+                for it in range(int(math.log2(pool_features/args.reduce_pooling))):
 
-                pool_features //= 2
-                x = Conv2D(pool_features, (3, 3), padding='same', use_bias=False, name='reduce_pooling{}'.format(it))(x)
-                x = BatchNormalization(name='bn_reduce_pooling{}'.format(it))(x)
-                x = Activation('relu', name='relu_reduce_pooling{}'.format(it))(x)
-            
-        if x.shape.ndims > 2:
-            # reduce spatial channels after classifier using pooling
-            if args.post_pooling == 'avg':
-                x = AveragePooling2D(pool_size=args.post_pool_size)(x)
-            elif args.post_pooling == 'max':
-                x = MaxPooling2D(pool_size=args.post_pool_size)(x)
+                    pool_features //= 2
+                    x = Conv2D(pool_features, (3, 3), padding='same', use_bias=False, name='reduce_pooling{}'.format(it))(x)
+                    x = BatchNormalization(name='bn_reduce_pooling{}'.format(it))(x)
+                    x = Activation('relu', name='relu_reduce_pooling{}'.format(it))(x)
 
-            x = Reshape((-1,), name='reshape0')(x)
+            if x.shape.ndims > 2:
+                # reduce spatial channels after classifier using pooling
+                if args.post_pooling == 'avg':
+                    x = AveragePooling2D(pool_size=args.post_pool_size)(x)
+                elif args.post_pooling == 'max':
+                    x = MaxPooling2D(pool_size=args.post_pool_size)(x)
 
-        if args.dropout_classifier != 0.:
-            x = Dropout(args.dropout_classifier, name='dropout_classifier')(x)
+                x = Reshape((-1,), name='reshape0')(x)
 
-        if not args.no_fcs and not args.hadamard:
+            if args.dropout_classifier != 0.:
+                x = Dropout(args.dropout_classifier, name='dropout_classifier')(x)
 
-            # regular FC classifier
-            dropouts = np.linspace( args.dropout,  args.dropout_last, len(args.fully_connected_layers))
-
-            x_m = x
-
-            for i, (fc_layer, dropout) in enumerate(zip(args.fully_connected_layers, dropouts)):
-                if args.batch_normalization:
-                    x_m = Dense(fc_layer//2, name= 'fc_m{}'.format(i))(x_m)
-                    x_m = BatchNormalization(name= 'bn_m{}'.format(i))(x_m)
-                    x_m = Activation(args.fully_connected_activation, 
-                                             name= 'act_m{}{}'.format(args.fully_connected_activation,i))(x_m)
-                else:
-                    x_m = Dense(fc_layer//2, activation=args.fully_connected_activation, 
-                                             name= 'fc_m{}'.format(i))(x_m)
-                if dropout != 0:
-                    x_m = Dropout(dropout,   name= 'dropout_fc_m{}_{:04.2f}'.format(i, dropout))(x_m)
-
-            for i, (fc_layer, dropout) in enumerate(zip(args.fully_connected_layers, dropouts)):
-                if args.batch_normalization:
-                    x = Dense(fc_layer,    name= 'fc{}'.format(i))(x)
-                    x = BatchNormalization(name= 'bn{}'.format(i))(x)
-                    x = Activation(args.fully_connected_activation, name='act{}{}'.format(args.fully_connected_activation,i))(x)
-                else:
-                    x = Dense(fc_layer, activation=args.fully_connected_activation, name= 'fc{}'.format(i))(x)
-                if dropout != 0:
-                    x = Dropout(dropout,                   name= 'dropout_fc{}_{:04.2f}'.format(i, dropout))(x)
+            if not args.no_fcs and not args.hadamard:
 
+                # regular FC classifier
+                dropouts = np.linspace( args.dropout,  args.dropout_last, len(args.fully_connected_layers))
 
-        if args.hadamard:
-            # ignore unscaled logits for now (_)
-            x_features = x
-            x, logits  = HadamardClassifier(N_CLASSES, name= "logits", l2_normalize=args.l2_normalize, output_raw_logits=True)(x)
-        elif not args.no_dense:
-            x          = Dense(             N_CLASSES, name= "logits")(x)
+                x_m = x
 
-        #print("Using {} activation and {} loss for predictions". format(activation, args.loss))          
+                for i, (fc_layer, dropout) in enumerate(zip(args.fully_connected_layers, dropouts)):
+                    if args.batch_normalization:
+                        x_m = Dense(fc_layer//2, name= 'fc_m{}'.format(i))(x_m)
+                        x_m = BatchNormalization(name= 'bn_m{}'.format(i))(x_m)
+                        x_m = Activation(args.fully_connected_activation, 
+                                                 name= 'act_m{}{}'.format(args.fully_connected_activation,i))(x_m)
+                    else:
+                        x_m = Dense(fc_layer//2, activation=args.fully_connected_activation, 
+                                                 name= 'fc_m{}'.format(i))(x_m)
+                    if dropout != 0:
+                        x_m = Dropout(dropout,   name= 'dropout_fc_m{}_{:04.2f}'.format(i, dropout))(x_m)
+
+                for i, (fc_layer, dropout) in enumerate(zip(args.fully_connected_layers, dropouts)):
+                    if args.batch_normalization:
+                        x = Dense(fc_layer,    name= 'fc{}'.format(i))(x)
+                        x = BatchNormalization(name= 'bn{}'.format(i))(x)
+                        x = Activation(args.fully_connected_activation, name='act{}{}'.format(args.fully_connected_activation,i))(x)
+                    else:
+                        x = Dense(fc_layer, activation=args.fully_connected_activation, name= 'fc{}'.format(i))(x)
+                    if dropout != 0:
+                        x = Dropout(dropout,                   name= 'dropout_fc{}_{:04.2f}'.format(i, dropout))(x)
+
+
+            if args.hadamard:
+                # ignore unscaled logits for now (_)
+                x_features = x
+                x, logits  = HadamardClassifier(N_CLASSES, name= "logits", l2_normalize=args.l2_normalize, output_raw_logits=True)(x)
+            elif not args.no_dense:
+                x          = Dense(             N_CLASSES, name= "logits")(x)
+
+            #print("Using {} activation and {} loss for predictions". format(activation, args.loss))          
+
+            prediction = Activation(activation ="softmax", name="predictions")(x)
+
+            if args.include_distractors:
+                if args.project_classifier_features != 0:
+                    d = HadamardClassifier(args.project_classifier_features, name= "features_project", l2_normalize=True, output_raw_logits=False)(x_features)
+                else:    
+                    d = logits
+                if args.top_k != 0:
+                    import tensorflow as tf
+                    def top_k(x, k):
+                        v, _ = tf.nn.top_k(x, k)
+                        return v
+                    d = Lambda(top_k, output_shape = (args.top_k,), arguments={'k' : args.top_k}, name='top_{}_logits'.format(args.top_k))(d)
+
+                if args.vgg_places365:
+                    places_features = VGG16Places365(include_top=False, pooling='avg')(input_image)
+                    d = concatenate([d, places_features])
+                elif args.vgg_places1365:
+                    places_features = VGG16PlacesHybrid1365(include_top=False, pooling='avg')(input_image)
+                    d = concatenate([d, places_features])
+                for features in [1024,512,256,128]:
+                        d = Dense(features,    name= 'd_fc{}'.format(features))(d)
+                        d = BatchNormalization(name= 'bn_m{}'.format(features))(d)
+                        d = Activation(args.fully_connected_activation,
+                            name= 'act_m{}{}'.format(args.fully_connected_activation,features))(d)
+
+                distractor = Dense(   1, activation='sigmoid', name='distractors')(d)        
+
+            return prediction if not args.include_distractors else (prediction, distractor)
+
+        input_image = Input(shape=(INPUT_SIZE, INPUT_SIZE, 3),  name = 'image' )
+        x = input_image
 
-        prediction = Activation(activation ="softmax", name="predictions")(x)
+        x = classifier_model(x)
 
-        if args.include_distractors:
-            if args.project_classifier_features != 0:
-                d = HadamardClassifier(args.project_classifier_features, name= "features_project", l2_normalize=True, output_raw_logits=False)(x_features)
-            else:    
-                d = logits
-            if args.top_k != 0:
-                import tensorflow as tf
-                def top_k(x, k):
-                    v, _ = tf.nn.top_k(x, k)
-                    return v
-                d = Lambda(top_k, output_shape = (args.top_k,), arguments={'k' : args.top_k}, name='top_{}_logits'.format(args.top_k))(d)
-
-            if args.vgg_places365:
-                places_features = VGG16Places365(include_top=False, pooling='avg')(input_image)
-                d = concatenate([d, places_features])
-            elif args.vgg_places1365:
-                places_features = VGG16PlacesHybrid1365(include_top=False, pooling='avg')(input_image)
-                d = concatenate([d, places_features])
-            for features in [1024,512,256,128]:
-                    d = Dense(features,    name= 'd_fc{}'.format(features))(d)
-                    d = BatchNormalization(name= 'bn_m{}'.format(features))(d)
-                    d = Activation(args.fully_connected_activation,
-                        name= 'act_m{}{}'.format(args.fully_connected_activation,features))(d)
-
-            distractor = Dense(   1, activation='sigmoid', name='distractors')(d)        
-
-        model = Model(inputs=input_image, outputs=prediction if not args.include_distractors else (prediction, distractor))
+        model = Model(inputs=input_image, outputs=build_head(x))
 
         if args.include_distractors:
             model.get_layer('logits').trainable = False
@@ -1114,13 +1887,15 @@ elif True:
     model_name = args.classifier
 
     if args.triplet_loss:
-        model_name += '-cs{}'.format(args.crop_size) 
+        model_name += '-cs{}'.format(args.crop_size) + \
+            ('-pk{}x{}{}'.format(args.triplet_pk, TRIPLET_PK_K, args.triplet_pk_mining) if args.triplet_pk else '')
     else:
         model_name += ('-hp' if args.hadamard else '') + \
         ('-l2' if args.l2_normalize else '-nol2' if args.hadamard else '') + \
         ('-pp{}{}'.format(args.post_pooling, args.post_pool_size) if args.post_pooling else '') + \
         '-loss{}'.format(args.loss) + \
-        '-cs{}'.format(args.crop_size) + \
+        ('-cs{}'.format(args.crop_size) if not CROP_SIZE_SCHEDULE else \
+         '-css{}'.format('_'.join(str(size) for _, size in CROP_SIZE_SCHEDULE))) + \
         ('-fc{}'.format(','.join([str(fc) for fc in args.fully_connected_layers])) if not args.no_fcs else '-nofc') + \
         ('-bn' if args.batch_normalization else '') + \
         (('-doc' + str(args.dropout_classifier)) if args.dropout_classifier != 0. else '') + \
@@ -1145,6 +1920,16 @@ elif True:
         match = re.search(r'([,A-Za-z_\d\.]+)-epoch(\d+)-.*\.hdf5', args.weights)
         last_epoch = int(match.group(2))        
 
+if args.dry_run or args.memory_budget:
+    stats = model_stats(model, optimizer=args.optimizer, amsgrad=args.amsgrad, accumulate=args.gradient_accumulation > 1,
+        checkpoints=args.gradient_checkpointing)
+    print_stats(stats, args.batch_size)
+    if args.memory_budget and memory_needed(stats, args.batch_size, training=training) > args.memory_budget * GB:
+        sys.exit("Estimated {:.2f} GB above --memory-budget {:.2f} GB, lower -b or -cs".format(
+            memory_needed(stats, args.batch_size, training=training) / GB, args.memory_budget))
+    if args.dry_run:
+        sys.exit(0)
+
 if training:
 
     if not args.triplet_loss:
@@ -1182,11 +1967,43 @@ if training:
             random.shuffle(ids_train)
             random.shuffle(ids_val)
         
+        ids_val_full = None
+        if args.val_subset_per_class:
+            # fixed stratified subset: up to n items of every landmark and distractors in proportion
+            ids_val_full = ids_val
+            rng = random.Random(SEED)
+            val_per_class, val_distractors = defaultdict(list), [ ]
+            for item in sorted(ids_val):
+                if args.include_distractors and get_id(item) in DISTRACTOR_IDS:
+                    val_distractors.append(item)
+                else:
+                    val_per_class[get_class(item)].append(item)
+            ids_val = [ ]
+            for items in val_per_class.values():
+                ids_val.extend(rng.sample(items, min(len(items), args.val_subset_per_class)))
+            ids_val.extend(rng.sample(val_distractors,
+                len(val_distractors) * len(ids_val) // max(len(ids_val_full) - len(val_distractors), 1)))
+            rng.shuffle(ids_val)
+            print("Validation subset: {} of {} items ({} per landmark){}".format(
+                len(ids_val), len(ids_val_full), args.val_subset_per_class,
+                ", full validation every {} epochs".format(args.full_val_every) if args.full_val_every else ""))
+
         print("Train split: {} Valid split {}".format(len(ids_train), len(ids_val)))
         print("Train/valid items overlap {}".format(len(set(ids_train).intersection(set(ids_val)))))
         print("Landmarks in train split {}".format(len({get_class(item) for item in ids_train})))
         print("Landmarks in valid split {}".format(len({get_class(item) for item in ids_val})))
 
+        if args.expand_classes:
+            # mostly items of the new classes, the old ones so their outputs keep calibrated
+            rng = random.Random(SEED)
+            new_items = [item for item in ids_train if get_class(item) >= EXPANDED_FROM]
+            old_items = [item for item in ids_train if get_class(item) <  EXPANDED_FROM]
+            n_old = min(len(old_items), int(len(new_items) * (1. - args.expand_classes_new_fraction) / args.expand_classes_new_fraction))
+            ids_train = new_items + rng.sample(old_items, n_old)
+            rng.shuffle(ids_train)
+            print("Info: training on {} items of {} new classes and {} of old classes".format(
+                len(new_items), N_CLASSES - EXPANDED_FROM, n_old))
+
         # compute class weight if not using class-aware sampling
         classes_train = [get_class(idx) for idx in ids_train]
         class_weight = class_weight.compute_class_weight('balanced', np.unique(classes_train), classes_train)
@@ -1194,6 +2011,14 @@ if training:
         ids_train = TRAIN_JPGS
         ids_val   = None
 
+    if args.data_parallel:
+        # each process trains on a slice of the items (of the same size so all run the same steps) and samples differently
+        ids_train = sorted(ids_train)
+        ids_train = ids_train[:len(ids_train) // args.data_parallel * args.data_parallel][args.rank::args.data_parallel]
+        random.seed(SEED + args.rank)
+        np.random.seed(SEED + args.rank)
+        print("Data parallel rank {}/{}: {} training items".format(args.rank, args.data_parallel, len(ids_train)))
+
     if args.optimizer == 'adam':
         opt = Adam(lr=args.learning_rate, amsgrad=args.amsgrad)
     elif args.optimizer == 'sgd':
@@ -1203,6 +2028,30 @@ if training:
     else:
         assert False
 
+    if args.gradient_accumulation > 1:
+        opt = AccumulateGradients(opt, args.gradient_accumulation)
+        print("Info: updating weights every {} batches, effective batch size {}".format(
+            args.gradient_accumulation, args.gradient_accumulation * args.batch_size))
+
+    if args.gradient_checkpointing:
+        # before allreduce_gradients so processes average the gradients computed with checkpoints
+        # (checkpoint tensors are looked up in the graph of the loss when compiling)
+        checkpoints = args.gradient_checkpointing if args.gradient_checkpointing in STRATEGIES else \
+            checkpoint_layers(model, args.gradient_checkpointing)
+        assert checkpoints, "--gradient-checkpointing: no layer name matches {}".format(args.gradient_checkpointing)
+        checkpoint_gradients(opt.optimizer if isinstance(opt, AccumulateGradients) else opt, model, args.gradient_checkpointing)
+        print("Info: gradient checkpointing with {}".format(
+            checkpoints if args.gradient_checkpointing in STRATEGIES else "outputs of {} layers".format(len(checkpoints))))
+
+    if args.data_parallel:
+        allreduce = SharedMemoryAllreduce(
+            join('/dev/shm', args.data_parallel_id), args.rank, args.data_parallel,
+            sum(K.count_params(w) for w in model.weights) + 1,
+            alive = (lambda: all(process.poll() is None for process in data_parallel_processes)) if args.rank == 0 else \
+                    (lambda: os.getppid() != 1))
+        # with -ga processes average the accumulated gradients once per update
+        allreduce_gradients(opt, allreduce)
+
     if args.freeze_classifier:
         for layer in model.layers:
             if isinstance(layer, Model):
@@ -1212,49 +2061,178 @@ if training:
                 if not args.freeze_all_classifiers:
                     break # otherwise freeze only first
 
-    if args.triplet_loss:
+    if args.feature_cache:
+        # train the head on classifier features computed once instead of every epoch
+        cache_key = weights_key(classifier_model, args.classifier, CROP_SIZE, args.pooling, args.delete_layers, args.bottleneck_features)
+        feature_cache = FeatureCache(
+            join(args.feature_cache_dir, '{}-cs{}-{}'.format(args.classifier, CROP_SIZE, cache_key)),
+            list(ids_train) + list(ids_val_full or ids_val), classifier_model.output_shape[1:], args.feature_cache_augmentations)
+        extract_features(feature_cache, classifier_model)
+
+        input_features = Input(shape=classifier_model.output_shape[1:], name='features')
+        head_model = Model(inputs=input_features, outputs=build_head(input_features))
+        if args.include_distractors:
+            head_model.get_layer('logits').trainable = False
+        # e.g. weights loaded with -w
+        copy_weights_by_name(model, head_model)
+        full_model = model
+        model = head_model
+
+    if args.sampled_softmax:
+        # train with the features fed to logits as output, predictions (full softmax) have no loss
+        inference_model = model
+        model = sampled_softmax_model(model)
+
+    if args.triplet_pk:
+        loss = pk_triplet_loss
+    elif args.triplet_loss:
         loss = identity_loss
+    elif args.sampled_softmax:
+        loss = { 'sampled_features' : sampled_softmax_loss(inference_model.get_layer('logits'), args.sampled_softmax) }
     else:
         if args.include_distractors:
             loss = { 'predictions' : zero_loss, 'distractors' : args.loss} 
         else:
             loss = { 'predictions' : args.loss} 
 
+    if args.triplet_loss and args.hard_negative_mining:
+        # the classifier shared by the triplet inputs embeds the images to mine
+        feature_model = next(layer for layer in model.layers if isinstance(layer, Model))
+
     model.summary()
     model = multi_gpu_model(model, gpus=args.gpus)
 
+    if args.triplet_pk:
+        train_metrics = [active_triplets]
+    elif args.triplet_loss:
+        train_metrics = None
+    else:
+        train_metrics = { 'predictions': ['categorical_accuracy'], 'distractors': ['binary_accuracy']}
+
     model.compile(optimizer=opt, 
         loss=loss, 
-        metrics={ 'predictions': ['categorical_accuracy'], 'distractors': ['binary_accuracy']} if not args.triplet_loss else None,
+        metrics=train_metrics,
         )
 
+    if args.sampled_softmax:
+        inference_model.compile(optimizer=opt, loss={ 'predictions' : args.loss }, metrics={ 'predictions': ['categorical_accuracy'] })
+
+    if args.feature_cache:
+        # so checkpoints of the full model can be resumed with -m like any other
+        full_model.compile(optimizer=opt, loss=loss,
+            metrics={ 'predictions': ['categorical_accuracy'], 'distractors': ['binary_accuracy']})
+
+    if args.find_batch_size:
+        batch_size = find_batch_size(model, candidate_batch_sizes(args.find_batch_size_max, max(args.gpus, 1)),
+            train=True, crop_size=CROP_SIZE, memory_cap=args.find_batch_size_memory_cap and args.find_batch_size_memory_cap * 1024 ** 3,
+            make_targets=(lambda batch_size: np.random.randint(max(batch_size // TRIPLET_PK_K, 1), size=(batch_size, 1)).astype(np.float32)) \
+                if args.triplet_pk else \
+                (lambda batch_size: [to_categorical(np.random.randint(N_CLASSES, size=batch_size), N_CLASSES)]) \
+                if args.sampled_softmax else None)
+        if not args.find_batch_size_apply or batch_size is None:
+            sys.exit(0)
+        args.batch_size = batch_size
+        print("Info: training with batch size {}".format(args.batch_size))
+
     if not args.triplet_loss:
         mode = 'max'
+        # metrics of the validation subset (-vspc) are val_* as those of the full split without it
+        val_name = 'valsub' if args.val_subset_per_class else 'val'
         if not args.include_distractors:
-            metric  = "-val_acc{val_categorical_accuracy:.6f}"
+            metric  = "-" + val_name + "_acc{val_categorical_accuracy:.6f}"
             monitor = "val_categorical_accuracy"
         else:
-            metric  = "-val_acc{val_distractors_binary_accuracy:.4f}"
+            metric  = "-" + val_name + "_acc{val_distractors_binary_accuracy:.4f}"
             monitor = "val_distractors_binary_accuracy"
     else:
         mode = 'min'
         metric = "-triplet_loss{loss:.6f}"
         monitor = 'loss'
 
-    save_checkpoint = ModelCheckpoint(
-            join(MODEL_FOLDER, model_name+"-epoch{epoch:03d}"+metric+".hdf5"),
-            monitor=monitor,
-            verbose=0,  save_best_only=True, save_weights_only=False, mode=mode, period=1)
+    async_val_csv = join(MODEL_FOLDER, model_name + "-async-val.csv")
+    if args.evaluate_checkpoints:
+        # evaluator of --async-validation: validates checkpoints until training ends, keeps the best as
+        # ModelCheckpoint would (with metric in the name) and deletes the others
+        val_generator = gen(ids_val, args.batch_size, training = False)
+        def evaluate(filepath):
+            with CustomObjectScope(custom_objects):
+                checkpoint_model = load_checkpoint(filepath)
+            results = checkpoint_model.evaluate_generator(val_generator, int(math.ceil(len(ids_val) / args.batch_size)))
+            results = dict(zip(checkpoint_model.metrics_names, results if isinstance(results, list) else [results]))
+            # a new graph for every checkpoint
+            K.clear_session()
+            configure_session()
+            return results
+        CheckpointEvaluator(
+            glob.escape(join(MODEL_FOLDER, model_name)) + "-epoch*-async.hdf5", async_val_csv,
+            join(MODEL_FOLDER, model_name+"-epoch{epoch:03d}"+metric+".hdf5"), evaluate, monitor, mode, args.evaluate_parent).run()
+        for generator in generators.values():
+            for worker in generator['workers']:
+                worker.terminate()
+        os._exit(0)
+
+    def make_checkpoint(metric, monitor, save_best_only=True):
+        if args.async_checkpoint:
+            checkpoint = AsyncModelCheckpoint(
+                join(MODEL_FOLDER, model_name+"-epoch{epoch:03d}"+metric+".hdf5"),
+                monitor=monitor,
+                verbose=0,  save_best_only=save_best_only, mode=mode, period=1, frozen_once=args.async_checkpoint_frozen_once)
+        else:
+            checkpoint = ModelCheckpoint(
+                join(MODEL_FOLDER, model_name+"-epoch{epoch:03d}"+metric+".hdf5"),
+                monitor=monitor,
+                verbose=0,  save_best_only=save_best_only, save_weights_only=False, mode=mode, period=1)
+        return checkpoint
+
+    # with --async-validation every epoch is checkpointed for the evaluator
+    save_checkpoint = checkpoint_writer = make_checkpoint(metric, monitor) if not args.async_validation else \
+        make_checkpoint("-async", 'loss', save_best_only=False)
+    if not args.async_checkpoint:
+        checkpoint_writer = None
+
+    if args.feature_cache:
+        # save the full model (classifier + head) not the head trained on cached features
+        save_checkpoint = HeadModelCheckpoint(save_checkpoint, full_model, head_model)
+
+    if args.sampled_softmax:
+        # save the full softmax model not the training model
+        save_checkpoint = InferenceModelCheckpoint(save_checkpoint, inference_model)
 
     reduce_lr = ReduceLROnPlateau(monitor=monitor, factor=0.2, patience=5, min_lr=1e-9, epsilon = 0.00001, verbose=1, mode=mode)
     
     clr = CyclicLR(base_lr=args.learning_rate/4, max_lr=args.learning_rate,
-                        step_size=int(math.ceil(len(ids_train)  / args.batch_size)) * 1, mode='exp_range',
-                        gamma=0.99994)
+                        step_size=int(math.ceil(len(ids_train)  / (args.batch_size * args.gradient_accumulation))) * 1, mode='exp_range',
+                        gamma=0.99994, batches_per_update=args.gradient_accumulation)
 
-    accuracy_callback = AccuracyReset(join(MODEL_FOLDER, model_name+"-epoch{epoch:03d}-group{group:03d}.hdf5"))
+    accuracy_callback = AccuracyReset(join(MODEL_FOLDER, model_name+"-epoch{epoch:03d}-group{group:03d}.hdf5"), checkpoint_writer)
     callbacks = [save_checkpoint]
 
+    if args.async_validation:
+        # first so reduce_lr sees the (lagging) metrics of the evaluator
+        callbacks.insert(0, AsyncValidationMetrics(async_val_csv))
+    elif args.sampled_softmax:
+        # first so the checkpoint and reduce_lr see the full softmax validation metrics
+        callbacks.insert(0, SampledSoftmaxValidation(
+            inference_model, gen(ids_val, args.batch_size, training = False), int(math.ceil(len(ids_val) / args.batch_size))))
+
+    if args.val_subset_per_class and args.rank == 0:
+        # first so the checkpoint of the full split and callbacks after it see val_full_* metrics
+        full_monitor = monitor.replace('val_', 'val_full_', 1)
+        full_checkpoint = make_checkpoint(metric.replace('-valsub_acc{val_', '-valfull_acc{val_full_'), full_monitor)
+        if args.feature_cache:
+            full_checkpoint = HeadModelCheckpoint(full_checkpoint, full_model, head_model)
+        callbacks.insert(0, FullValidation(
+            feature_gen(feature_cache, ids_val_full, args.batch_size, training = False) if args.feature_cache else \
+                gen(ids_val_full, args.batch_size, training = False, name = 'val full'),
+            int(math.ceil(len(feature_cache.good_items(ids_val_full) if args.feature_cache else ids_val_full) / args.batch_size)), args.full_val_every, args.max_epoch, full_checkpoint))
+
+    if metrics.enabled:
+        callbacks.append(MetricsCallback(metrics))
+
+    if timeline.enabled:
+        # first so the train_on_batch span does not include other callbacks
+        callbacks.insert(0, TimelineCallback(timeline))
+
     if args.class_aware_sampling:
         callbacks.append(accuracy_callback)
 
@@ -1265,22 +2243,203 @@ if training:
 
     if args.triplet_loss and False:
         callbacks.append(MonitorDistance())
-    
+
+    negatives_miner = None
+    if args.triplet_loss and args.hard_negative_mining:
+        items_per_class = defaultdict(list)
+        for item in ids_train:
+            items_per_class[get_class(item)].append(item)
+        negatives_miner = HardNegativeMiner(
+            feature_model, items_per_class, args.hard_negative_mining,
+            args.hard_negative_mining_classes, args.hard_negative_mining_negatives)
+        callbacks.append(negatives_miner)
+
+    if args.memory_report:
+        n_generators = 1 if args.triplet_loss else 2
+        n_workers    = n_generators * N_WORKERS
+        image_bytes  = CROP_SIZE * CROP_SIZE * 3 * 4 * ((TRIPLET_PK_K if args.triplet_pk else 3) if args.triplet_loss else 1)
+        callbacks.append(MemoryReport(
+            generators,
+            objects = {
+                'id_to_landmark'  : id_to_landmark,
+                'id_to_cat'       : id_to_cat,
+                'id_times_seen'   : id_times_seen,
+                'landmark_to_ids' : landmark_to_ids,
+                'cat_to_ids'      : cat_to_ids,
+                'clr.history'     : clr.history,
+            },
+            projected_workers = n_workers,
+            projected_buffers = {
+                'shared_mem_X' : n_workers * image_bytes,
+                'shared_mem_y' : n_workers * N_CLASSES * 4 if not args.triplet_loss else 0,
+                'batch X/y'    : n_generators * args.batch_size * (image_bytes // (TRIPLET_PK_K if args.triplet_pk else 1) + N_CLASSES * 4),
+            },
+            # decoded jpg, augmentation intermediates and the float32 crop
+            estimated_worker_bytes = 16 * CROP_SIZE * CROP_SIZE * 3 * 4))
+
+    if CROP_SIZE_SCHEDULE:
+        crop_size_schedule = CropSizeSchedule(CROP_SIZE_SCHEDULE, last_epoch)
+        # so generators start at the crop size of the first epoch trained
+        CROP_SIZE = crop_size_schedule.crop_size
+        callbacks.append(crop_size_schedule)
+
+    loss_sampler = None
+    if args.loss_aware_sampling:
+        # class weights go in the sample weights (Keras ignores class_weight when given sample weights)
+        loss_sampler = LossAwareSampler(
+            ids_train, args.loss, decay=args.loss_aware_sampling_decay, floor=args.loss_aware_sampling_floor,
+            class_weights=dict(zip(np.unique(classes_train), class_weight)), get_class=get_class)
+        callbacks.append(loss_sampler)
+
+    if args.metrics_log and args.rank == 0:
+        callbacks.append(MetricsLogger(MetricsLog(join(MODEL_FOLDER, model_name + "-metrics"))))
+
+    training_state = None
+    if args.save_state_every or args.resume_state:
+        training_state = TrainingState(
+            join(MODEL_FOLDER, model_name+"-state.pkl"), args.save_state_every, id_times_seen,
+            clr = clr if args.cyclic_learning_rate else None)
+        callbacks.append(training_state)
+
     # an epoch is just number of training samples, however if using class-aware sampling items are 
     # oversampled so one epoch does not see all distinct training items.
+    # with -tl an epoch sees every class once (with -tpk args.triplet_pk classes per batch)
+    steps_per_epoch = int(math.ceil((len(ids_train) if not args.triplet_loss else N_CLASSES) /
+        (args.triplet_pk if args.triplet_pk else args.batch_size)))
+
+    resume_epoch_step = 0
+    if args.resume_state:
+        state = TrainingState.load(args.resume_state)
+        training_state.restore(model, state)
+        last_epoch, resume_epoch_step = state['epoch'], state['epoch_step']
+        if resume_epoch_step >= steps_per_epoch:
+            last_epoch, resume_epoch_step = last_epoch + 1, 0
+        print("Resuming from {} at epoch {} step {}/{}".format(
+            args.resume_state, last_epoch + 1, resume_epoch_step, steps_per_epoch))
+        del state
+
+    if args.data_parallel:
+        if args.rank != 0:
+            # checkpoints, validation and reports on rank 0, keep callbacks driving sampling and learning rate of this process
+            callbacks = [callback for callback in callbacks if callback in (clr, loss_sampler, negatives_miner, crop_size_schedule)]
+        callbacks.append(DataParallelSync(allreduce, args.data_parallel_baseline))
+
+    if args.feature_cache:
+        train_generator = feature_gen(feature_cache, ids_train, args.batch_size)
+    else:
+        train_generator = gen(ids_train, args.batch_size, accuracy_callback = accuracy_callback, state_callback = training_state,
+            negatives_miner = negatives_miner, loss_sampler = loss_sampler)
+
+    if args.benchmark_steps:
+        # trial of autotune.py/scaling.py: time training steps only, then stop workers and exit
+        # (with -dp every rank prints the images/s of its process, steps run in lockstep)
+        benchmark = ThroughputBenchmark(args.benchmark_warmup)
+        model.fit_generator(generator=train_generator, steps_per_epoch=args.benchmark_steps, epochs=1, callbacks=[benchmark], verbose=0)
+        print("BENCHMARK " + json.dumps({ 'images_per_second' : benchmark.images_per_second, 'rank' : args.rank }))
+        sys.stdout.flush()
+        for generator in generators.values():
+            for worker in generator['workers']:
+                worker.terminate()
+        if args.data_parallel and args.rank == 0:
+            for process in data_parallel_processes:
+                process.wait()
+            allreduce.close()
+        os._exit(0)
+
+    if args.lr_range_test:
+        range_test = LRRangeTest(min_lr=args.lr_range_test_bounds[0], max_lr=args.lr_range_test_bounds[1],
+            num_updates=args.lr_range_test_steps, mode=args.lr_range_test_mode, batches_per_update=args.gradient_accumulation)
+        model.fit_generator(generator=train_generator, steps_per_epoch=args.lr_range_test_steps * args.gradient_accumulation,
+            epochs=1, callbacks=[range_test] + ([crop_size_schedule] if crop_size_schedule else []))
+        csv_name = join(MODEL_FOLDER, model_name + "-lr-range.csv")
+        with open(csv_name, 'w') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['lr', 'smoothed_loss'])
+            writer.writerows(zip(range_test.lrs, range_test.losses))
+        suggestion = range_test.suggest()
+        if suggestion is None:
+            print("Not enough updates before the loss diverged, try a lower -lrtb or more -lrts (curve in {})".format(csv_name))
+        else:
+            base_lr, max_lr, steepest_lr = suggestion
+            print("Suggested: -l {:.2e} (steepest loss decrease), or -clr -l {:.2e} (cycles {:.2e} to {:.2e}); curve in {}".format(
+                steepest_lr, max_lr, base_lr, max_lr, csv_name))
+        sys.stdout.flush()
+        for generator in generators.values():
+            for worker in generator['workers']:
+                worker.terminate()
+        os._exit(0)
+
+    # with --sampled-softmax validation is done by SampledSoftmaxValidation
+    validate = not (args.triplet_loss or args.sampled_softmax or args.async_validation) and args.rank == 0
+
+    if args.async_validation:
+        evaluator = subprocess.Popen([sys.executable] + [arg for arg in sys.argv if arg not in ('-av', '--async-validation')] + [
+            '--evaluate-checkpoints', '--evaluate-parent', str(os.getpid()), '--workers', str(args.async_validation_workers),
+            '--intra-op-threads', str(args.async_validation_threads), '--no-pin-cores'])
+        print("Info: evaluator process {} validates checkpoints ({} workers, {} threads), metrics in {}".format(
+            evaluator.pid, args.async_validation_workers, args.async_validation_threads, async_val_csv))
+
+    fit_kwargs = dict(
+            validation_data  = (feature_gen(feature_cache, ids_val, args.batch_size, training = False) if args.feature_cache else \
+                                gen(ids_val, args.batch_size, training = False)) if validate else None,
+            validation_steps = int(math.ceil(len(feature_cache.good_items(ids_val) if args.feature_cache else ids_val) / args.batch_size)) \
+                               if validate else None,
+            callbacks = callbacks,
+            verbose   = 1 if args.rank == 0 else 0,
+            class_weight={  'sampled_features' if args.sampled_softmax else 'predictions': class_weight } \
+                if ((not args.class_aware_sampling) and (not args.include_distractors) and (not args.triplet_loss) \
+                    and (not args.loss_aware_sampling) and (not args.expand_classes)) else None)
+
+    if resume_epoch_step != 0:
+        # finish the interrupted epoch, then requeue batches the Keras enqueuer read ahead (and discarded)
+        model.fit_generator(
+            generator        = train_generator,
+            steps_per_epoch  = steps_per_epoch - resume_epoch_step,
+            epochs = last_epoch + 1,
+            initial_epoch = last_epoch,
+            **fit_kwargs)
+        training_state.rewind()
+        last_epoch += 1
+
+    if args.expand_classes:
+        model.fit_generator(
+            generator        = train_generator,
+            steps_per_epoch  = steps_per_epoch,
+            epochs = last_epoch + args.expand_classes,
+            initial_epoch = last_epoch,
+            **fit_kwargs)
+        last_epoch += args.expand_classes
+        args.max_epoch = last_epoch + args.expand_classes_rebalance
+        if isinstance(expanded_logits, ExpandedDense):
+            # rebalance: train the outputs of old and new classes together
+            expanded_logits.train_old = True
+            model.compile(optimizer=opt, loss=loss, metrics=train_metrics)
+            print("Info: training old and new logits {} epochs".format(args.expand_classes_rebalance))
+        else:
+            print("Info: Hadamard logits have no old outputs to rebalance, training {} more epochs as before".format(args.expand_classes_rebalance))
+
     model.fit_generator(
-            generator        = gen(ids_train, args.batch_size, accuracy_callback = accuracy_callback),
-            steps_per_epoch  = int(math.ceil((len(ids_train) if not args.triplet_loss else N_CLASSES) / args.batch_size)),
-            validation_data  = gen(ids_val, args.batch_size, training = False) if not args.triplet_loss else None,
-            validation_steps = int(math.ceil(len(ids_val) / args.batch_size))  if not args.triplet_loss else None,
+            generator        = train_generator,
+            steps_per_epoch  = steps_per_epoch,
             epochs = args.max_epoch,
-            callbacks = callbacks,
             initial_epoch = last_epoch,
-            class_weight={  'predictions': class_weight } \
-                if ((not args.class_aware_sampling) and (not args.include_distractors) and (not args.triplet_loss)) else None)
+            **fit_kwargs)
+
+    if args.data_parallel and args.rank == 0:
+        for process in data_parallel_processes:
+            process.wait()
+        allreduce.close()
 
 elif args.test or args.test_train:
 
+    if args.find_batch_size:
+        batch_size = find_batch_size(multi_gpu_model(model, gpus=args.gpus), candidate_batch_sizes(args.find_batch_size_max, max(args.gpus, 1)),
+            train=False, crop_size=CROP_SIZE, memory_cap=args.find_batch_size_memory_cap and args.find_batch_size_memory_cap * 1024 ** 3)
+        if not args.find_batch_size_apply or batch_size is None:
+            sys.exit(0)
+        args.batch_size = batch_size
+        print("Info: predicting with batch size {}".format(args.batch_size))
+
     if args.test:
         with open(TEST_CSV, 'r') as csvfile:
             reader = csv.reader(csvfile, delimiter=',', quotechar='|')
@@ -1292,6 +2451,11 @@ elif args.test or args.test_train:
     if args.knn:
 
         features_dir = Path(args.features_dir) / "{}-cs{}".format(args.classifier,args.crop_size)
+        if args.knn_logits_input:
+            assert args.model, "--knn-logits-input needs a model with a logits layer (-m)"
+            # features the logits layer of the trained model is applied to (not its softmax output)
+            model = Model(inputs=model.inputs, outputs=model.get_layer('logits').input)
+            features_dir = Path(args.features_dir) / (os.path.splitext(os.path.basename(args.model))[0] + '-logits-input')
 
         os.makedirs(features_dir, exist_ok=True)
 
@@ -1301,13 +2465,15 @@ elif args.test or args.test_train:
 
         model = multi_gpu_model(model, gpus=args.gpus)
 
-        with Pool(min(args.batch_size, cpu_count())) as pool:
-            process_item_func  = partial(process_item, predict = True)
+        with Pool(min(args.batch_size, args.workers or cpu_count()), initializer=configure_worker, initargs=(WORKER_CORES, args.worker_threads)) as pool:
 
             imgs = np.empty((args.batch_size, CROP_SIZE, CROP_SIZE, 3), dtype=np.float32)
 
             if args.test_train:
 
+                metrics.set('inference_items', sum(
+                    min(len(landmark_to_ids[landmark]), args.knn_landmark_samples) for landmark in range(N_CLASSES)))
+
                 for landmark in tqdm(range(N_CLASSES)):
 
                     batch_id = 0
@@ -1320,7 +2486,7 @@ elif args.test or args.test_train:
                     items = [Path(TRAIN_DIR) / (idx + '.jpg') for idx in idxs]
 
                     #print(items)
-                    batch_results = pool.map(process_item_func, items)
+                    batch_results = pool_map_items(pool, items)
                     #print(batch_results)
 
                     f = 0
@@ -1335,14 +2501,16 @@ elif args.test or args.test_train:
                             batch_id += 1
 
                             if batch_id == args.batch_size:
-                                features[f:f+batch_id,...] = model.predict(imgs[:batch_id])
+                                with timeline.span('predict'):
+                                    features[f:f+batch_id,...] = model.predict(imgs[:batch_id])
                                 f += batch_id
                                 batch_id = 0
                                 batch_idx = [ ]
 
                     # predict remaining items (if any)
                     if batch_id != 0:
-                        features[f:f+batch_id,...] = model.predict(imgs[:batch_id])
+                        with timeline.span('predict'):
+                            features[f:f+batch_id,...] = model.predict(imgs[:batch_id])
                         f += batch_id
 
                     np.save(features_dir / str(landmark), features[:f])
@@ -1352,20 +2520,23 @@ elif args.test or args.test_train:
             elif args.test:
 
                 def predict_minibatch():
-                    features = model.predict(imgs[:batch_id])
+                    with timeline.span('predict'):
+                        features = model.predict(imgs[:batch_id])
                     for i, (feature, _idx) in enumerate(zip(features, batch_idx)):
                         np.save(features_dir / _idx , feature)
 
                 batch_id = 0
                 batch_idx = [ ]
 
+                metrics.set('inference_items', len(all_test_ids))
+
                 for idxs in tqdm(
                     (all_test_ids[ii:ii+args.batch_size] for ii in range(0, len(all_test_ids), args.batch_size)), 
                     total=math.ceil(len(all_test_ids) / args.batch_size)):
 
                     items = [Path(TEST_DIR) / (idx + '.jpg') for idx in idxs]
 
-                    batch_results = pool.map(process_item_func, items)
+                    batch_results = pool_map_items(pool, items)
 
                     for idx, (img, _, _) in zip(idxs, batch_results):
 
@@ -1384,6 +2555,7 @@ elif args.test or args.test_train:
                 if batch_id != 0:
                     predict_minibatch()
 
+        timeline.save()
 
     else:
         has_distractor_head = True if len(model.outputs) > 1 else False
@@ -1403,8 +2575,7 @@ elif args.test or args.test_train:
             all_ids  = list(TRAIN_IDS)#[:20000] # CHANGE
             jpgs_dir = TRAIN_DIR
 
-        with Pool(min(args.batch_size, cpu_count())) as pool:
-            process_item_func  = partial(process_item, predict = True)
+        with Pool(min(args.batch_size, args.workers or cpu_count()), initializer=configure_worker, initargs=(WORKER_CORES, args.worker_threads)) as pool:
 
             with open(csv_name, 'w') as csvfile:
 
@@ -1417,11 +2588,12 @@ elif args.test or args.test_train:
                 batch_idx = [ ]
 
                 def predict_minibatch():
-                    if has_distractor_head:
-                        predictions, distractors, logits = model.predict(imgs[:batch_id])
-                    else:
-                        predictions, logits              = model.predict(imgs[:batch_id])
-                        distractors = predictions # hack to avoid code dup
+                    with timeline.span('predict'):
+                        if has_distractor_head:
+                            predictions, distractors, logits = model.predict(imgs[:batch_id])
+                        else:
+                            predictions, logits              = model.predict(imgs[:batch_id])
+                            distractors = predictions # hack to avoid code dup
 
                     cats = np.argmax(predictions, axis=1)
                     for i, (cat, distractor, logit, _idx) in enumerate(zip(cats, distractors, logits, batch_idx)):
@@ -1442,13 +2614,15 @@ elif args.test or args.test_train:
                         else:
                             csv_writer.writerow([_idx, ""])    
 
+                metrics.set('inference_items', len(all_ids))
+
                 for idxs in tqdm(
                     (all_ids[ii:ii+args.batch_size] for ii in range(0, len(all_ids), args.batch_size)), 
                     total=math.ceil(len(all_ids) / args.batch_size)):
 
                     items = [Path(jpgs_dir) / (idx + '.jpg') for idx in idxs]
 
-                    batch_results = pool.map(process_item_func, items)
+                    batch_results = pool_map_items(pool, items)
 
                     for idx, (img, _, _) in zip(idxs, batch_results):
 
@@ -1469,6 +2643,8 @@ elif args.test or args.test_train:
                 if batch_id != 0:
                     predict_minibatch()
 
+        timeline.save()
+
         if args.test:
             print("kaggle competitions submit -f {} -m '{}'".format(
                 csv_name,
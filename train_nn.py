@@ -21,6 +21,9 @@ import keras.losses
 from multi_gpu_keras import multi_gpu_model
 from clr_callback import CyclicLR
 from hadamard import HadamardClassifier
+from signal_profiler import SignalProfiler
+from metrics_server import Metrics
+from metrics_callback import MetricsCallback
 import re
 import itertools
 from statistics import mean
@@ -57,8 +60,11 @@ parser.add_argument('-fc', '--fully-connected-layers', nargs='+', type=int, defa
 parser.add_argument('-bn', '--batch-normalization', action='store_true', help='Use batch normalization in FC layers')
 parser.add_argument('-fca', '--fully-connected-activation', type=str, default='relu', help='Activation function to use in FC layers, e.g. -fca relu|selu|prelu|leakyrelu|elu|...')
 parser.add_argument('-hp', '--hadamard', action='store_true', help='Use Hadamard projection instead of FC layers, see https://arxiv.org/pdf/1801.04540.pdf')
+parser.add_argument('-pw', '--profile-window', type=float, default=30., help='Seconds to profile main process and workers for when sent SIGUSR1 (kill -USR1 pid), e.g. -pw 60')
+parser.add_argument('-mp', '--metrics-port', type=int, default=None, help='Serve Prometheus metrics (throughput, lr, loss) on localhost port, e.g. -mp 9100')
 parser.add_argument('-tn', '--top-n', type=int, default=16, help='Use top-N NNs)')
 parser.add_argument('-d', '--dense', action='store_true', help='Use dense model')
+parser.add_argument('-wk', '--workers', type=int, default=32, help='Generator worker processes with --dense (sparse generators run in the main process), e.g. -wk 16')
 
 # test
 parser.add_argument('-t', '--test', action='store_true', help='Test model and generate CSV/npy submission file')
@@ -66,6 +72,8 @@ parser.add_argument('-tt', '--test-train', action='store_true', help='Test model
 # yapf: enable
 
 args = parser.parse_args()
+SignalProfiler('train_nn', window=args.profile_window).install()
+metrics = Metrics(args.metrics_port).serve()
 
 training = not (args.test or args.test_train)
 n_nets = len(args.networks)
@@ -450,6 +458,13 @@ if training:
     else:
         callbacks.append(reduce_lr)
 
+    n_workers = args.workers if args.dense else 0
+
+    if metrics.enabled:
+        metrics.describe('generator_workers', 'gauge', 'Generator worker processes')
+        metrics.set('generator_workers', n_workers)
+        callbacks.append(MetricsCallback(metrics))
+
     generator = dense_generator if args.dense else sparse_generator
 
     model.fit_generator(
@@ -463,8 +478,8 @@ if training:
         validation_steps=np.ceil(
             float(len(IDX_VALID_SPLIT)) / float(args.batch_size)) - 1,
         initial_epoch=last_epoch,
-        use_multiprocessing = True if args.dense else False,
-        workers = 32 if args.dense else False)
+        use_multiprocessing = n_workers > 0,
+        workers = n_workers)
 
 elif args.test or args.test_train:
     pass
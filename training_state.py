@@ -0,0 +1,145 @@
+import os
+import pickle
+import random
+import threading
+
+import numpy as np
+from keras import backend as K
+from keras.callbacks import Callback
+
+class TrainingState(Callback):
+    """Snapshots the training pipeline state every `every` steps so an interrupted run
+    can be resumed at the exact step it was interrupted.
+
+    A snapshot holds the model and optimizer weights, the learning rate, the CyclicLR
+    iteration counters, `id_times_seen`, the sampler state of the training generator
+    (cursors, permutations, class-aware sampling group, jobs in flight) and the
+    python/numpy RNG state of the main process. It is copied in memory between two
+    steps and pickled to disk by a background thread (atomic rename, so a crash never
+    leaves a half-written file).
+
+    The training generator registers itself by calling `set_generator` with two
+    functions, `get_state(batches_trained)` and `rewind(batches_trained)`, and the lock
+    it holds while sampling so the sampler and RNG state are captured together. Batches the
+    Keras enqueuer read ahead but the model has not trained on yet are stored as jobs
+    to replay, so resuming neither skips nor replays data.
+
+    # Arguments
+        filepath: where to write snapshots, e.g. models/ResNet50-...-state.pkl
+        every: snapshot every n training steps (0 to only use it for resuming)
+        id_times_seen: dict of item id -> times seen (shared with the generator)
+        clr: optional CyclicLR callback whose iteration counters are saved
+    """
+
+    def __init__(self, filepath, every, id_times_seen, clr=None):
+        super(TrainingState, self).__init__()
+        self.filepath      = filepath
+        self.every         = every
+        self.id_times_seen = id_times_seen
+        self.clr           = clr
+        self.step          = 0
+        self.epoch         = -1
+        self.epoch_step    = 0
+        self.resume_sampler = None
+        self._get_generator_state = None
+        self._rewind_generator    = None
+        self._generator_lock      = threading.Lock()
+        self._writer = None
+
+    def set_generator(self, get_state, rewind, lock):
+        self._get_generator_state = get_state
+        self._rewind_generator    = rewind
+        self._generator_lock      = lock
+
+    def on_epoch_begin(self, epoch, logs=None):
+        # when resuming mid-epoch keep the step count within the interrupted epoch
+        if epoch != self.epoch:
+            self.epoch      = epoch
+            self.epoch_step = 0
+
+    def on_batch_end(self, batch, logs=None):
+        self.step       += 1
+        self.epoch_step += 1
+        if self.every != 0 and self.step % self.every == 0:
+            self.snapshot()
+
+    def on_train_end(self, logs=None):
+        self.wait()
+
+    def snapshot(self):
+        state = {
+            'step'              : self.step,
+            'epoch'             : self.epoch,
+            'epoch_step'        : self.epoch_step,
+            'weights'           : self.model.get_weights(),
+            'optimizer_weights' : K.batch_get_value(self.model.optimizer.weights),
+            'lr'                : K.get_value(self.model.optimizer.lr),
+        }
+        if self.clr is not None:
+            state['clr'] = {
+                'clr_iterations' : self.clr.clr_iterations,
+                'trn_iterations' : self.clr.trn_iterations,
+                'batches'        : self.clr.batches,
+            }
+        # the generator samples (and advances the RNGs) from the Keras enqueuer thread
+        with self._generator_lock:
+            state['random']        = random.getstate()
+            state['np_random']     = np.random.get_state()
+            state['id_times_seen'] = dict(self.id_times_seen)
+            if self._get_generator_state is not None:
+                state['sampler'] = self._get_generator_state(self.step)
+
+        # only one snapshot in memory waiting to be written
+        self.wait()
+        self._writer = threading.Thread(target=self._write, args=(state,), daemon=True)
+        self._writer.start()
+
+    def wait(self):
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+    def _write(self, state):
+        tmp_filepath = self.filepath + '.tmp'
+        with open(tmp_filepath, 'wb') as fp:
+            pickle.dump(state, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filepath, self.filepath)
+        print("\nSaved training state at step {} (epoch {}, step {} of epoch) to {}".format(
+            state['step'], state['epoch'] + 1, state['epoch_step'], self.filepath))
+
+    @staticmethod
+    def load(filepath):
+        with open(filepath, 'rb') as fp:
+            return pickle.load(fp)
+
+    def restore(self, model, state):
+        """Restores weights, optimizer, RNG and counters from a snapshot into a compiled model.
+        The sampler state is handed to the training generator when it starts.
+        """
+        model.set_weights(state['weights'])
+        # optimizer weights only exist once the training function has been built
+        model._make_train_function()
+        model.optimizer.set_weights(state['optimizer_weights'])
+        K.set_value(model.optimizer.lr, state['lr'])
+
+        self.id_times_seen.update(state['id_times_seen'])
+        random.setstate(state['random'])
+        np.random.set_state(state['np_random'])
+
+        if self.clr is not None and 'clr' in state:
+            self.clr.clr_iterations = state['clr']['clr_iterations']
+            self.clr.trn_iterations = state['clr']['trn_iterations']
+            self.clr.batches        = state['clr'].get('batches', 0)
+
+        self.step           = state['step']
+        self.epoch          = state['epoch']
+        self.epoch_step     = state['epoch_step']
+        self.resume_sampler = state.get('sampler')
+
+    def rewind(self):
+        """Requeues batches the generator yielded but were not trained on, e.g. read ahead
+        by the Keras enqueuer of a `fit_generator` call that has returned.
+        """
+        if self._rewind_generator is not None:
+            with self._generator_lock:
+                self._rewind_generator(self.step)